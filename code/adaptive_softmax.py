@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+###############################
+# Adaptive softmax output layer (Grave et al., "Efficient softmax
+# approximation for GPUs"), an alternative to ner's hidden2score +
+# score2logP for large label sets such as the 1323 CCG supertags.
+#
+# The labels are ranked by their frequency in the training data and cut at
+# cutoffs into a head and tail clusters: the head scores the most frequent
+# labels plus one entry per tail cluster, and each tail cluster scores its
+# own labels from a projection of the hidden vector divided by div_value
+# once more per cluster, so rarer labels get smaller, cheaper layers:
+#   log P(label) = log P_head(label)                            (head label)
+#   log P(label) = log P_head(cluster) + log P_cluster(label)   (tail label)
+# With ner(..., output_layer="adaptive", adaptive_cutoffs=(100, 400)):
+#   - train computes the loss with nll, which only evaluates the tail
+#     clusters of the gold labels of each batch;
+#   - the decoders get the full (batch size, label size) log-probabilities
+#     from log_prob, in the original label indices.
+# The label ranking is a buffer, so it is saved with the checkpoints.
+###############################
+
+
+# Number of occurrences of each label in Y, a list of minibatches of label
+# sequences (as ner's train_Y)
+def label_counts(Y, label_size):
+  counts = np.zeros(label_size, dtype=np.int64)
+  for batch in Y:
+    for label_seq in batch:
+      counts += np.bincount(np.asarray(label_seq, dtype=np.int64), minlength=label_size)
+  return counts
+
+
+class AdaptiveSoftmax(nn.Module):
+  # counts: label frequencies giving the ranking (most frequent first),
+  # e.g. from label_counts; None keeps the label indices as ranks (as when
+  # the ranking is loaded from a checkpoint)
+  def __init__(self, hidden_dim, label_size, cutoffs, counts=None, div_value=4.0):
+    super(AdaptiveSoftmax, self).__init__()
+
+    cutoffs = list(cutoffs)
+    if len(cutoffs) == 0 or cutoffs != sorted(set(cutoffs)) \
+       or cutoffs[0] <= 0 or cutoffs[-1] >= label_size:
+      raise Exception("Adaptive softmax cutoffs must be increasing and within (0, %d): %s" % (label_size, cutoffs))
+
+    self.hidden_dim = hidden_dim
+    self.label_size = label_size
+    # Rank ranges [cutoffs[i], cutoffs[i + 1]) of the clusters, the head
+    # being [0, cutoffs[0])
+    self.cutoffs = cutoffs + [label_size]
+    self.num_clusters = len(cutoffs)
+
+    self.head = nn.Linear(hidden_dim, cutoffs[0] + self.num_clusters)
+    self.tail = nn.ModuleList()
+    for i in range(self.num_clusters):
+      projection_dim = max(1, int(hidden_dim // (div_value ** (i + 1))))
+      self.tail.append(nn.Sequential(
+        nn.Linear(hidden_dim, projection_dim, bias=False),
+        nn.Linear(projection_dim, self.cutoffs[i + 1] - self.cutoffs[i])))
+
+    if counts is None:
+      label_order = np.arange(label_size)
+    else:
+      # Stable, so that labels of equal count keep their index order
+      label_order = np.argsort(-np.asarray(counts), kind="mergesort")
+    # label_order[rank] is a label, label_rank[label] its rank
+    self.register_buffer("label_order", torch.from_numpy(label_order.astype(np.int64)))
+    self.register_buffer("label_rank", torch.from_numpy(np.argsort(label_order).astype(np.int64)))
+
+  # h: (N, hidden_dim) => log-probabilities of all the labels, (N, label_size)
+  def log_prob(self, h):
+    head_logP = F.log_softmax(self.head(h), dim=1)
+    # Columns by rank
+    logP = [head_logP[:, :self.cutoffs[0]]]
+    for i, tail in enumerate(self.tail):
+      cluster_logP = head_logP[:, self.cutoffs[0] + i].contiguous().view(-1, 1)
+      logP.append(F.log_softmax(tail(h), dim=1) + cluster_logP)
+    # Back to label indices
+    return torch.cat(logP, dim=1).index_select(1, self.label_rank)
+
+  # Summed negative log-likelihood of the labels (N) given h (N, hidden_dim),
+  # as NLLLoss(size_average=False) on log_prob(h) but computing each tail
+  # cluster only for the rows whose label is in it
+  def nll(self, h, labels):
+    rank = self.label_rank.index_select(0, labels.view(-1))
+    head_target = rank.clone()
+    loss = 0
+    for i, tail in enumerate(self.tail):
+      low, high = self.cutoffs[i], self.cutoffs[i + 1]
+      rows = ((rank >= low) & (rank < high)).nonzero().view(-1)
+      if rows.numel() == 0:
+        continue
+      head_target.index_fill_(0, rows, self.cutoffs[0] + i)
+      tail_logP = F.log_softmax(tail(h.index_select(0, rows)), dim=1)
+      loss = loss - tail_logP.gather(1, (rank.index_select(0, rows) - low).view(-1, 1)).sum()
+
+    head_logP = F.log_softmax(self.head(h), dim=1)
+    return loss - head_logP.gather(1, head_target.view(-1, 1)).sum()
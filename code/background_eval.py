@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+
+###############################
+# Evaluation of ner.train's model in a separate process, so that an epoch of
+# training does not wait for the validation and test decoding.
+#
+# The evaluator holds a copy of the weights in shared memory. publish()
+# copies the current weights into it (under a lock) and returns; the
+# evaluator process loads the latest published snapshot into its own copy of
+# the model, runs evaluate on the validation and test sets for every decode
+# configuration and appends one line per configuration to the log file:
+#   eval  epoch  decode_method  beam_size  val F  test F  eval time
+# (accuracy in place of F for the CCG copies). Snapshots published while an
+# evaluation is running are not queued: only the latest one is evaluated
+# next. close() waits for the last published snapshot to be evaluated;
+# close(wait=False), as when training fails, stops the evaluator at once. The
+# process is a daemon, so it never keeps its parent from exiting.
+#
+# A configuration is (decode_method, beam_size) or
+# (decode_method, beam_size, max_beam_size, agent) for adaptive decoding.
+###############################
+
+
+def copy_state(target, source):
+  for name, tensor in source.items():
+    target[name].copy_(tensor)
+
+
+def run_evaluator(machine, snapshot, snapshot_epoch, lock, published, done,
+                  configs, log_filename, f_score_index_begin, num_threads):
+  torch.set_num_threads(num_threads)
+  state = machine.state_dict()
+  last_epoch = None
+
+  while True:
+    published.wait()
+    published.clear()
+
+    with lock:
+      epoch = snapshot_epoch.value
+      is_new = epoch >= 0 and epoch != last_epoch
+      if is_new:
+        copy_state(state, snapshot)
+
+    if is_new:
+      last_epoch = epoch
+      for config in configs:
+        decode_method, beam_size = config[:2]
+        max_beam_size, agent = config[2:] if len(config) > 2 else (beam_size, None)
+
+        time_begin = time.time()
+        val_fscore, _, _ = machine.evaluate(machine.val_X, machine.val_Y, None, None, "val", None, decode_method, beam_size, max_beam_size, agent, 0, 0, f_score_index_begin, generate_episode=False)
+        test_fscore, _, _ = machine.evaluate(machine.test_X, machine.test_Y, None, None, "test", None, decode_method, beam_size, max_beam_size, agent, 0, 0, f_score_index_begin, generate_episode=False)
+        time_end = time.time()
+
+        print("background evaluation of epoch", epoch, decode_method, beam_size,
+              ": validation F score = %.6f" % val_fscore,
+              ", test F score = %.6f" % test_fscore)
+        # One write per line, appended, next to the trainer's lines
+        with open(log_filename, "a") as f:
+          f.write("eval\t%d\t%s\t%s\t%f\t%f\t%f\n" % (epoch, decode_method, beam_size, val_fscore, test_fscore, time_end - time_begin))
+
+    # Stop once closed, unless a newer snapshot came in meanwhile
+    if done.value and snapshot_epoch.value in [-1, last_epoch]:
+      break
+
+
+class BackgroundEvaluator():
+  def __init__(self, machine, configs, log_filename, f_score_index_begin, num_threads=1):
+    self.machine = machine
+    self.snapshot = {name: tensor.cpu().clone().share_memory_()
+                     for name, tensor in machine.state_dict().items()}
+    self.snapshot_epoch = mp.Value('i', -1)
+    self.lock = mp.Lock()
+    self.published = mp.Event()
+    self.done = mp.Value('b', False)
+
+    self.process = mp.Process(target=run_evaluator,
+                              args=(machine, self.snapshot, self.snapshot_epoch,
+                                    self.lock, self.published, self.done,
+                                    configs, log_filename, f_score_index_begin,
+                                    num_threads),
+                              daemon=True)
+    self.process.start()
+
+  def publish(self, epoch):
+    with self.lock:
+      copy_state(self.snapshot, self.machine.state_dict())
+      self.snapshot_epoch.value = epoch
+    self.published.set()
+
+  # Wait until the latest snapshot has been evaluated, then stop
+  def close(self, wait=True):
+    if not wait:
+      self.process.terminate()
+    self.done.value = True
+    self.published.set()
+    self.process.join()
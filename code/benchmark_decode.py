@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from det_agent import det_agent
+from ner import ner
+
+
+###############################
+# Micro-benchmark of the decoders on a randomly initialized ner model, so it
+# needs no dataset or checkpoint and runs anywhere.
+#
+# For every label size (12 = German NER, 1323 = CCG by default), sentence
+# length and beam size, times on one random sentence:
+#   greedy:      decode_greedy
+#   beam:        decode_beam
+#   beam_step:   the decode_beam_step + top-k loop of decode_beam_adaptive,
+#                with a fixed beam size and no agent
+#   adaptive:    decode_beam_adaptive with det_agent (beam size = initial
+#                beam size, max_beam_size = --max-beam-size)
+# Each timing is the median of --repeats runs after --warmup runs, excluding
+# the encoder. Results (and the decode_cost counters) go to a JSON baseline;
+# --compare prints the ratios against an older baseline and flags the
+# configurations that got slower by more than --tolerance.
+#
+# With --output-layer adaptive, the model has an adaptive softmax output
+# layer (see adaptive_softmax.py) cut at the --adaptive-cutoffs below each
+# label size; label sizes with no such cutoff are skipped.
+#
+# Usage:
+#   python3 benchmark_decode.py --output ../result_benchmark/baseline.json
+#   python3 benchmark_decode.py --compare ../result_benchmark/baseline.json
+###############################
+
+
+def int_list(text):
+  return [int(x) for x in text.split(",")]
+
+
+def random_sentence(vocab_size, label_size, seq_len, rng):
+  # Keep 0 (<PAD>) and 1 (<BEG>) out, as in the real data
+  sen = rng.randint(2, vocab_size, size=(1, seq_len)).tolist()
+  label = rng.randint(2, label_size, size=(1, seq_len)).tolist()
+  return Variable(torch.LongTensor(sen)), Variable(torch.LongTensor(label))
+
+
+def encode(machine, sen_var):
+  init_enc_hidden = Variable(torch.zeros((2, 1, machine.hidden_dim)))
+  init_enc_cell = Variable(torch.zeros((2, 1, machine.hidden_dim)))
+  enc_hidden_seq, (enc_hidden_out, enc_cell_out) = machine.encode(sen_var, init_enc_hidden, init_enc_cell)
+  init_dec_hidden = machine.enc2dec_hidden(torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
+  init_dec_cell = machine.enc2dec_cell(torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
+  return enc_hidden_seq, init_dec_hidden, init_dec_cell
+
+
+# The decode_beam_step loop of decode_beam_adaptive, with a fixed beam size
+def decode_beam_step_loop(machine, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, beam_size):
+  init_label_emb = machine.label_embedding(
+    Variable(torch.LongTensor(1, 1).zero_()) + machine.BEG_INDEX) \
+    .view(1, machine.label_embedding_dim)
+  dec_hidden_out, dec_cell_out = machine.decoder_cell(init_label_emb, (init_dec_hidden, init_dec_cell))
+  if machine.attention:
+    dec_hidden_out, _ = machine.attention(dec_hidden_out[None, :, :], enc_hidden_seq, 0, machine.enc2dec_hidden)
+    dec_hidden_out = dec_hidden_out.view(1, machine.hidden_dim)
+
+  accum_logP_matrix = machine.output_logP(dec_hidden_out, 0)
+  dec_hidden_beam = torch.stack([dec_hidden_out], dim=0)
+  dec_cell_beam = torch.stack([dec_cell_out], dim=0)
+
+  beam_size_in = min(beam_size, machine.label_size)
+  accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size_in, dim=1)
+  for t in range(1, seq_len):
+    beta_beam = torch.floor(index_beam.float() / machine.label_size).long()
+    y_beam = torch.remainder(index_beam, machine.label_size)
+    accum_logP_matrix, _, dec_hidden_beam, dec_cell_beam, _, _, _ = \
+      machine.decode_beam_step(beam_size_in, y_beam, beta_beam,
+                               dec_hidden_beam, dec_cell_beam, accum_logP_beam,
+                               enc_hidden_seq, seq_len, t)
+    accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size_in, dim=1)
+  return accum_logP_beam
+
+
+def time_decoder(run, repeats, warmup):
+  for _ in range(warmup):
+    run()
+  times = []
+  for _ in range(repeats):
+    time_begin = time.time()
+    run()
+    times.append(time.time() - time_begin)
+  return float(np.median(times)), float(np.min(times))
+
+
+def benchmark(args):
+  results = []
+  for label_size in args.label_sizes:
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+
+    adaptive_cutoffs = [cutoff for cutoff in args.adaptive_cutoffs if cutoff < label_size]
+    if args.output_layer == "adaptive" and len(adaptive_cutoffs) == 0:
+      print("Skipping label size %d: no adaptive softmax cutoff below it" % label_size)
+      continue
+
+    machine = ner(args.word_embedding_dim, args.hidden_dim, args.label_embedding_dim, args.vocab_size, label_size, minibatch_size=1, attention=args.attention, gpu=False, output_layer=args.output_layer, adaptive_cutoffs=adaptive_cutoffs)
+    max_beam_size = min(args.max_beam_size, label_size)
+    agent = det_agent(max_beam_size, args.accum_logP_ratio_low, args.logP_ratio_low)
+
+    for seq_len in args.lengths:
+      sen_var, label_var = random_sentence(args.vocab_size, label_size, seq_len, rng)
+      enc_hidden_seq, init_dec_hidden, init_dec_cell = encode(machine, sen_var)
+
+      runs = [("greedy", 1, lambda: machine.decode_greedy(1, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq))]
+      for beam_size in args.beam_sizes:
+        if beam_size > label_size:
+          continue
+        runs.append(("beam", beam_size, lambda beam_size=beam_size: machine.decode_beam(1, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, beam_size)))
+        runs.append(("beam_step", beam_size, lambda beam_size=beam_size: decode_beam_step_loop(machine, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, beam_size)))
+        if beam_size <= max_beam_size:
+          runs.append(("adaptive", beam_size, lambda beam_size=beam_size: machine.decode_beam_adaptive(seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, beam_size, max_beam_size, agent, 1, 0.1, label_var, 2, generate_episode=False)))
+
+      for decoder, beam_size, run in runs:
+        # Counters of one run (see decode_cost.py)
+        machine.decode_cost.reset()
+        run()
+        cost = machine.decode_cost.as_list()[:-1]
+
+        median_time, min_time = time_decoder(run, args.repeats, args.warmup)
+        result = {"label_size": label_size, "seq_len": seq_len,
+                  "decoder": decoder, "beam_size": beam_size,
+                  "median_s": median_time, "min_s": min_time,
+                  "per_token_ms": 1000 * median_time / seq_len,
+                  "lstm_cell": cost[0], "topk": cost[1],
+                  "candidates": cost[2], "agent_calls": cost[3]}
+        results.append(result)
+        print("%d\t%d\t%s\t%d\t%.6f\t%.4f" % (label_size, seq_len, decoder, beam_size, median_time, result["per_token_ms"]))
+  return results
+
+
+def result_key(result):
+  return (result["label_size"], result["seq_len"], result["decoder"], result["beam_size"])
+
+
+def compare(results, baseline_filename, tolerance):
+  with open(baseline_filename) as f:
+    baseline = {result_key(result): result for result in json.load(f)["results"]}
+
+  regressions = 0
+  print("label_size\tseq_len\tdecoder\tbeam_size\tbaseline_s\tnew_s\tratio")
+  for result in results:
+    old = baseline.get(result_key(result))
+    if old is None:
+      continue
+    ratio = result["median_s"] / old["median_s"] if old["median_s"] > 0 else float("inf")
+    flag = ""
+    if ratio > 1 + tolerance:
+      flag = "\tREGRESSION"
+      regressions += 1
+    print("%d\t%d\t%s\t%d\t%.6f\t%.6f\t%.3f%s" % (result_key(result) + (old["median_s"], result["median_s"], ratio, flag)))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Decoder micro-benchmark on a random model')
+  parser.add_argument('--label-sizes', type=int_list, default=[12, 1323],
+                      help='comma-separated label sizes (default: 12,1323)')
+  parser.add_argument('--lengths', type=int_list, default=[10, 30, 100],
+                      help='comma-separated sentence lengths (default: 10,30,100)')
+  parser.add_argument('--beam-sizes', type=int_list, default=[1, 3, 5, 10],
+                      help='comma-separated beam sizes (default: 1,3,5,10)')
+  parser.add_argument('--max-beam-size', type=int, default=10,
+                      help='max beam size of the adaptive decoder (default: 10)')
+  parser.add_argument('--accum-logP-ratio-low', type=float, default=0.1,
+                      help='det_agent threshold (default: 0.1)')
+  parser.add_argument('--logP-ratio-low', type=float, default=0.1,
+                      help='det_agent threshold (default: 0.1)')
+  parser.add_argument('--vocab-size', type=int, default=10000,
+                      help='word vocabulary size (default: 10000)')
+  parser.add_argument('--word-embedding-dim', type=int, default=64)
+  parser.add_argument('--hidden-dim', type=int, default=64)
+  parser.add_argument('--label-embedding-dim', type=int, default=8)
+  parser.add_argument('--attention', default='fixed',
+                      help='attention type, or "none" (default: fixed)')
+  parser.add_argument('--output-layer', choices=['softmax', 'adaptive'], default='softmax',
+                      help='output layer of the model (default: softmax)')
+  parser.add_argument('--adaptive-cutoffs', type=int_list, default=[100, 400],
+                      help='comma-separated adaptive softmax cutoffs (default: 100,400)')
+  parser.add_argument('--repeats', type=int, default=5,
+                      help='timed runs per configuration (default: 5)')
+  parser.add_argument('--warmup', type=int, default=1,
+                      help='untimed runs per configuration (default: 1)')
+  parser.add_argument('--threads', type=int, default=1,
+                      help='torch threads (default: 1)')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', default=None,
+                      help='where to write the JSON results')
+  parser.add_argument('--compare', default=None,
+                      help='JSON results of an earlier run to compare against')
+  parser.add_argument('--tolerance', type=float, default=0.1,
+                      help='slowdown flagged as a regression (default: 0.1)')
+  args = parser.parse_args()
+
+  if args.attention == "none":
+    args.attention = None
+  torch.set_num_threads(args.threads)
+
+  results = benchmark(args)
+
+  if args.output:
+    config = dict(vars(args))
+    config.update({"torch": torch.__version__,
+                   "python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "processor": platform.processor()})
+    with open(args.output, "w") as f:
+      json.dump({"config": config, "results": results}, f, indent=2)
+
+  if args.compare:
+    regressions = compare(results, args.compare, args.tolerance)
+    print("%d regression(s)" % regressions)
+
+
+if __name__ == "__main__":
+  main()
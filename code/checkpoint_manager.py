@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+import os
+import queue
+import re
+import threading
+
+import torch
+import torch.multiprocessing as mp
+
+
+###############################
+# Checkpoints written off the training path.
+#
+# save(epoch, state) copies the tensors of state (state dicts of the model
+# and the optimizer, nested dicts / lists) to CPU memory and returns; a
+# background thread then torch.saves the copy to <prefix><epoch>.pth.tmp.<pid>
+# and renames it to <prefix><epoch>.pth, so a crash never leaves a partial
+# checkpoint under the final name.
+#
+# The manager can be created before forking workers (A3C): the epoch
+# bookkeeping is in shared memory, so only the first worker saving an epoch
+# writes it and the others' saves of that epoch are dropped. (The original
+# scripts had every worker overwrite the same file under a lock.) Each
+# process starts its own writer thread and has to call close() before
+# exiting so that its pending checkpoints are written.
+#
+# Retention, applied after every write: with keep_last, only the last
+# keep_last epochs on disk and the best one (highest score passed to save,
+# if any) are kept. keep_last=None keeps everything.
+###############################
+
+
+def snapshot(obj):
+  if torch.is_tensor(obj):
+    return obj.cpu().clone()
+  if isinstance(obj, dict):
+    return type(obj)((key, snapshot(value)) for key, value in obj.items())
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(snapshot(value) for value in obj)
+  return obj
+
+
+class CheckpointManager():
+  def __init__(self, directory, prefix="ckpt_", keep_last=None, background=True):
+    self.directory = directory
+    self.prefix = prefix
+    self.keep_last = keep_last
+    self.background = background
+    self.pattern = re.compile("^" + re.escape(prefix) + r"(\d+)\.pth$")
+
+    # Shared by forked workers
+    self.last_epoch = mp.Value('i', -1)
+    self.best_epoch = mp.Value('i', -1)
+    self.best_score = mp.Value('d', float("-inf"))
+
+    self.pid = None
+    self.queue = None
+    self.thread = None
+
+  def filename(self, epoch):
+    return os.path.join(self.directory, self.prefix + str(epoch) + ".pth")
+
+  def _start(self):
+    # The writer thread of the parent is not inherited by forked workers
+    self.pid = os.getpid()
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.start()
+
+  # Returns False if this epoch was already saved (by any process)
+  def save(self, epoch, state, score=None):
+    with self.last_epoch.get_lock():
+      if epoch <= self.last_epoch.value:
+        return False
+      self.last_epoch.value = epoch
+    with self.best_score.get_lock():
+      if score is not None and score > self.best_score.value:
+        self.best_score.value = score
+        self.best_epoch.value = epoch
+
+    state = snapshot(state)
+    if not self.background:
+      self._write(epoch, state)
+      return True
+    if self.pid != os.getpid():
+      self._start()
+    self.queue.put((epoch, state))
+    return True
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      self._write(*item)
+
+  def _write(self, epoch, state):
+    filename = self.filename(epoch)
+    tmp_filename = filename + ".tmp." + str(os.getpid())
+    torch.save(state, tmp_filename)
+    os.rename(tmp_filename, filename)
+    if self.keep_last is not None:
+      self._remove_old()
+
+  def saved_epochs(self):
+    epochs = []
+    for name in os.listdir(self.directory):
+      match = self.pattern.match(name)
+      if match:
+        epochs.append(int(match.group(1)))
+    return sorted(epochs)
+
+  def _remove_old(self):
+    epochs = self.saved_epochs()
+    kept = set(epochs[-self.keep_last:]) if self.keep_last > 0 else set()
+    kept.add(self.best_epoch.value)
+    for epoch in epochs:
+      if epoch not in kept:
+        try:
+          os.remove(self.filename(epoch))
+        except OSError:
+          # Already removed by another process
+          pass
+
+  # Write the pending checkpoints of this process
+  def close(self):
+    if self.thread is not None and self.pid == os.getpid():
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+import sys
+
+import numpy as np
+
+import conlleval
+
+
+###############################
+# Chunk-level CoNLL scoring on label index arrays, without writing and
+# re-parsing text files.
+#
+# The chunk start / end rules are those of conlleval.py: they only depend on
+# the previous and current chunk tags and on whether the chunk types differ,
+# so they are tabulated once per label pair, and a whole evaluation set is
+# scored with a few array operations. The counts come back as a
+# conlleval.EvalCounts, so conlleval.metrics() and conlleval.report() apply
+# as usual:
+#
+#   scorer = ChunkScorer(index2label)
+#   for each batch: scorer.add(label, label_pred)  # (batch size, sen len)
+#   overall, by_type = conlleval.metrics(scorer.counts())
+#
+# With boundary=True (default) sentences are separated as by the "-X-" /
+# empty lines of CoNLL files. With boundary=False they are concatenated, as
+# in the result_processed_*.txt files written by ner.evaluate.
+#
+# Check against conlleval.py on such a file:
+#   python3 chunk_eval.py ../result_de/result_processed_test.txt
+###############################
+
+
+class ChunkScorer():
+  def __init__(self, index2label, boundary=True):
+    self.boundary = boundary
+
+    # Index label_size is the sentence boundary, tagged O with no type
+    label_size = max(index2label) + 1
+    self.boundary_index = label_size
+    tag_type = [conlleval.parse_tag(index2label[i]) if i in index2label else ('O', '')
+                for i in range(label_size)]
+    tag_type.append(('O', ''))
+
+    tag_names = sorted(set(tag for tag, _ in tag_type))
+    self.type_names = sorted(set(type_ for _, type_ in tag_type))
+    tag_pairs = sorted(set(tag_type))
+    tag_id = np.array([tag_names.index(tag) for tag, _ in tag_type])
+    self.type_id = np.array([self.type_names.index(type_) for _, type_ in tag_type])
+    # Same (tag, type) <=> correct tag in conlleval
+    self.tag_type_id = np.array([tag_pairs.index(pair) for pair in tag_type])
+
+    # start / end of chunk for (previous tag, tag, types differ)
+    tag_num = len(tag_names)
+    start = np.zeros((tag_num, tag_num, 2), dtype=bool)
+    end = np.zeros((tag_num, tag_num, 2), dtype=bool)
+    for i, prev_tag in enumerate(tag_names):
+      for j, tag in enumerate(tag_names):
+        for type_differs in [0, 1]:
+          type_ = 'b' if type_differs else 'a'
+          start[i, j, type_differs] = conlleval.start_of_chunk(prev_tag, tag, 'a', type_)
+          end[i, j, type_differs] = conlleval.end_of_chunk(prev_tag, tag, 'a', type_)
+
+    # The same per label pair, (label_size + 1, label_size + 1)
+    type_differs = (self.type_id[:, None] != self.type_id[None, :]).astype(int)
+    self.start_table = start[tag_id[:, None], tag_id[None, :], type_differs]
+    self.end_table = end[tag_id[:, None], tag_id[None, :], type_differs]
+
+    self.reset()
+
+  def reset(self):
+    self.correct_seqs = []
+    self.guessed_seqs = []
+
+  # correct, guessed: label indices of a batch, (batch size, sen len)
+  def add(self, correct, guessed):
+    correct = np.asarray(correct, dtype=int)
+    guessed = np.asarray(guessed, dtype=int)
+    assert correct.shape == guessed.shape
+    if self.boundary:
+      # One boundary after every sentence
+      pad = np.full((correct.shape[0], 1), self.boundary_index, dtype=int)
+      correct = np.concatenate([correct, pad], axis=1)
+      guessed = np.concatenate([guessed, pad], axis=1)
+    self.correct_seqs.append(correct.reshape(-1))
+    self.guessed_seqs.append(guessed.reshape(-1))
+
+  def counts(self):
+    counts = conlleval.EvalCounts()
+    if len(self.correct_seqs) == 0:
+      return counts
+
+    # The scan starts as after a boundary (previous tag O, no type)
+    correct = np.concatenate([[self.boundary_index]] + self.correct_seqs)
+    guessed = np.concatenate([[self.boundary_index]] + self.guessed_seqs)
+    prev_correct, correct = correct[:-1], correct[1:]
+    prev_guessed, guessed = guessed[:-1], guessed[1:]
+    n = len(correct)
+
+    start_correct = self.start_table[prev_correct, correct]
+    start_guessed = self.start_table[prev_guessed, guessed]
+    end_correct = self.end_table[prev_correct, correct]
+    end_guessed = self.end_table[prev_guessed, guessed]
+    correct_type = self.type_id[correct]
+    guessed_type = self.type_id[guessed]
+    type_differs = correct_type != guessed_type
+
+    # conlleval's in_correct: a chunk starting in both with the same type is
+    # correct iff at the next position where either chunk ends or the types
+    # differ, both chunks end (or the data ends there), and no other such
+    # chunk started in between
+    chunk_begin = np.flatnonzero(start_correct & start_guessed & ~type_differs)
+    event = np.append(np.flatnonzero(end_correct | end_guessed | type_differs), n)
+    next_event = event[np.searchsorted(event, chunk_begin, side='right')]
+    next_begin = np.append(chunk_begin[1:], n)
+    both_end = np.append(end_correct & end_guessed, True)[next_event]
+    chunk_correct = (next_begin >= next_event) & both_end
+    correct_chunk_type = correct_type[chunk_begin[chunk_correct]]
+
+    type_num = len(self.type_names)
+    t_correct_chunk = np.bincount(correct_chunk_type, minlength=type_num)
+    t_found_correct = np.bincount(correct_type[start_correct], minlength=type_num)
+    t_found_guessed = np.bincount(guessed_type[start_guessed], minlength=type_num)
+
+    is_token = correct != self.boundary_index
+    counts.correct_chunk = int(chunk_correct.sum())
+    counts.found_correct = int(start_correct.sum())
+    counts.found_guessed = int(start_guessed.sum())
+    counts.token_counter = int(is_token.sum())
+    counts.correct_tags = int((is_token & (self.tag_type_id[correct] == self.tag_type_id[guessed])).sum())
+    for i, type_ in enumerate(self.type_names):
+      if t_correct_chunk[i] > 0:
+        counts.t_correct_chunk[type_] = int(t_correct_chunk[i])
+      if t_found_correct[i] > 0:
+        counts.t_found_correct[type_] = int(t_found_correct[i])
+      if t_found_guessed[i] > 0:
+        counts.t_found_guessed[type_] = int(t_found_guessed[i])
+    return counts
+
+
+# Overall chunk F1 (in %, as ner.evaluate's F-score) of ChunkScorer.counts(),
+# or of ner's chunk_counts after an evaluation
+def chunk_fscore(counts):
+  overall, _ = conlleval.metrics(counts)
+  return 100 * overall.fscore
+
+
+if __name__ == "__main__":
+  # Usage: python3 chunk_eval.py <result_processed file>
+  # Scores "word label prediction" lines both ways and prints both reports
+  with open(sys.argv[1]) as f:
+    lines = f.readlines()
+
+  # Empty lines separate sentences, if there are any
+  label2index = {}
+  sentences = [([], [])]
+  for line in lines:
+    features = line.split()
+    if len(features) == 0:
+      sentences.append(([], []))
+      continue
+    for label, seq in zip(features[-2:], sentences[-1]):
+      seq.append(label2index.setdefault(label, len(label2index)))
+  index2label = {index: label for label, index in label2index.items()}
+
+  sentences = [sentence for sentence in sentences if len(sentence[0]) > 0]
+  scorer = ChunkScorer(index2label, boundary=len(sentences) > 1)
+  for correct, guessed in sentences:
+    scorer.add([correct], [guessed])
+  print("chunk_eval.py:")
+  conlleval.report(scorer.counts())
+  print("conlleval.py:")
+  conlleval.report(conlleval.evaluate(lines))
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import numpy as np
+import torch
+
+from state_features import NO_CANDIDATE_MARGIN
+
+
+###############################
+# Confidence gate of ner's "gated" decoding: a batch is decoded greedily,
+# and only its uncertain sentences are decoded again with beam search (or
+# adaptive beams), since most sentences come out the same either way.
+#
+# The uncertainty of a sentence comes from the logP's greedy decoding
+# already computed, at every step:
+#   margin:  the smallest gap between the top-1 and top-2 logP over the
+#            sentence (a close call anywhere may change the best path);
+#   entropy: the entropy of the label distribution, summed over the sentence.
+# A sentence is re-decoded if its margin is below gate_margin or its entropy
+# above gate_entropy (either is skipped when None).
+#
+# Usage, with the other arguments of ner.evaluate:
+#   machine.evaluate(..., "gated", beam_size, ..., gate_fallback="beam",
+#                    gate_margin=1.0)
+# then machine.gate_counts is [re-decoded sentences, sentences];
+# gate_report.py compares it with greedy and always-beam decoding.
+###############################
+
+
+# logP_seq: (seq len * batch size, label size), time step major, as returned
+# by decode_greedy => (margin, entropy) numpy arrays of batch size
+def sentence_uncertainty(logP_seq, batch_size):
+  label_size = logP_seq.size()[1]
+  if label_size > 1:
+    top, _ = torch.topk(logP_seq, 2, dim=1)
+    margin = (top[:, 0] - top[:, 1]).contiguous().view(-1, batch_size).min(0)[0]
+    margin = margin.data.cpu().numpy()
+  else:
+    margin = np.full(batch_size, NO_CANDIDATE_MARGIN)
+
+  entropy = -(logP_seq.exp() * logP_seq).sum(1).view(-1, batch_size).sum(0)
+  return margin, entropy.data.cpu().numpy()
+
+
+# Indices of the sentences to re-decode
+def uncertain_sentences(margin, entropy, gate_margin, gate_entropy):
+  uncertain = np.zeros(len(margin), dtype=bool)
+  if gate_margin is not None:
+    uncertain |= margin < gate_margin
+  if gate_entropy is not None:
+    uncertain |= entropy > gate_entropy
+  return np.nonzero(uncertain)[0]
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import argparse
+import glob
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from decode_cost import COST_FIELDS, read_cost_summary
+
+
+###############################
+# F-score (or CCG accuracy) versus decoding cost over configurations.
+#
+# Every ner.evaluate run with a result_path leaves a
+# cost_summary_<suffix>.txt next to its predictions. Point this script at
+# those files (or at the result directories holding them) to get a table of
+# score and cost per token for each run, with the runs on the Pareto front
+# (no other run is both cheaper and better) marked, and a plot of the same.
+#
+# Usage:
+#   python3 cost_report.py ../result_*/ --suffix test --cost lstm_cell \
+#     --output ../result_cost/test
+###############################
+
+
+def find_summaries(paths, suffix):
+  filenames = []
+  for path in paths:
+    for match in sorted(glob.glob(path)):
+      if os.path.isdir(match):
+        filenames += sorted(glob.glob(os.path.join(match, "cost_summary_" + suffix + ".txt")))
+      else:
+        filenames.append(match)
+  return filenames
+
+
+def run_name(summary, filename):
+  name = os.path.basename(os.path.normpath(summary["path"]))
+  name += ":" + os.path.basename(filename)[len("cost_summary_"):-len(".txt")]
+  name += ":" + summary["decode_method"]
+  if summary["decode_method"] != "greedy":
+    name += "_" + str(int(summary["beam_size"]))
+  if summary["decode_method"] == "adaptive":
+    name += "_max_" + str(int(summary["max_beam_size"]))
+    if summary.get("action_repeat", 1) != 1:
+      name += "_repeat_" + str(int(summary["action_repeat"]))
+  return name
+
+
+# Indices of the runs not dominated by another run (lower or equal cost and
+# higher or equal score, one of them strictly)
+def pareto_front(costs, scores):
+  front = []
+  for i in range(len(costs)):
+    dominated = False
+    for j in range(len(costs)):
+      if costs[j] <= costs[i] and scores[j] >= scores[i] \
+         and (costs[j] < costs[i] or scores[j] > scores[i]):
+        dominated = True
+        break
+    if not dominated:
+      front.append(i)
+  return front
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Score vs. decoding cost report')
+  parser.add_argument('paths', nargs='+',
+                      help='cost_summary_*.txt files or result directories (globs allowed)')
+  parser.add_argument('--suffix', default='test',
+                      help='evaluation suffix to pick in result directories (default: test)')
+  parser.add_argument('--cost', default='lstm_cell', choices=COST_FIELDS,
+                      help='cost on the x axis, per token (default: lstm_cell)')
+  parser.add_argument('--score-name', default='F-score',
+                      help='label of the score axis (default: F-score)')
+  parser.add_argument('--output', default='cost_report',
+                      help='prefix of the .txt table and .pdf plot (default: cost_report)')
+  args = parser.parse_args()
+
+  filenames = find_summaries(args.paths, args.suffix)
+  if len(filenames) == 0:
+    raise Exception("No cost summary found")
+
+  runs = []
+  for filename in filenames:
+    summary = read_cost_summary(filename)
+    summary["name"] = run_name(summary, filename)
+    runs.append(summary)
+
+  # Costs per token, so that runs on different data are comparable
+  for run in runs:
+    for field in COST_FIELDS:
+      run[field + "_per_token"] = run[field] / max(run["tokens"], 1)
+
+  costs = [run[args.cost + "_per_token"] for run in runs]
+  scores = [run["score"] for run in runs]
+  front = pareto_front(costs, scores)
+
+  order = sorted(range(len(runs)), key=lambda i: (costs[i], -scores[i]))
+
+  header = ["name", "score"] + [field + "/token" for field in COST_FIELDS] + ["pareto"]
+  table = "\t".join(header) + "\n"
+  for i in order:
+    run = runs[i]
+    row = [run["name"], "%.4f" % run["score"]]
+    row += ["%.4f" % run[field + "_per_token"] for field in COST_FIELDS[:-1]]
+    row += ["%.6f" % run["time_per_token"], "*" if i in front else ""]
+    table += "\t".join(row) + "\n"
+
+  print(table)
+  with open(args.output + ".txt", "w") as f:
+    f.write(table)
+
+  front = sorted(front, key=lambda i: costs[i])
+
+  plt.figure(1)
+  plt.plot(costs, scores, "bo")
+  plt.plot([costs[i] for i in front], [scores[i] for i in front], "r-")
+  for i in front:
+    plt.annotate(runs[i]["name"].split(":")[-1], (costs[i], scores[i]), fontsize=6)
+  plt.xlabel(args.cost + ' per token')
+  plt.ylabel(args.score_name)
+  plt.savefig(args.output + ".pdf")
+
+
+if __name__ == "__main__":
+  main()
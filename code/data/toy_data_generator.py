@@ -0,0 +1,108 @@
+"""
+Generate synthetic toy corpora in the format of dataset/toy_reverse
+(data.txt: space-separated source tokens, a tab, space-separated target
+tokens, one sentence per line), for scale-testing training and decoding
+without the licensed datasets.
+
+Tasks:
+  reverse: the target is the source reversed, each token mapped to a label
+           as token % label_size (the original toy task when
+           vocab_size == label_size)
+  tagging: one label per token, label_t = (x_t + x_{t-1}) % label_size, so
+           that predicting a label needs the previous token as well
+
+Sentence lengths are drawn from a uniform or a geometric distribution,
+clipped to [min_length, max_length] (at most 500, the longest sentence the
+preprocessing keeps). The same seed always gives the same corpus.
+
+Usage:
+  python3 toy_data_generator.py ../../dataset/toy_long --task tagging \
+    --vocab-size 1000 --label-size 50 --max-length 500 --train-size 100000
+"""
+import argparse
+import os
+
+import numpy as np
+
+MAX_LENGTH = 500
+
+
+def sample_lengths(num, length_dist, min_length, max_length, mean_length, rng):
+  if length_dist == "uniform":
+    lengths = rng.randint(min_length, max_length + 1, size=num)
+  elif length_dist == "geometric":
+    # Mean of min_length + (geometric - 1) is mean_length
+    p = 1.0 / max(mean_length - min_length + 1, 1)
+    lengths = min_length + rng.geometric(p, size=num) - 1
+  else:
+    raise Exception("Unknown length distribution: " + length_dist)
+  return np.clip(lengths, min_length, max_length)
+
+
+def make_target(task, source, label_size):
+  if task == "reverse":
+    return source[::-1] % label_size
+  elif task == "tagging":
+    previous = np.concatenate([[0], source[:-1]])
+    return (source + previous) % label_size
+  else:
+    raise Exception("Unknown task: " + task)
+
+
+def generate_split(filename, num, args, rng):
+  lengths = sample_lengths(num, args.length_dist, args.min_length,
+                           args.max_length, args.mean_length, rng)
+  with open(filename, "w") as f:
+    for length in lengths:
+      source = rng.randint(0, args.vocab_size, size=length)
+      target = make_target(args.task, source, args.label_size)
+      f.write(" ".join(map(str, source)) + "\t" + " ".join(map(str, target)) + "\n")
+
+
+def write_vocab(filename, size, with_index):
+  with open(filename, "w") as f:
+    for i in range(size):
+      f.write(("%d\t%d\n" % (i, i)) if with_index else ("%d\n" % i))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Generate a synthetic toy corpus')
+  parser.add_argument('output_dir', help='gets train/, valid/, test/ (each with data.txt)')
+  parser.add_argument('--task', default='reverse', choices=['reverse', 'tagging'])
+  parser.add_argument('--vocab-size', type=int, default=10)
+  parser.add_argument('--label-size', type=int, default=10)
+  parser.add_argument('--length-dist', default='uniform', choices=['uniform', 'geometric'])
+  parser.add_argument('--min-length', type=int, default=1)
+  parser.add_argument('--max-length', type=int, default=20,
+                      help='at most %d (default: 20)' % MAX_LENGTH)
+  parser.add_argument('--mean-length', type=float, default=30,
+                      help='mean length of the geometric distribution (default: 30)')
+  parser.add_argument('--train-size', type=int, default=10000)
+  parser.add_argument('--valid-size', type=int, default=1000)
+  parser.add_argument('--test-size', type=int, default=1000)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  if args.max_length > MAX_LENGTH:
+    raise Exception("max_length is at most %d" % MAX_LENGTH)
+  if args.min_length < 1 or args.min_length > args.max_length:
+    raise Exception("Need 1 <= min_length <= max_length")
+
+  # One stream per split, so that e.g. changing train_size keeps valid/test
+  for split_index, (split, num) in enumerate([("train", args.train_size),
+                                              ("valid", args.valid_size),
+                                              ("test", args.test_size)]):
+    split_dir = os.path.join(args.output_dir, split)
+    if not os.path.exists(split_dir):
+      os.makedirs(split_dir)
+    rng = np.random.RandomState([args.seed, split_index])
+    generate_split(os.path.join(split_dir, "data.txt"), num, args, rng)
+    write_vocab(os.path.join(split_dir, "vocab.source"), args.vocab_size, False)
+    write_vocab(os.path.join(split_dir, "vocab.target"), args.label_size, False)
+
+  write_vocab(os.path.join(args.output_dir, "vocab.src"), args.vocab_size, True)
+  write_vocab(os.path.join(args.output_dir, "vocab.tgt"), args.label_size, True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+import itertools
+import os
+import struct
+import sys
+
+import numpy as np
+
+
+###############################
+# Binary store of an indexed tagging dataset, replacing the indexed_*.txt
+# CSV files (one line of space-separated indices per sentence).
+#
+# A dataset at <path> is three files:
+#   <path>.words    int32, the word indices of all sentences, concatenated
+#   <path>.labels   int32, the label indices, aligned with .words
+#   <path>.offsets  a 16-byte header (magic, unused), then int64 offsets:
+#                   sentence i is tokens offsets[i]:offsets[i + 1]
+#
+# DatasetWriter appends sentences with bounded memory; IndexedDataset maps
+# the files read-only and builds the same-length minibatches as
+# Preprocessor.minibatch:
+#   X_batch, Y_batch = IndexedDataset(path).minibatch(batch_size)
+###############################
+
+MAGIC = b"ADABDAT1"
+HEADER_FORMAT = "<8s8x"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+TOKEN_DTYPE = np.dtype("<i4")
+OFFSET_DTYPE = np.dtype("<i8")
+
+
+def read_header(path):
+  with open(path + ".offsets", "rb") as f:
+    magic, = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+  if magic != MAGIC:
+    raise Exception("Not an indexed dataset: " + path)
+
+
+class DatasetWriter():
+  # Tokens are buffered and written chunk_size tokens at a time
+  def __init__(self, path, chunk_size=1 << 20):
+    self.path = path
+    self.chunk_size = chunk_size
+
+    self.words_file = open(path + ".words", "wb")
+    self.labels_file = open(path + ".labels", "wb")
+    self.offsets_file = open(path + ".offsets", "wb")
+    self.offsets_file.write(struct.pack(HEADER_FORMAT, MAGIC))
+    np.zeros(1, dtype=OFFSET_DTYPE).tofile(self.offsets_file)
+
+    self.num_sentences = 0
+    self.num_tokens = 0
+    self.pending = []
+    self.num_pending = 0
+
+  def __len__(self):
+    return self.num_sentences
+
+  # words, labels: flat index arrays of several sentences, lengths: their
+  # lengths, in order
+  def write_sentences(self, words, labels, lengths):
+    words = np.asarray(words, dtype=TOKEN_DTYPE)
+    labels = np.asarray(labels, dtype=TOKEN_DTYPE)
+    lengths = np.asarray(lengths, dtype=OFFSET_DTYPE)
+    assert len(words) == len(labels) and len(words) == lengths.sum()
+    self.pending.append((words, labels, lengths))
+    self.num_pending += len(words)
+    if self.num_pending >= self.chunk_size:
+      self.flush()
+
+  def write_sentence(self, words, labels):
+    self.write_sentences(words, labels, [len(words)])
+
+  def flush(self):
+    if len(self.pending) > 0:
+      words = np.concatenate([item[0] for item in self.pending])
+      labels = np.concatenate([item[1] for item in self.pending])
+      lengths = np.concatenate([item[2] for item in self.pending])
+      words.tofile(self.words_file)
+      labels.tofile(self.labels_file)
+      (self.num_tokens + np.cumsum(lengths)).astype(OFFSET_DTYPE).tofile(self.offsets_file)
+      self.num_sentences += len(lengths)
+      self.num_tokens += len(words)
+      self.pending = []
+      self.num_pending = 0
+    for f in [self.words_file, self.labels_file, self.offsets_file]:
+      f.flush()
+
+  def close(self):
+    self.flush()
+    for f in [self.words_file, self.labels_file, self.offsets_file]:
+      f.close()
+
+
+def map_array(filename, dtype, offset=0):
+  num = (os.path.getsize(filename) - offset) // dtype.itemsize
+  if num == 0:
+    return np.zeros(0, dtype=dtype)
+  return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(num,))
+
+
+class IndexedDataset():
+  # Memory-mapped, read-only view of a dataset written by DatasetWriter
+  def __init__(self, path):
+    self.path = path
+    read_header(path)
+    self.offsets = map_array(path + ".offsets", OFFSET_DTYPE, HEADER_SIZE)
+    self.words = map_array(path + ".words", TOKEN_DTYPE)
+    self.labels = map_array(path + ".labels", TOKEN_DTYPE)
+    self.lengths = np.diff(self.offsets)
+
+  def __len__(self):
+    return len(self.lengths)
+
+  # (word indices, label indices) of sentence i
+  def get(self, i):
+    begin, end = self.offsets[i], self.offsets[i + 1]
+    return np.asarray(self.words[begin:end]), np.asarray(self.labels[begin:end])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.get(i)
+
+  # Minibatches of sentences of the same length as lists of lists, in the
+  # order of Preprocessor.minibatch (by length, then by position)
+  def minibatch(self, batch_size):
+    X_batch = []
+    Y_batch = []
+    order = np.argsort(self.lengths, kind="mergesort")
+    for _, group in itertools.groupby(order, key=lambda i: self.lengths[i]):
+      group = list(group)
+      for begin in range(0, len(group), batch_size):
+        sentences = [self.get(i) for i in group[begin:begin + batch_size]]
+        X_batch.append([words.tolist() for words, _ in sentences])
+        Y_batch.append([labels.tolist() for _, labels in sentences])
+    return X_batch, Y_batch
+
+  # Write the legacy indexed text format, one sentence per line
+  def to_text(self, words_path, labels_path):
+    with open(words_path, "w") as words_file, open(labels_path, "w") as labels_file:
+      for words, labels in self:
+        words_file.write(" ".join(map(str, words.tolist())) + "\n")
+        labels_file.write(" ".join(map(str, labels.tolist())) + "\n")
+
+
+if __name__ == "__main__":
+  # Usage: python3 dataset_store.py <dataset> <words output> <labels output>
+  IndexedDataset(sys.argv[1]).to_text(sys.argv[2], sys.argv[3])
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import os
+
+
+###############################
+# Decoding cost of a batch (a single sentence for adaptive decoding), counted
+# by the ner decoders:
+#   lstm_cell:   decoder LSTMCell invocations (one per beam per time step)
+#   topk:        top-k / max selections, including the ones in make_state
+#   candidates:  (beam, label) pairs scored, i.e. label_size per LSTMCell call
+#   agent_calls: queries to the beam agent (adaptive only)
+#   time:        wall time of encoding plus decoding the batch, in seconds
+#
+# ner.evaluate writes one row per batch, with its sentence length and batch
+# size, into cost_<suffix>.txt and a
+# summary of the run into cost_summary_<suffix>.txt, which cost_report.py
+# aggregates over configurations.
+###############################
+
+COST_FIELDS = ["lstm_cell", "topk", "candidates", "agent_calls", "time"]
+
+
+class DecodeCost():
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.lstm_cell = 0
+    self.topk = 0
+    self.candidates = 0
+    self.agent_calls = 0
+    self.time = 0
+
+  def as_list(self):
+    return [getattr(self, field) for field in COST_FIELDS]
+
+
+# Per-batch rows: sentence length and batch size followed by COST_FIELDS
+def write_sentence_costs(filename, sen_lens, batch_sizes, sentence_costs):
+  with open(filename, "w") as f:
+    f.write("# sen_len\tbatch_size\t" + "\t".join(COST_FIELDS) + "\n")
+    for sen_len, batch_size, cost in zip(sen_lens, batch_sizes, sentence_costs):
+      f.write("%d\t%d\t%d\t%d\t%d\t%d\t%f\n" % tuple([sen_len, batch_size] + cost))
+
+
+# One "key\tvalue" per line: the configuration (a list of (key, value)),
+# the score and the totals, over all the sentences of the batches
+def write_cost_summary(filename, config, score, sen_lens, batch_sizes, sentence_costs):
+  summary = list(config)
+  summary.append(("score", float(score)))
+  summary.append(("sentences", sum(batch_sizes)))
+  summary.append(("tokens", sum(sen_len * batch_size for sen_len, batch_size in zip(sen_lens, batch_sizes))))
+  for i, field in enumerate(COST_FIELDS):
+    summary.append((field, sum(cost[i] for cost in sentence_costs)))
+
+  with open(filename, "w") as f:
+    for key, value in summary:
+      f.write("%s\t%s\n" % (key, value))
+
+
+def read_cost_summary(filename):
+  summary = {"path": os.path.dirname(filename)}
+  with open(filename) as f:
+    for line in f:
+      key, value = line.rstrip("\n").split("\t", 1)
+      try:
+        value = float(value)
+      except ValueError:
+        pass
+      summary[key] = value
+  return summary
@@ -11,9 +11,13 @@ import numpy as np
 import time
 import os
 
+from state_features import ACCUM_MARGIN_KEPT, ACCUM_MARGIN_PRUNED, \
+  LOGP_MARGIN_KEPT, LOGP_MARGIN_PRUNED, BEAM_SIZE
+
 
 class det_agent():
-  def __init__(self, max_beam_size, accum_logP_ratio_low, logP_ratio_low):
+  def __init__(self, max_beam_size, accum_logP_ratio_low, logP_ratio_low,
+               state_type="topk"):
     self.DECREASE = 0
     self.SAME = 1
     self.INCREASE = 2
@@ -21,12 +25,16 @@ class det_agent():
     self.max_beam_size = max_beam_size
     self.accum_logP_ratio_low = accum_logP_ratio_low
     self.logP_ratio_low = logP_ratio_low
+    self.state_type = state_type
 
 
   # state is expected to be:
   # [max_beam_size of accumulated logP's (sorted from high to low),
   #  max_beam_size of (non-accumulated) logP's (sorted from high to low),
   #  current (incoming) beam size]
+  # or, with state_type="compact", the summary of
+  # state_features.make_compact_state, which carries the same gaps to the
+  # best beam directly (as margins, i.e. with the opposite sign).
   # May later be appended with (part of the following):
   # [input sequence length,
   #  current time step in the decoding process,
@@ -38,6 +46,9 @@ class det_agent():
   # 2: increase the beam size by 1 (would be no effect in environment if the current beam size is already max_beam_size; the agent can in principle output this action---especially later when it is trained by RL---but it simply won't cause the beam size to really increase by 1 in the environment.)
   # 0: decrease the beam size by 1 (similar to stated above: would be no effect if the current beam size is already 1.)
   def get_action(self, state):
+    if self.state_type == "compact":
+      return self.get_action_compact(state)
+
     accum_logP = state[0:self.max_beam_size]
     logP = state[self.max_beam_size:2 * self.max_beam_size]
     beam_size_in = int(state[2 * self.max_beam_size])
@@ -67,3 +78,22 @@ class det_agent():
 
     # Otherwise, keep the same beam size
     return self.SAME
+
+
+  # Same decision as get_action, from the margins of the compact state
+  def get_action_compact(self, state):
+    beam_size_in = int(state[BEAM_SIZE])
+
+    if beam_size_in > 1:
+      if -state[ACCUM_MARGIN_KEPT] <= np.log(self.accum_logP_ratio_low):
+        return self.DECREASE
+      if -state[LOGP_MARGIN_KEPT] <= np.log(self.logP_ratio_low):
+        return self.DECREASE
+
+    if beam_size_in < self.max_beam_size:
+      if -state[ACCUM_MARGIN_PRUNED] > np.log(self.accum_logP_ratio_low):
+        return self.INCREASE
+      if -state[LOGP_MARGIN_PRUNED] > np.log(self.logP_ratio_low):
+        return self.INCREASE
+
+    return self.SAME
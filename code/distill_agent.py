@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from episode_store import EpisodeStore
+from model import AdaptiveActorCritic, PolicyAgent
+from ner import ner
+from rule_agent import rule_agent, rule_features, fit_tree
+from train_rl_de import get_index2word, get_index2label, minibatch_of_one_de
+
+
+###############################
+# Distill a trained AdaptiveActorCritic into a small decision tree over the
+# quantities det_agent looks at (see rule_agent.py), so that serving does not
+# need the neural policy.
+#
+# 1. Decode val with the policy, logging the states it visits.
+# 2. Label every visited state with the policy's (greedy) action and fit the
+#    tree on the states of 80% of the sentences.
+# 3. Report the agreement with the policy on the held-out sentences, and the
+#    F-score / total beam / decoding time of both agents on val.
+###############################
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Distill a beam policy into rules')
+  parser.add_argument('policy', help='checkpoint of the AdaptiveActorCritic')
+  parser.add_argument('--load-model-dir', default='../result_lrn_0p001_atten/',
+                      help='directory of the ner checkpoint')
+  parser.add_argument('--epoch', type=int, default=46,
+                      help='epoch of the ner checkpoint (default: 46)')
+  parser.add_argument('--beam-size', type=int, default=3,
+                      help='initial beam size (default: 3)')
+  parser.add_argument('--max-depth', type=int, default=3,
+                      help='depth of the decision tree (default: 3)')
+  parser.add_argument('--min-samples-leaf', type=int, default=20,
+                      help='minimum number of states per leaf (default: 20)')
+  parser.add_argument('--state-type', default='topk',
+                      choices=['topk', 'compact'],
+                      help='state the policy was trained on (default: topk)')
+  parser.add_argument('--output', default='rule_agent.json',
+                      help='where to save the rules (default: rule_agent.json)')
+  args = parser.parse_args()
+
+  dict_file = "../dataset/German/vocab1.de"
+  entity_file = "../dataset/German/vocab1.en"
+  index2word = get_index2word(dict_file)
+  index2label = get_index2label(entity_file)
+  vocab_size = len(index2word)
+  label_size = len(index2label)
+
+  val_X, val_Y = minibatch_of_one_de('valid')
+
+  hidden_dim = 64
+  label_embedding_dim = 8
+  word_embedding_dim = 64
+  pretrained = 'de64'
+  attention = "fixed"
+
+  load_model_filename = os.path.join(args.load_model_dir, "ckpt_" + str(args.epoch) + ".pth")
+  machine = ner(word_embedding_dim, hidden_dim, label_embedding_dim, vocab_size, label_size, minibatch_size=1, val_X=val_X, val_Y=val_Y, attention=attention, gpu=False, pretrained=pretrained, load_model_filename=load_model_filename, load_map_location="cpu")
+
+  machine.state_type = args.state_type
+
+  max_beam_size = label_size
+
+  model = AdaptiveActorCritic(max_beam_size=max_beam_size, action_space=3,
+                              state_type=args.state_type)
+  model.load_state_dict(torch.load(args.policy, map_location="cpu")["state_dict"])
+  model.eval()
+  policy = PolicyAgent(model)
+
+  # For German dataset, f_score_index_begin = 5 (because O_INDEX = 4)
+  f_score_index_begin = 5
+  reward_coef_fscore = 1
+  reward_coef_beam_size = 0.1
+
+  # 1. Decode with the policy, logging the visited states.
+  # Episode generation adds a backtracking per step, so time a plain pass.
+  time_begin = time.time()
+  policy_fscore, policy_beam_number, policy_avg_beam_size = machine.evaluate(val_X, val_Y, index2word, index2label, "val", None, "adaptive", args.beam_size, max_beam_size, policy, reward_coef_fscore, reward_coef_beam_size, f_score_index_begin, generate_episode=False)
+  policy_time = time.time() - time_begin
+
+  episode_path = os.path.splitext(args.output)[0] + "_episode_val.bin"
+  machine.evaluate(val_X, val_Y, index2word, index2label, "val", None, "adaptive", args.beam_size, max_beam_size, policy, reward_coef_fscore, reward_coef_beam_size, f_score_index_begin, generate_episode=True, episode_save_path=episode_path)
+
+  # 2. Label states with the policy and fit the rules
+  store = EpisodeStore(episode_path)
+  states = np.asarray(store.records["state"])
+  sentence_ids = np.asarray(store.records["sentence_id"])
+  actions = np.concatenate([policy.get_actions(states[begin:begin + 4096])
+                            for begin in range(0, len(states), 4096)])
+  features = rule_features(states, max_beam_size, args.state_type)
+
+  rng = np.random.RandomState(1)
+  unique_ids = np.unique(sentence_ids)
+  held_out_ids = rng.choice(unique_ids, size=max(1, len(unique_ids) // 5), replace=False)
+  held_out = np.in1d(sentence_ids, held_out_ids)
+
+  tree = fit_tree(features[~held_out], actions[~held_out], max_depth=args.max_depth, min_samples_leaf=args.min_samples_leaf)
+  agent = rule_agent(max_beam_size, tree, args.state_type)
+  agent.save(args.output)
+
+  rule_actions = np.array([agent.get_action(state) for state in states[held_out]])
+  agreement = (rule_actions == actions[held_out]).mean() if held_out.any() else 0
+
+  # 3. Decode with the rules
+  time_begin = time.time()
+  rule_fscore, rule_beam_number, rule_avg_beam_size = machine.evaluate(val_X, val_Y, index2word, index2label, "val", None, "adaptive", args.beam_size, max_beam_size, agent, reward_coef_fscore, reward_coef_beam_size, f_score_index_begin, generate_episode=False)
+  rule_time = time.time() - time_begin
+
+  report = agent.describe()
+  report += "held-out agreement with policy = %.4f (%d states)\n" % (agreement, held_out.sum())
+  report += "policy: val F = %.6f, total beam = %d, avg beam = %.4f, time = %.2f\n" % (policy_fscore, policy_beam_number, policy_avg_beam_size, policy_time)
+  report += "rules:  val F = %.6f, total beam = %d, avg beam = %.4f, time = %.2f\n" % (rule_fscore, rule_beam_number, rule_avg_beam_size, rule_time)
+  report += "delta:  val F = %+.6f, total beam = %+d, avg beam = %+.4f\n" % (rule_fscore - policy_fscore, rule_beam_number - policy_beam_number, rule_avg_beam_size - policy_avg_beam_size)
+  print(report)
+  with open(os.path.splitext(args.output)[0] + "_report.txt", "w") as f:
+    f.write(report)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+###############################
+# Data-parallel training of ner on one host, over a gloo process group
+# (CPU only, no GPU needed).
+#
+#   launch(num_procs, target, args, kwargs)
+# forks num_procs processes, joins them into a process group and runs
+# target(*args, **kwargs) in each; the model built before launch is inherited by all.
+# ner.train(..., distributed=True) then, in every process:
+#   - broadcasts rank 0's weights, so all ranks start from the same model;
+#   - each epoch, shards the batches with shard_batches: batches of similar
+#     length are grouped world_size at a time, the groups shuffled with a
+#     seed shared by all ranks, and rank r takes the r-th batch of each
+#     group, so the ranks of one step decode sentences of about the same
+#     length and none waits long for the others;
+#   - after each backward, averages the gradients of all ranks, weighted by
+#     their batch sizes (all_reduce_gradients), so every rank takes the same
+#     optimizer step;
+#   - sums the epoch loss over ranks; rank 0 alone evaluates, logs, saves
+#     checkpoints and decides on early stopping.
+#
+# The model has no forward() (train calls encode / decode_train), so it is
+# not wrapped in DistributedDataParallel; the gradients are all-reduced the
+# same way, one flattened bucket per step.
+#
+# A step of N ranks is a step over N batches: the loss follows that of a
+# single process run with N times the batch size.
+###############################
+
+
+def launch(num_procs, target, args=(), kwargs=None, num_threads=1, master_port=29500):
+  processes = []
+  for rank in range(num_procs):
+    p = mp.Process(target=run_process,
+                   args=(rank, num_procs, target, args, kwargs or {}, num_threads, master_port))
+    p.start()
+    processes.append(p)
+  for p in processes:
+    p.join()
+  for p in processes:
+    if p.exitcode != 0:
+      raise Exception("Distributed training process exited with code %d" % p.exitcode)
+
+
+def run_process(rank, world_size, target, args, kwargs, num_threads, master_port):
+  torch.set_num_threads(num_threads)
+  os.environ["MASTER_ADDR"] = "127.0.0.1"
+  os.environ["MASTER_PORT"] = str(master_port)
+  dist.init_process_group("gloo", rank=rank, world_size=world_size)
+  try:
+    target(*args, **kwargs)
+  finally:
+    dist.destroy_process_group()
+
+
+def broadcast_parameters(module):
+  for tensor in module.state_dict().values():
+    dist.broadcast(tensor, 0)
+
+
+# A random seed drawn by rank 0, the same on all ranks
+def broadcast_seed():
+  seed = torch.LongTensor([np.random.randint(2 ** 31)])
+  dist.broadcast(seed, 0)
+  return int(seed[0])
+
+
+def broadcast_flag(flag):
+  flag = torch.LongTensor([int(flag)])
+  dist.broadcast(flag, 0)
+  return bool(flag[0])
+
+
+def all_reduce_sum(value):
+  value = torch.DoubleTensor([float(np.sum(value))])
+  dist.all_reduce(value)
+  return float(value[0])
+
+
+# Replace the gradients of module by the average over all ranks, weighted
+# by weight (the batch size of this rank, 0 for a padding step)
+def all_reduce_gradients(module, weight):
+  params = [p for p in module.parameters() if p.requires_grad]
+  # Sparse gradients (ner's sparse_embedding) are reduced densely
+  grads = [(p.grad.data.to_dense() if p.grad.data.is_sparse else p.grad.data).view(-1)
+           if p.grad is not None else p.data.new(p.numel()).zero_()
+           for p in params]
+  bucket = torch.cat(grads + [grads[0].new([1])]) * weight
+  dist.all_reduce(bucket)
+  total_weight = float(bucket[-1])
+  offset = 0
+  for p in params:
+    numel = p.numel()
+    grad = bucket[offset:offset + numel].view_as(p.data) / total_weight
+    if p.grad is None or p.grad.data.is_sparse:
+      p.grad = torch.autograd.Variable(grad)
+    else:
+      p.grad.data.copy_(grad)
+    offset += numel
+
+
+def shard_batches(batches, rank, world_size, shuffle, rng):
+  # Returns this rank's batch indices for the epoch and whether each one
+  # counts: the last group is padded with uncounted repeats, as all ranks
+  # must take the same number of steps
+  order = sorted(range(len(batches)), key=lambda i: len(batches[i][0]))
+  groups = [order[begin:begin + world_size] for begin in range(0, len(order), world_size)]
+  if shuffle:
+    groups = [groups[i] for i in rng.permutation(len(groups))]
+
+  batch_idx_list = []
+  counted_list = []
+  for group in groups:
+    counted = rank < len(group)
+    batch_idx_list.append(group[rank] if counted else group[rank % len(group)])
+    counted_list.append(counted)
+  return batch_idx_list, counted_list
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import os
+import struct
+import sys
+
+import numpy as np
+
+
+###############################
+# Append-only binary store of RL experience, replacing the tab-separated
+# episode dumps ("%d" action followed by "\t%f" per state element).
+#
+# File layout: a 16-byte header (magic, state_dim), followed by fixed-width
+# records, one per state visited by the agent:
+#   sentence_id (int32): index of the sentence (batch) in the evaluated data
+#   action      (int32): action taken in this state, -1 for a terminal state
+#   reward      (float32): reward received for that action
+#   next_index  (int64): record index of the next state, -1 if terminal
+#   state       (float32 * state_dim): the state vector from make_state
+#
+# An episode of n experience tuples (s_{t-1}, a_{t-1}, r_{t-1}, s_t) from
+# decode_beam_adaptive is stored as n + 1 records: each tuple's next state is
+# the following record, and the last next state is a terminal record.
+###############################
+
+MAGIC = b"ADABEPS1"
+HEADER_FORMAT = "<8sI4x"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def record_dtype(state_dim):
+  return np.dtype([("sentence_id", "<i4"),
+                   ("action", "<i4"),
+                   ("reward", "<f4"),
+                   ("next_index", "<i8"),
+                   ("state", "<f4", (state_dim,))])
+
+
+def read_header(path):
+  with open(path, "rb") as f:
+    magic, state_dim = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+  if magic != MAGIC:
+    raise Exception("Not an episode store: " + path)
+  return state_dim
+
+
+class EpisodeWriter():
+  # Records are buffered in a preallocated array and written chunk_size
+  # records at a time. With append=True, new episodes are appended to an
+  # existing store at path; otherwise the file is overwritten.
+  def __init__(self, path, state_dim, chunk_size=4096, append=False):
+    self.path = path
+    self.state_dim = state_dim
+    self.dtype = record_dtype(state_dim)
+    self.chunk_size = chunk_size
+
+    if append and os.path.exists(path) and os.path.getsize(path) > 0:
+      if read_header(path) != state_dim:
+        raise Exception("State dim mismatch when appending to " + path)
+      self.f = open(path, "ab")
+      self.num_written = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+    else:
+      self.f = open(path, "wb")
+      self.f.write(struct.pack(HEADER_FORMAT, MAGIC, state_dim))
+      self.num_written = 0
+
+    self.buffer = np.zeros(chunk_size, dtype=self.dtype)
+    self.num_buffered = 0
+
+  def __len__(self):
+    return self.num_written + self.num_buffered
+
+  def _append(self, sentence_id, action, reward, next_index, state):
+    if self.num_buffered == self.chunk_size:
+      self.flush()
+    record = self.buffer[self.num_buffered]
+    record["sentence_id"] = sentence_id
+    record["action"] = action
+    record["reward"] = reward
+    record["next_index"] = next_index
+    record["state"] = state
+    self.num_buffered += 1
+
+  # episode is the list of experience tuples (s, a, r, s') of one sentence
+  def write_episode(self, sentence_id, episode):
+    if len(episode) == 0:
+      return
+    for experience_tuple in episode:
+      state, action, reward, _ = experience_tuple
+      self._append(sentence_id, action, reward, len(self) + 1, state)
+    # Terminal record holding the last next state
+    self._append(sentence_id, -1, 0, -1, episode[-1][3])
+
+  # Append all the records of an EpisodeStore (e.g. one shard of a parallel
+  # evaluation), with their sentence ids shifted by sentence_id_offset
+  def write_store(self, store, sentence_id_offset=0):
+    if store.state_dim != self.state_dim:
+      raise Exception("State dim mismatch when appending " + store.path + " to " + self.path)
+    self.flush()
+    record_offset = self.num_written
+    for begin in range(0, len(store.records), self.chunk_size):
+      records = np.array(store.records[begin:begin + self.chunk_size])
+      records["sentence_id"] += sentence_id_offset
+      records["next_index"][records["next_index"] >= 0] += record_offset
+      records.tofile(self.f)
+      self.num_written += len(records)
+    self.f.flush()
+
+  def flush(self):
+    if self.num_buffered > 0:
+      self.buffer[:self.num_buffered].tofile(self.f)
+      self.num_written += self.num_buffered
+      self.num_buffered = 0
+    self.f.flush()
+
+  def close(self):
+    self.flush()
+    self.f.close()
+
+
+class EpisodeStore():
+  # Memory-mapped, read-only view of an episode store
+  def __init__(self, path):
+    self.path = path
+    self.state_dim = read_header(path)
+    self.dtype = record_dtype(self.state_dim)
+    num_records = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+    if num_records > 0:
+      self.records = np.memmap(path, dtype=self.dtype, mode="r",
+                               offset=HEADER_SIZE, shape=(num_records,))
+    else:
+      self.records = np.zeros(0, dtype=self.dtype)
+
+    # Indices of the records that are actual transitions (not terminal)
+    self.transition_index = np.nonzero(self.records["action"] >= 0)[0]
+
+  def __len__(self):
+    return len(self.transition_index)
+
+  # Returns (state, action, reward, next_state, done, sentence_id) arrays for
+  # the given transition numbers (0 <= index < len(self))
+  def get(self, index):
+    record_index = self.transition_index[index]
+    records = self.records[record_index]
+    next_index = records["next_index"]
+    next_states = self.records["state"][next_index]
+    done = self.records["action"][next_index] < 0
+    return (np.asarray(records["state"]), np.asarray(records["action"]),
+            np.asarray(records["reward"]), np.asarray(next_states), done,
+            np.asarray(records["sentence_id"]))
+
+  def sample(self, batch_size, rng=np.random):
+    return self.get(rng.randint(0, len(self), size=batch_size))
+
+  # Yields minibatches of transitions, in storage order or shuffled. With
+  # num_shards > 1, only those of shard number shard, a disjoint 1 /
+  # num_shards of the transitions (the workers of one epoch pass the same
+  # rng seed), so that no worker reads the others' records
+  def iterate(self, batch_size, shuffle=False, rng=np.random, shard=0, num_shards=1):
+    order = np.arange(len(self))
+    if shuffle:
+      order = rng.permutation(order)
+    order = order[shard::num_shards]
+    for begin in range(0, len(order), batch_size):
+      index = order[begin:begin + batch_size]
+      if shuffle:
+        # Sorted reads are much friendlier to the page cache
+        index = np.sort(index)
+      yield self.get(index)
+
+  # Write the legacy text format ("%d" action then "\t%f" per state element)
+  def to_text(self, text_path):
+    with open(text_path, "w") as f:
+      for record_index in self.transition_index:
+        record = self.records[record_index]
+        f.write("%d" % record["action"])
+        for state_element in record["state"]:
+          f.write("\t%f" % state_element)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+  # Usage: python3 episode_store.py <episode store> <legacy text output>
+  EpisodeStore(sys.argv[1]).to_text(sys.argv[2])
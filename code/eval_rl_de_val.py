@@ -2,6 +2,7 @@
 
 import argparse
 import os
+import time
 from operator import itemgetter
 
 import matplotlib
@@ -10,9 +11,10 @@ import pandas as pd
 import torch
 import torch.multiprocessing as mp
 
-from model import AdaptiveActorCritic
+from model import AdaptiveActorCritic, PolicyAgent
 from ner import ner
 from optim import SharedAdam
+from parallel_eval import parallel_evaluate
 from rl_trainer import train_adaptive, eval_adaptive
 
 matplotlib.use("Agg")
@@ -221,6 +223,9 @@ def main():
                       help='name of the process')
   parser.add_argument('--no-shared', default=False,
                       help='use an optimizer without shared momentum.')
+  parser.add_argument('--eval-workers', type=int, default=1,
+                      help='CPU processes sharing the evaluation, through '
+                           'ner.evaluate (see parallel_eval.py; default: 1)')
   args = parser.parse_args()
 
   if not os.path.exists(args.logdir):
@@ -246,15 +251,26 @@ def main():
     checkpoint = torch.load(load_model_filename, map_location=load_map_location)
     model.load_state_dict(checkpoint["state_dict"])
 
-    fscore, total_beam_number_in_dataset, avg_beam_size, time_used = \
-      eval_adaptive(machine,
-                    max_beam_size,
-                    model,
-                    val_X, val_Y, index2word, index2label,
-                    "val", False, "adaptive", initial_beam_size,
-                    reward_coef_fscore, reward_coef_beam_size,
-                    f_score_index_begin,
-                    args)
+    if args.eval_workers > 1:
+      # The policy's most probable actions, as eval_adaptive
+      time_begin = time.time()
+      fscore, total_beam_number_in_dataset, avg_beam_size = \
+        parallel_evaluate(machine, val_X, val_Y, index2word, index2label,
+                          "val", None, "adaptive", initial_beam_size, max_beam_size,
+                          PolicyAgent(model), reward_coef_fscore, reward_coef_beam_size,
+                          f_score_index_begin, generate_episode=False,
+                          num_workers=args.eval_workers)
+      time_used = time.time() - time_begin
+    else:
+      fscore, total_beam_number_in_dataset, avg_beam_size, time_used = \
+        eval_adaptive(machine,
+                      max_beam_size,
+                      model,
+                      val_X, val_Y, index2word, index2label,
+                      "val", False, "adaptive", initial_beam_size,
+                      reward_coef_fscore, reward_coef_beam_size,
+                      f_score_index_begin,
+                      args)
 
     log_msg = "%d\t%f\t%d\t%f\t%f" % (epoch, fscore, total_beam_number_in_dataset, avg_beam_size, time_used)
     print(log_msg)
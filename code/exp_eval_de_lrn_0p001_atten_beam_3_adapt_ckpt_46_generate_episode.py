@@ -155,8 +155,8 @@ def main():
 
   ##################
 
-  experience_file_train = os.path.join(result_path, "beam_3_adapt_ckpt_46_episode_train.txt")
-  experience_file_val = os.path.join(result_path, "beam_3_adapt_ckpt_46_episode_val.txt")
+  experience_file_train = os.path.join(result_path, "beam_3_adapt_ckpt_46_episode_train.bin")
+  experience_file_val = os.path.join(result_path, "beam_3_adapt_ckpt_46_episode_val.bin")
 
   epoch = 46
   load_model_filename = os.path.join(result_path, "ckpt_" + str(epoch) + ".pth")
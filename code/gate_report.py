@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+
+import torch
+
+from det_agent import det_agent
+from ner import ner
+from train_de import get_index2word, get_index2label, minibatch_de
+
+
+###############################
+# Confidence-gated decoding (see confidence_gate.py) against greedy and
+# always-beam decoding, for a German NER checkpoint on CPU.
+#
+# For every split, evaluates greedy, beam (--beam-size) and "gated" decoding
+# with the same fallback beam size for each --gate-margins threshold (and
+# --gate-entropy, if given), and prints the F-score, wall time, fraction of
+# sentences re-decoded, and the F-score and time relative to always-beam.
+#
+# Usage:
+#   python3 gate_report.py ../result_lrn_0p001/ckpt_51.pth \
+#     --beam-size 5 --gate-margins 0.5,1,2,4
+###############################
+
+
+def float_list(text):
+  return [float(x) for x in text.split(",")]
+
+
+def timed_evaluate(machine, X, Y, split, decode_method, beam_size, max_beam_size, agent, gate_fallback, gate_margin, gate_entropy, f_score_index_begin):
+  time_begin = time.time()
+  fscore, _, _ = machine.evaluate(X, Y, None, None, split, None, decode_method, beam_size, max_beam_size, agent, 1, 0.1, f_score_index_begin, generate_episode=False, episode_save_path=None, gate_fallback=gate_fallback, gate_margin=gate_margin, gate_entropy=gate_entropy)
+  redecode_rate = machine.gate_counts[0] / max(machine.gate_counts[1], 1)
+  return fscore, time.time() - time_begin, redecode_rate
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare confidence-gated decoding with greedy and beam')
+  parser.add_argument('checkpoint', help='ckpt_<epoch>.pth written by ner.train')
+  parser.add_argument('--splits', default='valid,test',
+                      help='comma-separated German splits (default: valid,test)')
+  parser.add_argument('--beam-size', type=int, default=5,
+                      help='beam size of always-beam and of the fallback (default: 5)')
+  parser.add_argument('--gate-fallback', choices=['beam', 'adaptive'], default='beam',
+                      help='decoder of the uncertain sentences (default: beam)')
+  parser.add_argument('--gate-margins', type=float_list, default=[0.5, 1, 2, 4],
+                      help='comma-separated top-1/top-2 logP margin thresholds (default: 0.5,1,2,4)')
+  parser.add_argument('--gate-entropy', type=float, default=None,
+                      help='summed entropy threshold (default: none)')
+  parser.add_argument('--max-beam-size', type=int, default=None,
+                      help='for the adaptive fallback (default: label size)')
+  parser.add_argument('--accum-logP-ratio-low', type=float, default=0.1)
+  parser.add_argument('--logP-ratio-low', type=float, default=0.1)
+  parser.add_argument('--batch-size', type=int, default=32,
+                      help='sentences per batch (default: 32)')
+  parser.add_argument('--word-embedding-dim', type=int, default=64)
+  parser.add_argument('--hidden-dim', type=int, default=64)
+  parser.add_argument('--label-embedding-dim', type=int, default=8)
+  parser.add_argument('--attention', default='none',
+                      help='attention type of the checkpoint, or "none" (default: none)')
+  parser.add_argument('--f-score-index-begin', type=int, default=5)
+  parser.add_argument('--threads', type=int, default=1,
+                      help='torch threads (default: 1)')
+  args = parser.parse_args()
+
+  if args.attention == "none":
+    args.attention = None
+  torch.set_num_threads(args.threads)
+
+  index2word = get_index2word("../dataset/German/vocab1.de")
+  index2label = get_index2label("../dataset/German/vocab1.en")
+  label_size = len(index2label)
+
+  machine = ner(args.word_embedding_dim, args.hidden_dim, args.label_embedding_dim, len(index2word), label_size, minibatch_size=args.batch_size, attention=args.attention, gpu=False, pretrained=None, load_model_filename=args.checkpoint, load_map_location="cpu")
+
+  max_beam_size = args.max_beam_size or label_size
+  agent = det_agent(max_beam_size, args.accum_logP_ratio_low, args.logP_ratio_low)
+
+  configs = [("greedy", None), ("beam", None)]
+  configs += [("gated", gate_margin) for gate_margin in args.gate_margins]
+
+  print("split\tdecoder\tgate_margin\tF\ttime_s\tredecode_rate\tF_vs_beam\ttime_vs_beam")
+  for split in args.splits.split(","):
+    X, Y = minibatch_de(split, args.batch_size)
+
+    results = []
+    for decode_method, gate_margin in configs:
+      results.append(timed_evaluate(machine, X, Y, split, decode_method, args.beam_size, max_beam_size, agent, args.gate_fallback, gate_margin, args.gate_entropy, args.f_score_index_begin))
+
+    beam_fscore, beam_time, _ = results[1]
+    for (decode_method, gate_margin), (fscore, elapsed, redecode_rate) in zip(configs, results):
+      if decode_method == "greedy":
+        redecode_rate = 0
+      elif decode_method == "beam":
+        redecode_rate = 1
+      print("%s\t%s\t%s\t%.6f\t%.3f\t%.4f\t%+.6f\t%.3f" % (split, decode_method, "-" if gate_margin is None else "%g" % gate_margin, fscore, elapsed, redecode_rate, fscore - beam_fscore, elapsed / max(beam_time, 1e-9)), flush=True)
+
+
+if __name__ == "__main__":
+  main()
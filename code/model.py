@@ -4,6 +4,8 @@ import torch.nn as nn
 
 from torch.autograd import Variable
 
+from state_features import get_state_dim
+
 
 def normalized_columns_initializer(weights, std=1.0):
   out = torch.randn(weights.size())
@@ -30,19 +32,22 @@ def weights_init(m):
 
 
 class AdaptiveActorCritic(torch.nn.Module):
-  def __init__(self, max_beam_size, action_space):
+  def __init__(self, max_beam_size, action_space, state_type="topk"):
     """ Format of a state (a vector): 
           1. accum_logP = state[0:self.max_beam_size]
           2. logP = state[self.max_beam_size:2 * self.max_beam_size]
           3. beam_size_in = int(state[2 * self.max_beam_size])
+        or, with state_type="compact", the fixed-size summary of
+        state_features.make_compact_state.
       Args
         max_beam_size
         action_space: number of possible actions, default is 3 
+        state_type: "topk" or "compact", as in ner.make_state
     """
     super(AdaptiveActorCritic, self).__init__()
 
     # FC layers
-    hidden_size = max_beam_size * 2 + 1
+    hidden_size = get_state_dim(state_type, max_beam_size)
     self.critic_linear = nn.Linear(hidden_size, 1)
     self.actor_linear = nn.Linear(hidden_size, action_space)
 
@@ -52,6 +57,29 @@ class AdaptiveActorCritic(torch.nn.Module):
     return self.critic_linear(state), self.actor_linear(state)
 
 
+class PolicyAgent():
+  """ Wraps a trained AdaptiveActorCritic in the det_agent interface
+      (get_action(state) and the DECREASE/SAME/INCREASE constants),
+      so that it can be passed as the agent of ner.evaluate.
+      The action is the most probable one, as in rl_trainer.eval_adaptive.
+  """
+  def __init__(self, model):
+    self.DECREASE = 0
+    self.SAME = 1
+    self.INCREASE = 2
+
+    self.model = model
+
+  def get_action(self, state):
+    _, logit = self.model(state)
+    return int(logit.view(1, -1).max(1)[1].data.numpy().reshape(-1)[0])
+
+  # Most probable actions for a (number of states, state dim) matrix
+  def get_actions(self, states):
+    _, logit = self.model(states)
+    return logit.max(1)[1].data.numpy().reshape(-1)
+
+
 if __name__ == "__main__":
   state = np.random.rand(21)
   print(state.shape)
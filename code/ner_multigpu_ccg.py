@@ -9,9 +9,20 @@ import torch.optim as optim
 
 import numpy as np
 import time
-import itertools
 
+from adaptive_softmax import AdaptiveSoftmax, label_counts
 from attention import Attention
+from background_eval import BackgroundEvaluator
+from checkpoint_manager import CheckpointManager
+from confidence_gate import sentence_uncertainty, uncertain_sentences
+from decode_cost import DecodeCost, write_sentence_costs, write_cost_summary
+from distributed import broadcast_parameters, broadcast_seed, broadcast_flag, all_reduce_sum, all_reduce_gradients, shard_batches
+from episode_store import EpisodeWriter
+from optim import LazyAdam
+from prediction_store import PredictionWriter
+from profiler import profiled, span
+from state_features import make_compact_state, get_score_gap
+from tag_dictionary import PRUNED_LOGP
 from preprocessor import *
 
 import os
@@ -29,7 +40,10 @@ class ner(nn.Module):
                attention="fixed",
                gpu=False, gpu_no=0,
                pretrained=None,
-               load_model_filename=None, load_map_location=None):
+               load_model_filename=None, load_map_location=None,
+               state_type="topk", action_repeat=1, repeat_gap_threshold=None,
+               sparse_embedding=False,
+               output_layer="softmax", adaptive_cutoffs=(100, 400)):
 
     super(ner, self).__init__()
     self.word_embedding_dim = word_embedding_dim
@@ -48,6 +62,22 @@ class ner(nn.Module):
     self.test_Y = test_Y
     self.load_model_filename = load_model_filename
 
+    # State representation for the RL agent, see state_features.py
+    self.state_type = state_type
+    # Hold the agent's beam size for action_repeat time steps (or until the
+    # score gap moves by more than repeat_gap_threshold), see query_agent
+    self.action_repeat = action_repeat
+    self.repeat_gap_threshold = repeat_gap_threshold
+
+    # Counted by the decoders, per batch in evaluate (see decode_cost.py)
+    self.decode_cost = DecodeCost()
+
+    # Optional TagDictionary restricting evaluate's decoding to the tags of
+    # each word, and the shortlist of the batch being decoded (see
+    # tag_dictionary.py and output_logP)
+    self.tag_dictionary = None
+    self.shortlist = None
+
     # For now we hard code the index of "<BEG>"
     self.BEG_INDEX = 1
 
@@ -63,8 +93,13 @@ class ner(nn.Module):
     else:
       self.attention = None
 
+    # With sparse_embedding, a batch's gradient of the word embedding only
+    # holds the rows of its words, and train updates them lazily (see
+    # optim.LazyAdam). The parameters, and so the checkpoints, are the same.
+    self.sparse_embedding = sparse_embedding
     self.word_embedding = nn.Embedding(self.vocab_size,
-                                       self.word_embedding_dim)
+                                       self.word_embedding_dim,
+                                       sparse=sparse_embedding)
     if pretrained:  # not None
       print("Using pretrained word embedding: ", pretrained)
       word_embedding_np = np.loadtxt('../dataset/WordEmbed/' + pretrained + '_embed.txt', dtype=float)    # load pretrained model: word2vec/glove
@@ -92,8 +127,21 @@ class ner(nn.Module):
     self.decoder_cell = nn.LSTMCell(self.label_embedding_dim,
                                     self.hidden_dim)
 
-    # Transform from hidden state to scores of all possible labels
-    self.hidden2score = nn.Linear(self.hidden_dim, self.label_size)
+    # Transform from hidden state to scores of all possible labels, or with
+    # output_layer "adaptive", to their log probabilities through an adaptive
+    # softmax whose clusters are cut at adaptive_cutoffs in the frequency
+    # ranking of the labels in train_Y (see adaptive_softmax.py)
+    self.output_layer = output_layer
+    if output_layer == "softmax":
+      self.hidden2score = nn.Linear(self.hidden_dim, self.label_size)
+      self.adaptive_softmax = None
+    elif output_layer == "adaptive":
+      self.hidden2score = None
+      self.adaptive_softmax = AdaptiveSoftmax(
+        self.hidden_dim, self.label_size, adaptive_cutoffs,
+        label_counts(train_Y, self.label_size) if train_Y is not None else None)
+    else:
+      raise Exception("Unknown output layer: " + output_layer)
 
     # From score to log probability
     self.score2logP = nn.LogSoftmax(dim=1)
@@ -102,6 +150,7 @@ class ner(nn.Module):
       self.checkpoint = torch.load(self.load_model_filename, map_location=load_map_location)
       self.load_state_dict(self.checkpoint["state_dict"])
 
+  @profiled("encode")
   def encode(self, sentence, init_enc_hidden, init_enc_cell):
     # sentence shape is (batch_size, sentence_length)
     sentence_emb = self.word_embedding(sentence)
@@ -189,11 +238,12 @@ class ner(nn.Module):
     # End if self.attention
 
     dec_hidden_seq.append(dec_hidden_out)
-    score = self.hidden2score(dec_hidden_out) \
-      .view(current_batch_size, self.label_size)
-    score_seq.append(score)
-    logP = self.score2logP(score).view(current_batch_size, self.label_size)
-    logP_seq.append(logP)
+    if self.adaptive_softmax is None:
+      score = self.hidden2score(dec_hidden_out) \
+        .view(current_batch_size, self.label_size)
+      score_seq.append(score)
+      logP = self.score2logP(score).view(current_batch_size, self.label_size)
+      logP_seq.append(logP)
 
     # The rest parts of the sentence
     for i in range(label_seq_len - 1):
@@ -215,11 +265,12 @@ class ner(nn.Module):
       # End if self.attention
 
       dec_hidden_seq.append(dec_hidden_out)
-      score = self.hidden2score(dec_hidden_out) \
-        .view(current_batch_size, self.label_size)
-      score_seq.append(score)
-      logP = self.score2logP(score).view(current_batch_size, self.label_size)
-      logP_seq.append(logP)
+      if self.adaptive_softmax is None:
+        score = self.hidden2score(dec_hidden_out) \
+          .view(current_batch_size, self.label_size)
+        score_seq.append(score)
+        logP = self.score2logP(score).view(current_batch_size, self.label_size)
+        logP_seq.append(logP)
 
     # It could make sense to reshape decoder hidden output
     # But currently we don't use this output in later stage
@@ -237,25 +288,55 @@ class ner(nn.Module):
     # It happens that directly concatenate along dim = 0 gives you
     # a convenient shape (batch_size * seq_len, label_size)
     # for later cross entropy loss
-    score_seq = torch.cat(score_seq, dim=0)
-    logP_seq = torch.cat(logP_seq, dim=0)
+    #
+    # With the adaptive softmax, there are no full scores: score_seq and
+    # logP_seq are None, and train computes the loss from dec_hidden_seq
+    if self.adaptive_softmax is None:
+      score_seq = torch.cat(score_seq, dim=0)
+      logP_seq = torch.cat(logP_seq, dim=0)
+    else:
+      score_seq = None
+      logP_seq = None
 
     #return dec_hidden_seq, score_seq, attention_seq
     return dec_hidden_seq, score_seq, logP_seq, attention_seq
 
 
-  def train(self, shuffle, result_path, do_evaluation, beam_size, data="ner"):
+  # With do_evaluation, stops after patience epochs without improvement on
+  # validation (if not None) and evaluates the test set only on improvement.
+  # Checkpoints are written in the background (see checkpoint_manager.py);
+  # with keep_last, only the best epoch's and the last keep_last are kept.
+  # With background_eval_configs (a list of (decode_method, beam_size)),
+  # every epoch's weights are also evaluated by a separate process (see
+  # background_eval.py) while training goes on.
+  def train(self, shuffle, result_path, do_evaluation, beam_size, data="ner", patience=None, keep_last=None, f_score_index_begin=5, background_eval_configs=None, distributed=False):
     # Will manually average over (sentence_len * instance_num)
     #loss_function = nn.CrossEntropyLoss(size_average=False)
 
     # We now use logSoftmax -> NLLLoss
     loss_function = nn.NLLLoss(size_average=False)
+    if self.adaptive_softmax is not None and data == "ner":
+      raise Exception("The O penalty of data ner needs output_layer softmax")
 
     # Note that here we called nn.Module.parameters()
-    optimizer = optim.Adam(self.parameters(), lr=self.learning_rate)
+    if self.sparse_embedding:
+      optimizer = LazyAdam(self.parameters(), lr=self.learning_rate)
+    else:
+      optimizer = optim.Adam(self.parameters(), lr=self.learning_rate)
     if self.load_model_filename:
       optimizer.load_state_dict(self.checkpoint["optimizer"])
 
+    # Data parallel over the process group set up by distributed.launch:
+    # every rank (process) trains on its shard of the batches with the
+    # averaged gradients, rank 0 alone evaluates, logs and saves checkpoints
+    if distributed:
+      rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+      broadcast_parameters(self)
+      shuffle_seed = broadcast_seed()
+    else:
+      rank, world_size = 0, 1
+    is_main = rank == 0
+
     # self.train_X = [batch_1, batch_2, ...]
     # batch_i = [ [idx_1, idx_2, ...], ...]
     # Note that we don't require all batches have the same size
@@ -267,154 +348,227 @@ class ner(nn.Module):
 
     train_loss_list = []
 
-    output_file = open(os.path.join(result_path, "log.txt"), "w+")
-
-    initial_epoch = (self.checkpoint["epoch"] + 1) if self.load_model_filename else 0
-
-    for epoch in range(initial_epoch, initial_epoch + self.max_epoch):
-      time_begin = time.time()
-      loss_sum = 0
-
-      batch_idx_list = range(batch_num)
-      if shuffle:
-        batch_idx_list = np.random.permutation(batch_idx_list)
-
-      for batch_idx in batch_idx_list:
-        sen = self.train_X[batch_idx]
-        label = self.train_Y[batch_idx]
-
-        #print("label=",label)
-
-        current_batch_size = len(sen)
-        current_sen_len = len(sen[0])
-
-        # Always clear the gradients before use
-        self.zero_grad()
-
-        sen_var = Variable(torch.LongTensor(sen))
-        label_var = Variable(torch.LongTensor(label))
-
-        if self.gpu:
-          sen_var = sen_var.cuda(self.cuda_dev)
-          label_var = label_var.cuda(self.cuda_dev)
-
-        # Initialize the hidden and cell states
-        # The axes semantics are
-        # (num_layers * num_directions, batch_size, hidden_size)
-        # So 1 for single-directional LSTM encoder,
-        # 2 for bi-directional LSTM encoder.
-        init_enc_hidden = Variable(
-          torch.zeros(2, current_batch_size, self.hidden_dim))
-        init_enc_cell = Variable(
-          torch.zeros(2, current_batch_size, self.hidden_dim))
-
-        if self.gpu:
-          init_enc_hidden = init_enc_hidden.cuda(self.cuda_dev)
-          init_enc_cell = init_enc_cell.cuda(self.cuda_dev)
-
-        enc_hidden_seq, (enc_hidden_out, enc_cell_out) = \
-          self.encode(sen_var, init_enc_hidden, init_enc_cell)
-
-        # The semantics of enc_hidden_out is (num_layers * num_directions,
-        # batch, hidden_size), and it is "tensor containing the hidden state
-        # for t = seq_len".
-        #
-        # Here we use a linear layer to transform the two-directions of the dec_hidden_out's into a single hidden_dim vector, to use as the input of the decoder
-        init_dec_hidden = self.enc2dec_hidden(torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
-        init_dec_cell = self.enc2dec_cell(torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
-
-        #init_dec_hidden = enc_hidden_out[0]
-        #init_dec_cell = enc_cell_out[0]
-
-        # Attention added
-        #dec_hidden_seq, score_seq, attention_seq = \
-        dec_hidden_seq, score_seq, logP_seq, attention_seq = \
-          self.decode_train(label_var, init_dec_hidden,
-                            init_dec_cell, enc_hidden_seq)
-
-        label_var_for_loss = label_var.permute(1, 0) \
-          .contiguous().view(-1)
-
-        if data == "ner":
-          O_INDEX = 4
-          gold_not_O_mask = (label_var_for_loss > O_INDEX).float()
-          PENALTY = 1.5
-          gold_not_O_mask = gold_not_O_mask * PENALTY
-          score_seq[:, O_INDEX] = score_seq[:, O_INDEX] + gold_not_O_mask
-        elif data == "ccg":
-          pass
-        else:
-          print("Warning: ner.train(): Check special penalty for this dataset")
+    output_file = None
+    background_evaluator = None
+    checkpoint_manager = None
+    if is_main:
+      # Opened for appending, as the background evaluator appends to it too
+      log_filename = os.path.join(result_path, "log.txt")
+      open(log_filename, "w").close()
+      output_file = open(log_filename, "a")
 
-        logP_seq = self.score2logP(score_seq)
+      if background_eval_configs:
+        background_evaluator = BackgroundEvaluator(self, background_eval_configs, log_filename, f_score_index_begin)
 
-        # Input: (N,C) where C = number of classes
-        # Target: (N) where each value is 0 <= targets[i] <= C−1
-        #loss = loss_function(score_seq, label_var_for_loss)
+      checkpoint_manager = CheckpointManager(result_path, keep_last=keep_last)
 
-        # We now use logSoftmax -> NLLLoss
-        loss = loss_function(logP_seq, label_var_for_loss) \
-               / (current_sen_len * current_batch_size)
+    initial_epoch = (self.checkpoint["epoch"] + 1) if self.load_model_filename else 0
 
-        if self.gpu:
-          loss_value = loss.cpu()
+    decode_method = "greedy" if beam_size in [None, 1] else "beam"
+    best_epoch = None
+    best_val_fscore = None
+    best_test_fscore = None
+    epochs_without_improvement = 0
+
+    # The checkpoint writer thread and the background evaluator are stopped
+    # in any case, or a failed run would never exit
+    try:
+      for epoch in range(initial_epoch, initial_epoch + self.max_epoch):
+        time_begin = time.time()
+        loss_sum = 0
+
+        if distributed:
+          # Batches of similar length on all ranks at each step; a padding
+          # step at the end is not counted (see distributed.shard_batches)
+          batch_idx_list, counted_list = shard_batches(self.train_X, rank, world_size, shuffle, np.random.RandomState(shuffle_seed + epoch))
         else:
-          loss_value = loss
-        #print(loss_value.data.numpy())
-        loss_sum += loss_value.data.numpy() * current_batch_size
-
-        loss.backward()
-        optimizer.step()
-      # End for batch_idx
-
-      avg_loss = loss_sum / instance_num
-      train_loss_list.append(avg_loss)
-
-      time_end = time.time()
-
-      if do_evaluation:
-        # Do evaluation on training set using model at this point
-        # using decode_greedy or decode_beam
-        #train_loss, train_fscore = self.evaluate(self.train_X, self.train_Y, None, None, "train", None, beam_size)
-        # Do evaluation on validation set as well
-        val_loss, val_fscore = self.evaluate(self.val_X, self.val_Y, None, None, "val", None, beam_size)
-        test_loss, test_fscore = self.evaluate(self.test_X, self.test_Y, None, None, "test", None, beam_size)
-
-        print("epoch", epoch,
-              ", accumulated loss during training = %.6f\n" % avg_loss,
-              #"\n training loss = %.6f" % train_loss,
-              "validation loss = %.6f" % val_loss,
-              ", test loss = %.6f\n" % test_loss,
-              #"\n training F score = %.6f" % train_fscore,
-              "validation F score = %.6f" % val_fscore,
-              ", test F score = %.6f" % test_fscore,
-              "\n time = %.6f" % (time_end - time_begin))
-
-        #output_file.write("%d\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\n" % (epoch, avg_loss, train_loss, val_loss, test_loss, train_fscore, val_fscore, test_fscore, time_end - time_begin))
-        output_file.write("%d\t%f\t%f\t%f\t%f\t%f\t%f\n" % (epoch, avg_loss, val_loss, test_loss, val_fscore, test_fscore, time_end - time_begin))
-        output_file.flush()
-      else:
-        print("epoch", epoch,
-              ", accumulated loss during training = %.6f" % avg_loss,
-              "\n time = %.6f" % (time_end - time_begin))
-
-        output_file.write("%d\t%f\t%f\n" % (epoch, avg_loss, time_end - time_begin))
-        output_file.flush()
-      # End if do_evaluation
-
-      # Save model
-      # In our current way of doing experiment, we don't keep is_best
-      is_best = False
-      checkpoint_filename = os.path.join(result_path, "ckpt_" + str(epoch) + ".pth")
-      self.save_checkpoint({'epoch': epoch,
-                       'state_dict': self.state_dict(),
-                       'optimizer' : optimizer.state_dict()},
-                      checkpoint_filename,
-                      is_best)
-
-    # End for epoch
-
-    output_file.close()
+          batch_idx_list = range(batch_num)
+          if shuffle:
+            batch_idx_list = np.random.permutation(batch_idx_list)
+          counted_list = [True] * batch_num
+
+        for batch_idx, counted in zip(batch_idx_list, counted_list):
+          sen = self.train_X[batch_idx]
+          label = self.train_Y[batch_idx]
+
+          #print("label=",label)
+
+          current_batch_size = len(sen)
+          current_sen_len = len(sen[0])
+
+          # Always clear the gradients before use
+          self.zero_grad()
+
+          sen_var = Variable(torch.LongTensor(sen))
+          label_var = Variable(torch.LongTensor(label))
+
+          if self.gpu:
+            sen_var = sen_var.cuda(self.cuda_dev)
+            label_var = label_var.cuda(self.cuda_dev)
+
+          # Initialize the hidden and cell states
+          # The axes semantics are
+          # (num_layers * num_directions, batch_size, hidden_size)
+          # So 1 for single-directional LSTM encoder,
+          # 2 for bi-directional LSTM encoder.
+          init_enc_hidden = Variable(
+            torch.zeros(2, current_batch_size, self.hidden_dim))
+          init_enc_cell = Variable(
+            torch.zeros(2, current_batch_size, self.hidden_dim))
+
+          if self.gpu:
+            init_enc_hidden = init_enc_hidden.cuda(self.cuda_dev)
+            init_enc_cell = init_enc_cell.cuda(self.cuda_dev)
+
+          enc_hidden_seq, (enc_hidden_out, enc_cell_out) = \
+            self.encode(sen_var, init_enc_hidden, init_enc_cell)
+
+          # The semantics of enc_hidden_out is (num_layers * num_directions,
+          # batch, hidden_size), and it is "tensor containing the hidden state
+          # for t = seq_len".
+          #
+          # Here we use a linear layer to transform the two-directions of the dec_hidden_out's into a single hidden_dim vector, to use as the input of the decoder
+          init_dec_hidden = self.enc2dec_hidden(torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
+          init_dec_cell = self.enc2dec_cell(torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
+
+          #init_dec_hidden = enc_hidden_out[0]
+          #init_dec_cell = enc_cell_out[0]
+
+          # Attention added
+          #dec_hidden_seq, score_seq, attention_seq = \
+          dec_hidden_seq, score_seq, logP_seq, attention_seq = \
+            self.decode_train(label_var, init_dec_hidden,
+                              init_dec_cell, enc_hidden_seq)
+
+          label_var_for_loss = label_var.permute(1, 0) \
+            .contiguous().view(-1)
+
+          if self.adaptive_softmax is not None:
+            # Only the tail clusters of this batch's labels are computed
+            loss = self.adaptive_softmax.nll(dec_hidden_seq.view(-1, self.hidden_dim), label_var_for_loss) \
+                   / (current_sen_len * current_batch_size)
+          else:
+            if data == "ner":
+              O_INDEX = 4
+              gold_not_O_mask = (label_var_for_loss > O_INDEX).float()
+              PENALTY = 1.5
+              gold_not_O_mask = gold_not_O_mask * PENALTY
+              score_seq[:, O_INDEX] = score_seq[:, O_INDEX] + gold_not_O_mask
+            elif data == "ccg":
+              pass
+            else:
+              print("Warning: ner.train(): Check special penalty for this dataset")
+
+            logP_seq = self.score2logP(score_seq)
+
+            # Input: (N,C) where C = number of classes
+            # Target: (N) where each value is 0 <= targets[i] <= C−1
+            #loss = loss_function(score_seq, label_var_for_loss)
+
+            # We now use logSoftmax -> NLLLoss
+            loss = loss_function(logP_seq, label_var_for_loss) \
+                   / (current_sen_len * current_batch_size)
+
+          if self.gpu:
+            loss_value = loss.cpu()
+          else:
+            loss_value = loss
+          #print(loss_value.data.numpy())
+          if counted:
+            loss_sum += loss_value.data.numpy() * current_batch_size
+
+          with span("backward"):
+            loss.backward()
+          if distributed:
+            with span("all_reduce"):
+              all_reduce_gradients(self, current_batch_size if counted else 0)
+          with span("optimizer_step"):
+            optimizer.step()
+        # End for batch_idx
+
+        if distributed:
+          loss_sum = all_reduce_sum(loss_sum)
+        avg_loss = loss_sum / instance_num
+        train_loss_list.append(avg_loss)
+
+        time_end = time.time()
+
+        stop = False
+        if is_main:
+          if background_evaluator is not None:
+            background_evaluator.publish(epoch)
+
+          if do_evaluation:
+            # Validation every epoch, test only when validation improves.
+            # (CCG copies return accuracy in place of the F score.)
+            val_fscore, _, _ = self.evaluate(self.val_X, self.val_Y, None, None, "val", None, decode_method, beam_size, beam_size, None, 0, 0, f_score_index_begin, generate_episode=False)
+
+            improved = best_epoch is None or val_fscore > best_val_fscore
+            if improved:
+              best_val_fscore = val_fscore
+              best_epoch = epoch
+              epochs_without_improvement = 0
+              test_fscore, _, _ = self.evaluate(self.test_X, self.test_Y, None, None, "test", None, decode_method, beam_size, beam_size, None, 0, 0, f_score_index_begin, generate_episode=False)
+              best_test_fscore = test_fscore
+            else:
+              epochs_without_improvement += 1
+              test_fscore = float("nan")
+
+            print("epoch", epoch,
+                  ", accumulated loss during training = %.6f\n" % avg_loss,
+                  "validation F score = %.6f" % val_fscore,
+                  (", test F score = %.6f" % test_fscore) if improved else ", test not evaluated",
+                  "\n best epoch = %d" % best_epoch,
+                  ", epochs without improvement = %d" % epochs_without_improvement,
+                  "\n time = %.6f" % (time_end - time_begin))
+
+            # test F score is nan when the test set was not evaluated
+            output_file.write("%d\t%f\t%f\t%f\t%f\t%d\n" % (epoch, avg_loss, val_fscore, test_fscore, time_end - time_begin, best_epoch))
+            output_file.flush()
+          else:
+            print("epoch", epoch,
+                  ", accumulated loss during training = %.6f" % avg_loss,
+                  "\n time = %.6f" % (time_end - time_begin))
+
+            output_file.write("%d\t%f\t%f\n" % (epoch, avg_loss, time_end - time_begin))
+            output_file.flush()
+          # End if do_evaluation
+
+          # Save model, the best one by validation F score
+          checkpoint_manager.save(epoch,
+                                  {'epoch': epoch,
+                                   'state_dict': self.state_dict(),
+                                   'optimizer' : optimizer.state_dict()},
+                                  val_fscore if do_evaluation else None)
+
+          if patience is not None and do_evaluation and epochs_without_improvement >= patience:
+            print("No improvement on validation for %d epochs, stopping" % patience)
+            stop = True
+
+        if distributed:
+          stop = broadcast_flag(stop)
+        if stop:
+          break
+
+      # End for epoch
+    except BaseException:
+      # No need to wait for the evaluation of the last snapshot
+      if background_evaluator is not None:
+        background_evaluator.close(wait=False)
+      raise
+    finally:
+      if checkpoint_manager is not None:
+        checkpoint_manager.close()
+
+    if is_main:
+      if background_evaluator is not None:
+        background_evaluator.close()
+
+      if do_evaluation and best_epoch is not None:
+        print("best epoch = %d, validation F score = %.6f, test F score = %.6f" % (best_epoch, best_val_fscore, best_test_fscore))
+        output_file.write("# best epoch\t%d\t%f\t%f\n" % (best_epoch, best_val_fscore, best_test_fscore))
+
+      output_file.close()
 
     return train_loss_list
 
@@ -425,6 +579,34 @@ class ner(nn.Module):
       torch.save(state, "best.pth")
 
 
+  # Log-probabilities of the labels at time step t, shape (batch size,
+  # |V^y|), from the decoder output dec_hidden_out. With a shortlist (set by
+  # evaluate from self.tag_dictionary), only the shortlisted rows of
+  # hidden2score are computed and normalized; the other labels get
+  # PRUNED_LOGP. With the adaptive softmax, the shortlisted labels are
+  # renormalized from its full log-probabilities
+  def output_logP(self, dec_hidden_out, t):
+    dec_hidden_out = dec_hidden_out.view(-1, self.hidden_dim)
+    if self.shortlist is None:
+      if self.adaptive_softmax is not None:
+        return self.adaptive_softmax.log_prob(dec_hidden_out)
+      return self.score2logP(self.hidden2score(dec_hidden_out)).view(-1, self.label_size)
+
+    candidates, mask = self.shortlist[t]
+    if self.adaptive_softmax is not None:
+      score = self.adaptive_softmax.log_prob(dec_hidden_out).index_select(1, candidates)
+    else:
+      weight = self.hidden2score.weight.index_select(0, candidates)
+      bias = self.hidden2score.bias.index_select(0, candidates)
+      # score.shape => (batch size, number of candidates)
+      score = torch.mm(dec_hidden_out, weight.t()) + bias
+    if mask is not None:
+      score = score + mask
+    logP_candidates = self.score2logP(score)
+
+    logP = logP_candidates.new(dec_hidden_out.size(0), self.label_size).fill_(PRUNED_LOGP)
+    return logP.index_copy(1, candidates, logP_candidates)
+
   def decode_greedy(self, batch_size, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq):
     # Current version is as parallel to beam as possible
     # for debugging purpose.
@@ -473,12 +655,9 @@ class ner(nn.Module):
       attention = attention.view(batch_size, seq_len)
     # End if self.attention
 
-    # score_out.shape => (batch size, |V^y|)
+    # logP.shape => (batch size, |V^y|)
     ##score_out = self.hidden2score(dec_hidden_out) + init_score
-    score_out = self.hidden2score(dec_hidden_out) \
-      .view(batch_size, self.label_size)
-
-    logP = self.score2logP(score_out).view(batch_size, self.label_size)
+    logP = self.output_logP(dec_hidden_out, 0)
     logP_seq.append(logP)
 
     # index.shape => (batch size, 1)
@@ -494,7 +673,7 @@ class ner(nn.Module):
     #
     ##score, index = torch.max(score_out, 1, keepdim = True)
 
-    _, index = torch.max(score_out, 1, keepdim = True)
+    _, index = torch.max(logP, 1, keepdim = True)
     # index.shape = (batch size, 1)
     label_pred_seq = index
 
@@ -525,10 +704,7 @@ class ner(nn.Module):
 
       # For greedy, no need to add (previous) score
       ##score_out = self.hidden2score(dec_hidden_out) + score
-      score_out = self.hidden2score(dec_hidden_out) \
-        .view(batch_size, self.label_size)
-
-      logP = self.score2logP(score_out).view(batch_size, self.label_size)
+      logP = self.output_logP(dec_hidden_out, t)
       logP_seq.append(logP)
 
       _, index = torch.max(logP, 1, keepdim = True)
@@ -555,6 +731,10 @@ class ner(nn.Module):
     logP_seq = torch.cat(logP_seq, dim=0)
     logP_pred_seq = logP_seq
 
+    self.decode_cost.lstm_cell += seq_len * batch_size
+    self.decode_cost.topk += seq_len
+    self.decode_cost.candidates += seq_len * batch_size * self.label_size
+
     return label_pred_seq, logP_pred_seq, attention_pred_seq
 
 
@@ -627,10 +807,8 @@ class ner(nn.Module):
       # the shape (batch size, 1, input seq len)
       attention_beam = attention_beam.permute(1, 0, 2)
 
-    # score_out.shape => (batch size, |V^y|)
-    score_out = self.hidden2score(dec_hidden_out) \
-      .view(batch_size, self.label_size)
-    logP_out = self.score2logP(score_out).view(batch_size, self.label_size)
+    # logP_out.shape => (batch size, |V^y|)
+    logP_out = self.output_logP(dec_hidden_out, 0)
 
     # Initial step, accumulated logP is the same as logP
     accum_logP_out = logP_out
@@ -654,7 +832,8 @@ class ner(nn.Module):
     # each row is [y^{t, b=0}, y^{t, b=1}, ..., y^{t, b=B-1}]
     # y_beam, score_beam => same
 
-    accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size, dim=1)
+    with span("topk"):
+      accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size, dim=1)
 
     beta_beam = torch.floor(index_beam.float() / self.label_size).long()
     y_beam = torch.remainder(index_beam, self.label_size)
@@ -722,8 +901,7 @@ class ner(nn.Module):
         if self.attention:
           attention_list.append(attention)
 
-        score_out = self.hidden2score(dec_hidden_out)
-        logP_out = self.score2logP(score_out).view(batch_size, self.label_size)
+        logP_out = self.output_logP(dec_hidden_out, t)
 
         accum_logP = accum_logP_beam[:, b].contiguous().view(batch_size, 1)
 
@@ -759,8 +937,9 @@ class ner(nn.Module):
       logP_matrix = torch.cat(logP_out_list, dim=1)
       accum_logP_matrix = torch.cat(accum_logP_out_list, dim=1)
 
-      accum_logP_beam, index_beam = \
-        torch.topk(accum_logP_matrix, beam_size, dim=1)
+      with span("topk"):
+        accum_logP_beam, index_beam = \
+          torch.topk(accum_logP_matrix, beam_size, dim=1)
 
       beta_beam = torch.floor(
         index_beam.float() / self.label_size).long()
@@ -823,23 +1002,71 @@ class ner(nn.Module):
     logP_pred_seq = logP_pred_seq.view(batch_size * seq_len, self.label_size)
     accum_logP_pred_seq = accum_logP_pred_seq.view(batch_size * seq_len, self.label_size)
 
+    # One LSTMCell call at t = 0, then beam_size calls per time step
+    self.decode_cost.lstm_cell += (1 + (seq_len - 1) * beam_size) * batch_size
+    self.decode_cost.topk += seq_len
+    self.decode_cost.candidates += (1 + (seq_len - 1) * beam_size) * batch_size * self.label_size
+
     return label_pred_seq, accum_logP_pred_seq, logP_pred_seq, attention_pred_seq
 
 
   # For German dataset, f_score_index_begin = 5 (because O_INDEX = 4)
   # For toy dataset, f_score_index_begin = 4 (because {0: '<s>', 1: '<e>', 2: '<p>', 3: '<u>', ...})
-  def evaluate(self, eval_data_X, eval_data_Y, index2word, index2label, suffix, result_path, decode_method, beam_size, max_beam_size, agent, reward_coef_fscore, reward_coef_beam_size, f_score_index_begin, generate_episode=True, episode_save_path=None):
+  # Greedy decoding of the batch, then the uncertain sentences (see
+  # confidence_gate.py) decoded again by fallback: "beam" (decode_beam of
+  # them as one batch) or "adaptive" (decode_beam_adaptive of each, without
+  # episodes). Returns the merged label_pred_seq (batch size, seq len), the
+  # indices of the re-decoded sentences and the average beam size of the
+  # batch at each step after the first
+  def decode_gated(self, sen, batch_size, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, fallback, gate_margin, gate_entropy, beam_size, max_beam_size, agent, label_var, f_score_index_begin):
+    label_pred_seq, logP_pred_seq, _ = self.decode_greedy(batch_size, seq_len, init_dec_hidden, init_dec_cell, enc_hidden_seq)
+
+    margin, entropy = sentence_uncertainty(logP_pred_seq, batch_size)
+    redecoded = uncertain_sentences(margin, entropy, gate_margin, gate_entropy)
+    # Summed over the sentences of the batch
+    beam_widths = np.ones(seq_len - 1) * (batch_size - len(redecoded))
+    if len(redecoded) == 0:
+      return label_pred_seq, redecoded, list(beam_widths / batch_size)
+
+    rows = Variable(torch.from_numpy(redecoded.astype(np.int64)))
+    if self.gpu:
+      rows = rows.cuda(self.cuda_dev)
+
+    # The shortlist of a tag dictionary is per batch
+    batch_shortlist = self.shortlist
+    if fallback == "beam":
+      if self.tag_dictionary is not None:
+        self.shortlist = self.tag_dictionary.shortlist([sen[i] for i in redecoded], self.gpu, self.cuda_dev)
+      fallback_pred_seq = self.decode_beam(len(redecoded), seq_len, init_dec_hidden.index_select(0, rows), init_dec_cell.index_select(0, rows), enc_hidden_seq.index_select(1, rows), beam_size)[0]
+      beam_widths += beam_size * len(redecoded)
+    elif fallback == "adaptive":
+      fallback_pred_seq = []
+      for i in redecoded:
+        i = int(i)
+        if self.tag_dictionary is not None:
+          self.shortlist = self.tag_dictionary.shortlist([sen[i]], self.gpu, self.cuda_dev)
+        pred_seq, _, _, _, _, beam_size_seq = self.decode_beam_adaptive(seq_len, init_dec_hidden[i:i + 1], init_dec_cell[i:i + 1], enc_hidden_seq[:, i:i + 1], beam_size, max_beam_size, agent, 0, 0, label_var[i:i + 1], f_score_index_begin, generate_episode=False)
+        fallback_pred_seq.append(pred_seq)
+        beam_widths += np.mean(beam_size_seq) if len(beam_size_seq) else beam_size
+      fallback_pred_seq = torch.cat(fallback_pred_seq, dim=0)
+    else:
+      raise Exception("Unknown fallback decoder: " + fallback)
+    self.shortlist = batch_shortlist
+
+    label_pred_seq = label_pred_seq.index_copy(0, rows, fallback_pred_seq)
+    return label_pred_seq, redecoded, list(beam_widths / batch_size)
+
+  def evaluate(self, eval_data_X, eval_data_Y, index2word, index2label, suffix, result_path, decode_method, beam_size, max_beam_size, agent, reward_coef_fscore, reward_coef_beam_size, f_score_index_begin, generate_episode=True, episode_save_path=None, result_mode="text", background_writer=False, gate_fallback="beam", gate_margin=1.0, gate_entropy=None):
     batch_num = len(eval_data_X)
 
     if result_path:
-      f_sen = open(result_path + "sen_" + suffix + ".txt", 'w')
-      f_pred = open(result_path + "pred_" + suffix + ".txt", 'w')
-      f_label = open(result_path + "label_" + suffix + ".txt", 'w')
-      f_result_processed = open(result_path + "result_processed_" + suffix + ".txt", 'w')
-      f_beam_size = open(result_path + 'beam_size_' + suffix + ".txt", 'w')
+      # Buffered, text or npz (see prediction_store.py)
+      prediction_writer = PredictionWriter(result_path, suffix, index2word, index2label, mode=result_mode, background=background_writer)
 
     if generate_episode:
-      episode_file = open(episode_save_path, "w+")
+      # The state dim is only known from the first state, so the episode
+      # store is opened lazily
+      episode_writer = None
 
     instance_num = 0
     correctness = 0
@@ -847,6 +1074,17 @@ class ner(nn.Module):
     beam_size_seqs = []
     action_seqs = []
 
+    # Sentences re-decoded by the fallback decoder of decode_method "gated"
+    redecoded_num = 0
+
+    # Predicted label indices of every batch, (batch size, sen len)
+    label_pred_seqs = []
+
+    # Per-batch decoding cost, with the batch shapes
+    sen_lens = []
+    batch_sizes = []
+    sentence_costs = []
+
     for batch in eval_data_X:
       instance_num += len(batch)
 
@@ -863,6 +1101,12 @@ class ner(nn.Module):
       current_batch_size = len(sen)
       current_sen_len = len(sen[0])
 
+      self.decode_cost.reset()
+      time_begin = time.time()
+
+      if self.tag_dictionary is not None:
+        self.shortlist = self.tag_dictionary.shortlist(sen, self.gpu, self.cuda_dev)
+
       sen_var = Variable(torch.LongTensor(sen))
       label_var = Variable(torch.LongTensor(label))
 
@@ -903,18 +1147,30 @@ class ner(nn.Module):
         label_pred_seq, accum_logP_pred_seq, logP_pred_seq, attention_pred_seq, episode, beam_size_seq = self.decode_beam_adaptive(current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, beam_size, max_beam_size, agent, reward_coef_fscore, reward_coef_beam_size, label_var, f_score_index_begin, generate_episode=generate_episode)
         beam_size_seqs.append(beam_size_seq)
 
-        if generate_episode:
-          for experience_tuple in episode:
-            episode_file.write("%d" % experience_tuple[1])
-            for state_element in experience_tuple[0]:
-              episode_file.write("\t%f" % state_element)
-            episode_file.write("\n")
+        if generate_episode and len(episode) > 0:
+          if episode_writer is None:
+            episode_writer = EpisodeWriter(episode_save_path, len(episode[0][0]))
+          episode_writer.write_episode(batch_idx, episode)
 
         ### Debugging...
         #print("input sentence =", sen)
         #print("true label =", label)
         #print("predicted label =", label_pred_seq)
         #print("episode =", episode)
+      elif decode_method == "gated":
+        # Greedy, then the fallback decoder (gate_fallback with beam_size)
+        # for the uncertain sentences only (see confidence_gate.py)
+        label_pred_seq, redecoded, beam_size_seq = self.decode_gated(sen, current_batch_size, current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, gate_fallback, gate_margin, gate_entropy, beam_size, max_beam_size, agent, label_var, f_score_index_begin)
+        beam_size_seqs.append(beam_size_seq)
+        redecoded_num += len(redecoded)
+      else:
+        raise Exception("Unknown decode method: " + decode_method)
+
+      self.decode_cost.time = time.time() - time_begin
+      sen_lens.append(current_sen_len)
+      batch_sizes.append(current_batch_size)
+      sentence_costs.append(self.decode_cost.as_list())
+      label_pred_seqs.append(label_pred_seq.data.cpu().numpy())
 
       correct_count += (label_pred_seq == label_var).sum()
       total_count += label_var.shape[1]
@@ -927,39 +1183,13 @@ class ner(nn.Module):
 
       # Write result into file
       if result_path:
-        if self.gpu:
-          label_pred_seq = label_pred_seq.cpu()
-
-        label_pred_seq = label_pred_seq.data.numpy().tolist()
-
-        # Here label_pred_seq.shape = (batch size, sen len)
-
-        # sen, label, label_pred_seq are list of lists,
-        # thus I would like to flatten them for iterating easier
-
-        sen = list(itertools.chain.from_iterable(sen))
-        label = list(itertools.chain.from_iterable(label))
-        label_pred_seq = list(itertools.chain.from_iterable(label_pred_seq))
-        assert len(sen) == len(label) and len(label) == len(label_pred_seq)
-        for i in range(len(sen)):
-          f_sen.write(str(sen[i]) + '\n')
-          f_label.write(str(label[i]) + '\n')
-          f_pred.write(str(label_pred_seq[i]) + '\n')
-
-          # clean version (does not print <PAD>, print a newline instead of <EOS>)
-          #if sen[i] != 0 and sen[i] != 2: # not <PAD> and not <EOS>
-          #if sen[i] != 0: # not <PAD>
-
-          result_sen = index2word[sen[i]]
-          result_label = index2label[label[i]]
-          result_pred = index2label[label_pred_seq[i]]
-          f_result_processed.write("%s %s %s\n" % (result_sen, result_label, result_pred))
-
-        if decode_method == "adaptive":
-          beam_size_seq_str = ' '.join(map(str, beam_size_seq))
-          f_beam_size.write(beam_size_seq_str + '\n')
+        with span("write_result"):
+          # Here label_pred_seq.shape = (batch size, sen len)
+          prediction_writer.write_batch(sen, label, label_pred_seqs[-1],
+                                        beam_size_seq if decode_method == "adaptive" else None)
 
     # End for batch_idx
+    self.shortlist = None
 
     if self.gpu:
       correct_count = correct_count.cpu()
@@ -973,22 +1203,45 @@ class ner(nn.Module):
     correct_count = correct_count.data.numpy()
     #total_count = total_count.data.numpy()
 
-    accuracy = float(correct_count) / total_count
+    # The counts add up over shards of the data (see parallel_eval.py)
+    self.eval_counts = [float(correct_count), float(total_count)]
+    accuracy = self.get_eval_score(self.eval_counts)
 
     if result_path:
-      f_sen.close()
-      f_pred.close()
-      f_label.close()
-      f_result_processed.close()
-      f_beam_size.close()
+      prediction_writer.close()
 
-    if generate_episode:
-      episode_file.close()
+    if generate_episode and episode_writer is not None:
+      episode_writer.close()
+
+    # Decoding cost, for cost_report.py
+    self.sentence_costs = sentence_costs
+
+    # For merging shards of a parallel evaluation
+    self.beam_size_seqs = beam_size_seqs
+    self.label_pred_seqs = label_pred_seqs
+
+    # Re-decode rate of "gated" decoding
+    self.gate_counts = [redecoded_num, instance_num]
+
+    if result_path:
+      write_sentence_costs(result_path + "cost_" + suffix + ".txt", sen_lens, batch_sizes, sentence_costs)
+      config = [("decode_method", decode_method),
+                ("beam_size", beam_size),
+                ("max_beam_size", max_beam_size if decode_method == "adaptive" else beam_size),
+                ("agent", type(agent).__name__ if decode_method == "adaptive" else None),
+                ("state_type", self.state_type),
+                ("action_repeat", self.action_repeat)]
+      if decode_method == "gated":
+        config += [("gate_fallback", gate_fallback),
+                   ("gate_margin", gate_margin),
+                   ("gate_entropy", gate_entropy),
+                   ("redecode_rate", redecoded_num / max(instance_num, 1))]
+      write_cost_summary(result_path + "cost_summary_" + suffix + ".txt", config, accuracy, sen_lens, batch_sizes, sentence_costs)
 
     total_beam_number_in_dataset = sum([sum(beam_size_seq) for beam_size_seq in beam_size_seqs])
     avg_beam_sizes = [(sum(beam_size_seq) / len(beam_size_seq) if len(beam_size_seq) else 0) for beam_size_seq in beam_size_seqs]
     avg_beam_sizes = list(filter(lambda xx: xx > 0, avg_beam_sizes))
-    avg_beam_size = sum(avg_beam_sizes) / len(avg_beam_sizes)
+    avg_beam_size = sum(avg_beam_sizes) / len(avg_beam_sizes) if len(avg_beam_sizes) else 0
 
     return accuracy, total_beam_number_in_dataset, avg_beam_size
 
@@ -1005,11 +1258,15 @@ class ner(nn.Module):
   # enc_hidden_seq: For attention. Can be put to None if no attention is used.
   #                 Shape: (seq len, batch size = 1, 2 * hidden dim) => for bi-directional LSTM encoder
   # attend_index: The index (time step, 0-based) in the enc_hidden_seq to attend to (used in fixed attention)
+  @profiled("decode_beam_step")
   def decode_beam_step(self, beam_size_in, y_beam_in, beta_beam_in, dec_hidden_beam_in, dec_cell_beam_in, accum_logP_beam_in, enc_hidden_seq, seq_len, attend_index):
 
     # Currently only support single instance, no minibatch
     batch_size = 1
 
+    self.decode_cost.lstm_cell += beam_size_in
+    self.decode_cost.candidates += beam_size_in * self.label_size
+
     # dec_hidden_out_list is the collection of the output hidden vectors from the input beam of y's.
     # If there are beam_size_in incoming beams, then there are also beam_size_in output hidden vectors in dec_hidden_out_list (one-to-one)
     # These hidden vectors will then be chosen according to top-K operation later
@@ -1054,10 +1311,9 @@ class ner(nn.Module):
       if self.attention:
         attention_list.append(attention)
 
-      # score_out and logP_out are shape (batch size = 1, label size)
+      # logP_out is shape (batch size = 1, label size)
       # They are the row predictions of the decoder for this step (not accumulated)
-      score_out = self.hidden2score(dec_hidden_out)
-      logP_out = self.score2logP(score_out).view(batch_size, self.label_size)
+      logP_out = self.output_logP(dec_hidden_out, attend_index)
 
       # accum_logP_in is shape (batch size = 1, 1)
       # It is the accumulated logP (sum over the path) of this beam we are now dealing with
@@ -1191,10 +1447,8 @@ class ner(nn.Module):
       # the shape (batch size, 1, input seq len)
       attention_beam = attention_beam.permute(1, 0, 2)
 
-    # score_out.shape => (batch size, |V^y|)
-    score_out = self.hidden2score(dec_hidden_out) \
-      .view(batch_size, self.label_size)
-    logP_out = self.score2logP(score_out).view(batch_size, self.label_size)
+    # logP_out.shape => (batch size, |V^y|)
+    logP_out = self.output_logP(dec_hidden_out, 0)
 
     # Initial step, accumulated logP is the same as logP
     accum_logP_out = logP_out
@@ -1211,11 +1465,22 @@ class ner(nn.Module):
     logP_matrix = torch.cat(logP_out_list, dim=1)
     accum_logP_matrix = torch.cat(accum_logP_out_list, dim=1)
 
+    # The LSTMCell call at t = 0
+    self.decode_cost.lstm_cell += 1
+    self.decode_cost.candidates += self.label_size
+
     # Just for code consistency (about reward calculation)
     cur_beam_size_in = 1
 
-    # Just for code consistency (about experience tuple)
-    cur_state = self.make_state(accum_logP_matrix, logP_matrix, 1, max_beam_size)
+    # The agent is queried at t = 1, then again after self.action_repeat
+    # time steps (or earlier when the score gap trigger fires), and the beam
+    # size is held in between. With action_repeat = 1 it acts at every t.
+    steps_since_query = self.action_repeat
+    gap_at_query = None
+
+    # The decision in effect, as [state, action, reward summed over the time
+    # steps it was held]. It becomes an experience tuple at the next query.
+    decision = None
     action = None
 
     # All beta^{t=0, b} are actually 0
@@ -1227,7 +1492,9 @@ class ner(nn.Module):
     beam_size_seq = []
     beam_size = initial_beam_size
     beam_size_seq.append(beam_size)
-    accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size, dim=1)
+    with span("topk"):
+      accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size, dim=1)
+    self.decode_cost.topk += 1
 
     beta_beam = torch.floor(index_beam.float() / self.label_size).long()
     y_beam = torch.remainder(index_beam, self.label_size)
@@ -1257,25 +1524,33 @@ class ner(nn.Module):
                               dec_hidden_beam, dec_cell_beam, accum_logP_beam,
                               enc_hidden_seq, seq_len, t)
 
+      # For reward calculation
+      prev_beam_size_in = cur_beam_size_in
+      cur_beam_size_in = beam_size
+
+      query, gap = self.query_agent(accum_logP_matrix, steps_since_query,
+                                    gap_at_query)
+
       # Actually, at t = T_y - 1 == seq_len - 1,
       # you don't have to take action (you don't have to pick a beam of predictions anymore), because at this last output step, you would pick only the highest result, and do the backtracking from it to determine the best sequence.
       # However, in the current version of this code, we temporarily keep doing one more beam picking, just to be compatible with the backtracking function and the rest of the code.
       # We delay the improvement to the future work.
       #
       # Note that this state is actually the output state at t
-      state = self.make_state(accum_logP_matrix, logP_matrix,
-                              beam_size, max_beam_size)
-
-      # For experience tuple
-      prev_state = cur_state
-      cur_state = state
-      prev_action = action
-
-      # For reward calculation
-      prev_beam_size_in = cur_beam_size_in
-      cur_beam_size_in = beam_size
-
-      action = agent.get_action(state)
+      # (the last one is also needed to close the last experience tuple)
+      if query or (generate_episode and t == seq_len - 1):
+        state = self.make_state(accum_logP_matrix, logP_matrix,
+                                beam_size, max_beam_size, t, seq_len)
+
+      if query:
+        with span("agent"):
+          action = agent.get_action(state)
+        self.decode_cost.agent_calls += 1
+        steps_since_query = 0
+        gap_at_query = gap
+      else:
+        action = agent.SAME
+      steps_since_query += 1
       action_seq.append(action)
       if action == agent.DECREASE and beam_size > 1:
         beam_size -= 1
@@ -1286,8 +1561,10 @@ class ner(nn.Module):
       if t <= seq_len - 2:
         beam_size_seq.append(beam_size)
 
-      accum_logP_beam, index_beam = \
-        torch.topk(accum_logP_matrix, beam_size, dim=1)
+      with span("topk"):
+        accum_logP_beam, index_beam = \
+          torch.topk(accum_logP_matrix, beam_size, dim=1)
+      self.decode_cost.topk += 1
 
       beta_beam = torch.floor(
         index_beam.float() / self.label_size).long()
@@ -1304,12 +1581,20 @@ class ner(nn.Module):
         label_pred_seq, accum_logP_pred_seq, logP_pred_seq, attention_pred_seq = self.backtracking(t + 1, batch_size, y_seq, beta_seq, attention_seq, logP_seq, accum_logP_seq)
         cur_fscore = self.get_fscore(label_pred_seq, label_true_seq, f_score_index_begin)
 
-        # If t >= 2, compute the reward,
-        # and generate the experience tuple ( s_{t-1}, a_{t-1}, r_{t-1}, s_t )
+        # If t >= 2, compute the reward r_{t-1}, which goes to the decision
+        # in effect at t - 1
         if t >= 2:
           reward = self.get_reward(cur_fscore, fscore, cur_beam_size_in, prev_beam_size_in, reward_coef_fscore, reward_coef_beam_size)
-          experience_tuple = (prev_state, prev_action, reward, cur_state)
-          episode.append(experience_tuple)
+          decision[2] += reward
+
+        # At a query (and at the end), generate the experience tuple
+        # ( s_{t'}, a_{t'}, r_{t'} + ... + r_{t-1}, s_t ) of the decision taken
+        # at t' and held until now
+        if query or t == seq_len - 1:
+          if decision is not None:
+            experience_tuple = (decision[0], decision[1], decision[2], state)
+            episode.append(experience_tuple)
+          decision = [state, action, 0] if t < seq_len - 1 else None
 
         fscore = cur_fscore
       else:
@@ -1321,7 +1606,17 @@ class ner(nn.Module):
 
 
   # make_state - generate the state for the RL agent
-  def make_state(self, accum_logP_matrix, logP_matrix, beam_size, max_beam_size):
+  #
+  # t and seq_len are only used by the "compact" state (position feature)
+  @profiled("make_state")
+  def make_state(self, accum_logP_matrix, logP_matrix, beam_size, max_beam_size, t=None, seq_len=None):
+    # Both state types take two top-k's
+    self.decode_cost.topk += 2
+
+    if self.state_type == "compact":
+      return make_compact_state(accum_logP_matrix, logP_matrix, beam_size,
+                                self.label_size, t, seq_len)
+
     accum_logP_state, _ = \
       torch.topk(accum_logP_matrix, max_beam_size, dim=1)
     logP_state, _ = \
@@ -1339,6 +1634,23 @@ class ner(nn.Module):
     return state
 
 
+  # query_agent - whether the agent should pick an action at this time step
+  #
+  # Returns (query, gap). gap is the score gap to pass back in as gap_at_query
+  # once the agent has been queried (None if there is no gap trigger).
+  def query_agent(self, accum_logP_matrix, steps_since_query, gap_at_query):
+    gap = None
+    if self.repeat_gap_threshold is not None:
+      gap = get_score_gap(accum_logP_matrix)
+      self.decode_cost.topk += 1
+      if gap_at_query is not None and \
+         abs(gap - gap_at_query) > self.repeat_gap_threshold:
+        return True, gap
+
+    return steps_since_query >= self.action_repeat, gap
+
+
+  @profiled("backtracking")
   def backtracking(self, seq_len, batch_size, y_seq, beta_seq, attention_seq, logP_seq, accum_logP_seq):
     # Only output the highest-scored beam (for each instance in the batch)
     label_pred_seq = y_seq[seq_len - 1][:, 0].contiguous() \
@@ -1398,8 +1710,15 @@ class ner(nn.Module):
     return reward
 
 
+  # Accuracy from the [correct count, total count] of evaluate
+  def get_eval_score(self, eval_counts):
+    correct_count, total_count = eval_counts
+    return correct_count / total_count
+
+
   # It computes partial F-score, so expect label_var.size()[1] >= label_pred_seq.size()[1] generally
   # This function should work for batch size > 1 as well
+  @profiled("get_fscore")
   def get_fscore(self, label_pred_seq_input, label_var_input, f_score_index_begin):
     if self.gpu:
       label_pred_seq = label_pred_seq_input.cpu().data.numpy()
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from episode_store import EpisodeStore
+from model import AdaptiveActorCritic
+from optim import SharedAdam
+from rl_trainer import ensure_shared_grads, sync_with_shared_model
+from state_features import COMPACT_STATE_DIM
+
+
+###############################
+# Offline policy training from logged episodes (see episode_store.py), e.g.
+# the det_agent trajectories written by the exp_eval_*_generate_episode.py
+# scripts. No sentence is decoded here.
+#
+# The loss on a minibatch of transitions (s, a, r, s') is
+#   bc_coef * behaviour cloning (-log pi(a|s))
+#   + awr_coef * advantage-weighted regression (-w(s, a) log pi(a|s))
+#   + value_loss_coef * TD(0) value regression,
+# where w(s, a) = min(exp(A(s, a) / awr_beta), awr_max_weight) and
+# A(s, a) = r + gamma * V(s') - V(s). Behaviour cloning alone reproduces the
+# logging agent; the AWR term moves the policy towards the logged actions
+# that turned out better than the critic expected.
+#
+# Like rl_trainer.train_adaptive, workers update a shared model Hogwild-style
+# with SharedAdam, each taking every num_processes-th minibatch. The
+# resulting checkpoint can warm-start the online A3C loop
+# (train_rl_de.py --warm-start).
+###############################
+
+
+def offline_loss(model, batch, args):
+  state, action, reward, next_state, done, _ = batch
+  batch_size = len(action)
+
+  value, logit = model(state)
+  next_value, _ = model(next_state)
+
+  log_prob = F.log_softmax(logit, dim=-1)
+  action_var = Variable(torch.from_numpy(action.astype(np.int64))).view(batch_size, 1)
+  log_prob_action = log_prob.gather(1, action_var)
+
+  reward_var = Variable(torch.from_numpy(reward.astype(np.float32))).view(batch_size, 1)
+  not_done = Variable(torch.from_numpy(1 - done.astype(np.float32))).view(batch_size, 1)
+
+  target = reward_var + args.gamma * not_done * next_value.detach()
+  advantage = target - value
+  value_loss = 0.5 * advantage.pow(2).mean()
+
+  weight = torch.exp(advantage.detach() / args.awr_beta) \
+    .clamp(max=args.awr_max_weight)
+  bc_loss = -log_prob_action.mean()
+  awr_loss = -(weight * log_prob_action).mean()
+
+  loss = args.bc_coef * bc_loss + args.awr_coef * awr_loss \
+         + args.value_loss_coef * value_loss
+
+  # Fraction of the logged actions the policy would pick greedily
+  agreement = (log_prob.max(1)[1].view(batch_size, 1) == action_var).float().mean()
+
+  return loss, agreement
+
+
+def train_offline(rank, max_beam_size, shared_model, optimizer, episode_path,
+                  args):
+  torch.manual_seed(args.seed + rank)
+  # One thread per worker; the workers themselves use all the cores
+  torch.set_num_threads(1)
+
+  logfile = open(os.path.join(args.logdir, "log_offline_" + str(rank) + ".txt"), "w+")
+
+  # Each process memory-maps the store itself
+  store = EpisodeStore(episode_path)
+
+  model = AdaptiveActorCritic(max_beam_size=max_beam_size, action_space=3,
+                              state_type=args.state_type)
+  model.train()
+
+  for epoch in range(0, args.n_epochs):
+    time_begin = time.time()
+    loss_sum = 0
+    agreement_sum = 0
+    batch_count = 0
+
+    # All workers shuffle with the same seed, then each reads only its own
+    # share of the transitions
+    rng = np.random.RandomState(args.seed + epoch)
+    for batch in store.iterate(args.batch_size, shuffle=True, rng=rng,
+                               shard=rank, num_shards=args.num_processes):
+      sync_with_shared_model(model, shared_model)
+
+      loss, agreement = offline_loss(model, batch, args)
+
+      optimizer.zero_grad()
+      model.zero_grad()
+      loss.backward()
+      torch.nn.utils.clip_grad_norm(model.parameters(), args.max_grad_norm)
+      ensure_shared_grads(model, shared_model)
+      optimizer.step()
+
+      loss_sum += float(loss.data.numpy().reshape(-1)[0])
+      agreement_sum += float(agreement.data.numpy().reshape(-1)[0])
+      batch_count += 1
+    # End for batch
+    time_end = time.time()
+
+    batch_count = max(batch_count, 1)
+    log_msg = "%d\t%f\t%f\t%f" % (epoch, loss_sum / batch_count,
+                                  agreement_sum / batch_count,
+                                  time_end - time_begin)
+    print(log_msg)
+    logfile.write(log_msg + '\n')
+    logfile.flush()
+
+    if rank == 0:
+      torch.save({'epoch': epoch,
+                  'state_dict': shared_model.state_dict(),
+                  'optimizer' : optimizer.state_dict()},
+                 os.path.join(args.logdir, "ckpt_offline_" + str(epoch) + ".pth"))
+  # End for epoch
+  logfile.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Offline training of the beam agent from logged episodes')
+  parser.add_argument('episode_path',
+                      help='episode store written by ner.evaluate(..., generate_episode=True)')
+  parser.add_argument('--logdir', default='../result_lrn_0p001_atten_rl_offline',
+                      help='name of logging directory')
+  parser.add_argument('--lr', type=float, default=0.001,
+                      help='learning rate (default: 0.001)')
+  parser.add_argument('--gamma', type=float, default=0.99,
+                      help='discount factor for rewards (default: 0.99)')
+  parser.add_argument('--n_epochs', type=int, default=10,
+                      help='number of passes over the episodes (default: 10)')
+  parser.add_argument('--batch-size', type=int, default=256,
+                      help='number of transitions per minibatch (default: 256)')
+  parser.add_argument('--bc-coef', type=float, default=1.0,
+                      help='behaviour cloning coefficient (default: 1.0)')
+  parser.add_argument('--awr-coef', type=float, default=1.0,
+                      help='advantage-weighted regression coefficient (default: 1.0)')
+  parser.add_argument('--awr-beta', type=float, default=1.0,
+                      help='temperature of the advantage weights (default: 1.0)')
+  parser.add_argument('--awr-max-weight', type=float, default=20.0,
+                      help='upper bound of the advantage weights (default: 20)')
+  parser.add_argument('--value-loss-coef', type=float, default=0.5,
+                      help='value loss coefficient (default: 0.5)')
+  parser.add_argument('--max-grad-norm', type=float, default=5,
+                      help='value loss coefficient (default: 5)')
+  parser.add_argument('--num-processes', type=int, default=os.cpu_count(),
+                      help='how many training processes to use (default: all cores)')
+  parser.add_argument('--state-type', default='topk',
+                      choices=['topk', 'compact'],
+                      help='state stored in the episodes, see ner.make_state '
+                           '(default: topk)')
+  parser.add_argument('--seed', type=int, default=1,
+                      help='random seed (default: 1)')
+  args = parser.parse_args()
+
+  os.environ['OMP_NUM_THREADS'] = '1'
+
+  if not os.path.exists(args.logdir):
+    os.mkdir(args.logdir)
+
+  # For the topk state, state_dim = 2 * max_beam_size + 1 (see
+  # ner.make_state). The compact state does not depend on max_beam_size.
+  store = EpisodeStore(args.episode_path)
+  if args.state_type == "compact":
+    max_beam_size = None
+    if store.state_dim != COMPACT_STATE_DIM:
+      raise Exception("Episodes do not hold compact states: " + args.episode_path)
+  else:
+    max_beam_size = (store.state_dim - 1) // 2
+  print("Loaded", len(store), "transitions, max_beam_size =", max_beam_size)
+
+  shared_model = AdaptiveActorCritic(max_beam_size=max_beam_size,
+                                     action_space=3,
+                                     state_type=args.state_type)
+  shared_model.share_memory()
+
+  optimizer = SharedAdam(params=shared_model.parameters(), lr=args.lr)
+  optimizer.share_memory()
+
+  processes = []
+  for rank in range(0, args.num_processes):
+    p = mp.Process(target=train_offline,
+                   args=(rank, max_beam_size, shared_model, optimizer,
+                         args.episode_path, args))
+    p.start()
+    processes.append(p)
+
+  for p in processes:
+    p.join()
+
+  # The warm start for the online A3C loop
+  torch.save({'epoch': args.n_epochs - 1,
+              'state_dict': shared_model.state_dict(),
+              'optimizer' : optimizer.state_dict()},
+             os.path.join(args.logdir, "ckpt_offline.pth"))
+
+
+if __name__ == "__main__":
+  main()
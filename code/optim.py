@@ -70,3 +70,81 @@ class SharedAdam(optim.Adam):
                 p.data.addcdiv_(-step_size, exp_avg, denom)
 
         return loss
+
+
+class LazyAdam(optim.Adam):
+    """Implements Adam algorithm with lazy updates for sparse gradients.
+
+    Dense gradients get the usual Adam update. For a sparse gradient (from
+    nn.Embedding(..., sparse=True)) only the rows in the gradient have their
+    moments decayed and their values updated, as in optim.SparseAdam, so a
+    step costs in proportion to the rows a batch touches, not to the size
+    of the embedding table.
+
+    The state is that of optim.Adam (step, exp_avg, exp_avg_sq), so state
+    dicts load into either optimizer.
+    """
+
+    def step(self, closure=None):
+        """Performs a single optimization step.
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data
+                state = self.state[p]
+
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = p.data.new().resize_as_(p.data).zero_()
+                    state['exp_avg_sq'] = p.data.new().resize_as_(p.data).zero_()
+
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                beta1, beta2 = group['betas']
+
+                state['step'] = int(state['step']) + 1
+
+                bias_correction1 = 1 - beta1**state['step']
+                bias_correction2 = 1 - beta2**state['step']
+                step_size = group['lr'] * math.sqrt(
+                    bias_correction2) / bias_correction1
+
+                if grad.is_sparse:
+                    if group['weight_decay'] != 0:
+                        raise Exception("LazyAdam does not support weight decay with sparse gradients")
+                    grad = grad.coalesce()
+                    rows = grad._indices()[0]
+                    values = grad._values()
+
+                    # Moments and values of the rows in the gradient only
+                    exp_avg_rows = exp_avg.index_select(0, rows) \
+                        .mul_(beta1).add_(1 - beta1, values)
+                    exp_avg_sq_rows = exp_avg_sq.index_select(0, rows) \
+                        .mul_(beta2).addcmul_(1 - beta2, values, values)
+                    exp_avg.index_copy_(0, rows, exp_avg_rows)
+                    exp_avg_sq.index_copy_(0, rows, exp_avg_sq_rows)
+
+                    denom = exp_avg_sq_rows.sqrt().add_(group['eps'])
+                    p.data.index_add_(0, rows, exp_avg_rows.div_(denom).mul_(-step_size))
+                    continue
+
+                if group['weight_decay'] != 0:
+                    grad = grad.add(group['weight_decay'], p.data)
+
+                # Decay the first and second moment running average coefficient
+                exp_avg.mul_(beta1).add_(1 - beta1, grad)
+                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+
+                denom = exp_avg_sq.sqrt().add_(group['eps'])
+
+                p.data.addcdiv_(-step_size, exp_avg, denom)
+
+        return loss
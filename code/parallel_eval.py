@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+
+from chunk_eval import ChunkScorer
+from decode_cost import write_sentence_costs, write_cost_summary
+from episode_store import EpisodeStore, EpisodeWriter
+from prediction_store import PredictionWriter
+
+
+###############################
+# ner.evaluate on several cores.
+#
+# The batches are cut into contiguous shards of about equal decoding work
+# (tokens times beam size, or tokens for adaptive decoding, which has batches
+# of one), shards_per_worker per worker so that the shards of long sentences
+# do not hold up the end. The workers are forked from this process after the
+# model's weights are moved to shared memory, so they all read the same copy;
+# each runs machine.evaluate on its shards without writing anything, and
+# sends back the counts (machine.eval_counts), beam sizes, predictions and
+# decoding costs of every batch. Generated episodes go to one episode store
+# per shard.
+#
+# Everything is merged in the original batch order: counts are summed (so
+# the F-score / accuracy is exactly that of evaluate), and the predictions,
+# chunk counts, decoding costs and episodes (sentence ids being batch
+# indices, as in evaluate) are written by this process as evaluate would.
+# The result does not depend on the number of workers.
+#
+# Usage, with the arguments of ner.evaluate:
+#   fscore, total_beam_number, avg_beam_size = \
+#     parallel_evaluate(machine, X, Y, ..., num_workers=32)
+# or --eval-workers of sweep.py, eval_rl_de_val.py and eval_rl_de_test.py.
+###############################
+
+# Set in the parent before forking the workers
+MACHINE = None
+EVAL_ARGS = {}
+
+
+def shard_bounds(eval_data_X, num_shards, decode_method, beam_size):
+  # [begin, end) batch ranges of about equal decoding work, none without
+  # batches
+  if len(eval_data_X) == 0:
+    return []
+  width = 1 if decode_method == "greedy" else beam_size
+  work = np.cumsum([len(batch) * len(batch[0]) * width for batch in eval_data_X])
+  cuts = np.searchsorted(work, work[-1] * np.arange(1, num_shards) / num_shards, side='right')
+  bounds = sorted(set([0] + cuts.tolist() + [len(eval_data_X)]))
+  return list(zip(bounds[:-1], bounds[1:]))
+
+
+def init_worker(num_threads):
+  torch.set_num_threads(num_threads)
+
+
+def evaluate_shard(item):
+  begin, end, episode_path = item
+  args = EVAL_ARGS
+  MACHINE.evaluate(args["X"][begin:end], args["Y"][begin:end], None, None,
+                   args["suffix"], None, args["decode_method"], args["beam_size"],
+                   args["max_beam_size"], args["agent"], args["reward_coef_fscore"],
+                   args["reward_coef_beam_size"], args["f_score_index_begin"],
+                   generate_episode=args["generate_episode"],
+                   episode_save_path=episode_path,
+                   gate_fallback=args["gate_fallback"], gate_margin=args["gate_margin"],
+                   gate_entropy=args["gate_entropy"])
+  return (MACHINE.eval_counts, MACHINE.beam_size_seqs, MACHINE.label_pred_seqs,
+          MACHINE.sentence_costs, MACHINE.gate_counts)
+
+
+def parallel_evaluate(machine, eval_data_X, eval_data_Y, index2word, index2label, suffix, result_path, decode_method, beam_size, max_beam_size, agent, reward_coef_fscore, reward_coef_beam_size, f_score_index_begin, generate_episode=True, episode_save_path=None, result_mode="text", background_writer=False, gate_fallback="beam", gate_margin=1.0, gate_entropy=None, num_workers=None, num_threads=1, shards_per_worker=4):
+  global MACHINE
+
+  if machine.gpu:
+    raise Exception("parallel_evaluate only runs on CPU")
+  if len(eval_data_X) == 0:
+    raise Exception("parallel_evaluate got no batches to evaluate")
+  num_workers = num_workers or multiprocessing.cpu_count()
+
+  MACHINE = machine
+  EVAL_ARGS.update({"X": eval_data_X, "Y": eval_data_Y, "suffix": suffix,
+                    "decode_method": decode_method, "beam_size": beam_size,
+                    "max_beam_size": max_beam_size, "agent": agent,
+                    "reward_coef_fscore": reward_coef_fscore,
+                    "reward_coef_beam_size": reward_coef_beam_size,
+                    "f_score_index_begin": f_score_index_begin,
+                    "generate_episode": generate_episode,
+                    "gate_fallback": gate_fallback, "gate_margin": gate_margin,
+                    "gate_entropy": gate_entropy})
+  # One copy of the weights for all the workers
+  machine.share_memory()
+
+  bounds = shard_bounds(eval_data_X, num_workers * shards_per_worker, decode_method, beam_size)
+  items = [(begin, end, episode_save_path + ".shard_%d" % i if generate_episode else None)
+           for i, (begin, end) in enumerate(bounds)]
+  for _, _, episode_path in items:
+    # Left over by an interrupted evaluation
+    if episode_path and os.path.exists(episode_path):
+      os.remove(episode_path)
+
+  pool = multiprocessing.get_context("fork").Pool(num_workers, initializer=init_worker, initargs=(num_threads,))
+  # imap keeps the shards in order
+  shard_results = list(pool.imap(evaluate_shard, items))
+  pool.close()
+  pool.join()
+
+  eval_counts = np.sum([result[0] for result in shard_results], axis=0).tolist()
+  beam_size_seqs = [seq for result in shard_results for seq in result[1]]
+  label_pred_seqs = [seq for result in shard_results for seq in result[2]]
+  sentence_costs = [cost for result in shard_results for cost in result[3]]
+  gate_counts = np.sum([result[4] for result in shard_results], axis=0).tolist()
+  sen_lens = [len(batch[0]) for batch in eval_data_X]
+  batch_sizes = [len(batch) for batch in eval_data_X]
+
+  fscore = machine.get_eval_score(eval_counts)
+
+  if generate_episode:
+    episode_writer = None
+    for begin, _, episode_path in items:
+      # No file if the shard had no episode
+      if not os.path.exists(episode_path):
+        continue
+      store = EpisodeStore(episode_path)
+      if episode_writer is None:
+        episode_writer = EpisodeWriter(episode_save_path, store.state_dim)
+      episode_writer.write_store(store, sentence_id_offset=begin)
+      del store
+      os.remove(episode_path)
+    if episode_writer is not None:
+      episode_writer.close()
+
+  if result_path:
+    prediction_writer = PredictionWriter(result_path, suffix, index2word, index2label, mode=result_mode, background=background_writer)
+    for sen, label, label_pred, beam_size_seq in zip(eval_data_X, eval_data_Y, label_pred_seqs, beam_size_seqs):
+      prediction_writer.write_batch(sen, label, label_pred,
+                                    beam_size_seq if decode_method == "adaptive" else None)
+    prediction_writer.close()
+
+  chunk_counts = None
+  if index2label:
+    chunk_scorer = ChunkScorer(index2label)
+    for label, label_pred in zip(eval_data_Y, label_pred_seqs):
+      chunk_scorer.add(label, label_pred)
+    chunk_counts = chunk_scorer.counts()
+
+  # The same attributes as after evaluate
+  machine.eval_counts = eval_counts
+  machine.beam_size_seqs = beam_size_seqs
+  machine.label_pred_seqs = label_pred_seqs
+  machine.sentence_costs = sentence_costs
+  machine.chunk_counts = chunk_counts
+  machine.gate_counts = gate_counts
+
+  if result_path:
+    write_sentence_costs(result_path + "cost_" + suffix + ".txt", sen_lens, batch_sizes, sentence_costs)
+    config = [("decode_method", decode_method),
+              ("beam_size", beam_size),
+              ("max_beam_size", max_beam_size if decode_method == "adaptive" else beam_size),
+              ("agent", type(agent).__name__ if decode_method == "adaptive" else None),
+              ("state_type", machine.state_type),
+              ("action_repeat", machine.action_repeat)]
+    if decode_method == "gated":
+      config += [("gate_fallback", gate_fallback),
+                 ("gate_margin", gate_margin),
+                 ("gate_entropy", gate_entropy),
+                 ("redecode_rate", gate_counts[0] / max(gate_counts[1], 1))]
+    write_cost_summary(result_path + "cost_summary_" + suffix + ".txt", config, fscore, sen_lens, batch_sizes, sentence_costs)
+
+  total_beam_number_in_dataset = sum([sum(beam_size_seq) for beam_size_seq in beam_size_seqs])
+  avg_beam_sizes = [(sum(beam_size_seq) / len(beam_size_seq) if len(beam_size_seq) else 0) for beam_size_seq in beam_size_seqs]
+  avg_beam_sizes = list(filter(lambda xx: xx > 0, avg_beam_sizes))
+  avg_beam_size = sum(avg_beam_sizes) / len(avg_beam_sizes) if len(avg_beam_sizes) else 0
+
+  return fscore, total_beam_number_in_dataset, avg_beam_size
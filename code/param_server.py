@@ -0,0 +1,325 @@
+import os
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from checkpoint_manager import CheckpointManager
+from model import AdaptiveActorCritic
+from optim import SharedAdam
+import profiler
+from rl_trainer import decode_one_sentence_adaptive_rl
+
+
+###############################
+# Parameter-server mode for A3C.
+#
+# The parameter server process owns the AdaptiveActorCritic and its SharedAdam.
+# Actor processes (on this host or any other) decode sentences with their own
+# copy of the policy, push gradients to the server without waiting for a
+# reply, and pull the weights every args.sync_interval sentences.
+#
+# The protocol is a plain multiprocessing.connection (pickled tuples over a
+# TCP socket with an authkey), one connection per actor:
+#   ("pull", version)          -> (version, params or None if up to date)
+#   ("push", grads)            -> no reply; server applies one optimizer step
+#   ("count", steps)           -> no reply; add to the global step counter
+#   ("epoch_end", rank, epoch) -> no reply; server saves ckpt_<epoch>.pth
+#                                 (once per epoch, see checkpoint_manager.py)
+#   ("close",)                 -> no reply; the actor is done
+###############################
+
+
+class ParameterServer():
+  def __init__(self, max_beam_size, lr, address, authkey, num_actors, logdir,
+               load_model_filename=None, state_type="topk", keep_checkpoints=None):
+    self.address = address
+    self.authkey = authkey
+    self.num_actors = num_actors
+    self.logdir = logdir
+    # ckpt_<epoch>.pth written in the background, once per epoch
+    self.checkpoint_manager = CheckpointManager(logdir, keep_last=keep_checkpoints)
+
+    self.model = AdaptiveActorCritic(max_beam_size=max_beam_size,
+                                     action_space=3, state_type=state_type)
+    if load_model_filename:
+      self.model.load_state_dict(
+        torch.load(load_model_filename, map_location="cpu")["state_dict"])
+    self.optimizer = SharedAdam(params=self.model.parameters(), lr=lr)
+
+    # All updates go through one optimizer, so applying a step is serialized.
+    # Pulls also take the lock, so an actor never sees a half-applied step.
+    self.lock = threading.Lock()
+    self.version = 0
+    self.counter = 0
+
+  def serve(self):
+    # Messages are unpickled: without a secret, anyone reaching the port
+    # could run code here
+    if not self.authkey:
+      raise Exception("The parameter server needs an authkey")
+    listener = Listener(self.address, authkey=self.authkey)
+    print("Parameter server listening on", listener.address)
+
+    threads = []
+    for _ in range(self.num_actors):
+      conn = listener.accept()
+      thread = threading.Thread(target=self._handle, args=(conn,))
+      thread.start()
+      threads.append(thread)
+
+    for thread in threads:
+      thread.join()
+    listener.close()
+
+    print("Parameter server done, total steps =", self.counter)
+    self.checkpoint_manager.close()
+    self.save_checkpoint(os.path.join(self.logdir, "ckpt_final.pth"), -1)
+
+  def _handle(self, conn):
+    while True:
+      try:
+        msg = conn.recv()
+      except EOFError:
+        break
+
+      kind = msg[0]
+      if kind == "pull":
+        with self.lock:
+          if msg[1] == self.version:
+            conn.send((self.version, None))
+          else:
+            params = [param.data.cpu().numpy().copy()
+                      for param in self.model.parameters()]
+            conn.send((self.version, params))
+      elif kind == "push":
+        with self.lock:
+          for param, grad in zip(self.model.parameters(), msg[1]):
+            param._grad = Variable(torch.from_numpy(grad))
+          with profiler.span("optimizer_step"):
+            self.optimizer.step()
+          self.version += 1
+      elif kind == "count":
+        with self.lock:
+          self.counter += msg[1]
+      elif kind == "epoch_end":
+        _, rank, epoch = msg
+        # The first actor to finish an epoch has it saved, the others'
+        # requests for the same epoch are dropped
+        with self.lock:
+          self.checkpoint_manager.save(epoch,
+                                       {'epoch': epoch,
+                                        'state_dict': self.model.state_dict(),
+                                        'optimizer' : self.optimizer.state_dict()})
+      elif kind == "close":
+        break
+      else:
+        raise Exception("Unknown message: " + str(kind))
+    # End while
+
+    conn.close()
+
+  def save_checkpoint(self, filename, epoch):
+    with self.lock:
+      torch.save({'epoch': epoch,
+                  'state_dict': self.model.state_dict(),
+                  'optimizer' : self.optimizer.state_dict()},
+                 filename)
+
+
+class ParameterClient():
+  def __init__(self, address, authkey, connect_timeout=60):
+    # The server may still be starting up, so retry for a while
+    time_begin = time.time()
+    while True:
+      try:
+        self.conn = Client(address, authkey=authkey)
+        break
+      except OSError:
+        if time.time() - time_begin > connect_timeout:
+          raise
+        time.sleep(0.5)
+
+    self.version = -1
+
+  # Copy the server's weights into model, unless they have not changed
+  # since the last pull
+  def pull(self, model):
+    self.conn.send(("pull", self.version))
+    version, params = self.conn.recv()
+    if params is not None:
+      for param, value in zip(model.parameters(), params):
+        param.data.copy_(torch.from_numpy(value))
+      self.version = version
+
+  def push(self, model):
+    grads = []
+    for param in model.parameters():
+      if param.grad is None:
+        grads.append(np.zeros(param.data.size(), dtype=np.float32))
+      else:
+        grads.append(param.grad.data.cpu().numpy())
+    self.conn.send(("push", grads))
+
+  def add_steps(self, steps):
+    self.conn.send(("count", steps))
+
+  def end_epoch(self, rank, epoch):
+    self.conn.send(("epoch_end", rank, epoch))
+
+  def close(self):
+    self.conn.send(("close",))
+    self.conn.close()
+
+
+# Stands in for the shared optimizer in decode_one_sentence_adaptive_rl:
+# step() pushes the actor's gradients to the parameter server
+class RemoteOptimizer():
+  def __init__(self, client, model):
+    self.client = client
+    self.model = model
+
+  def zero_grad(self):
+    self.model.zero_grad()
+
+  def step(self):
+    self.client.push(self.model)
+
+
+def run_parameter_server(max_beam_size, lr, address, authkey, num_actors,
+                         logdir, load_model_filename=None, state_type="topk",
+                         keep_checkpoints=None):
+  server = ParameterServer(max_beam_size, lr, address, authkey, num_actors,
+                           logdir, load_model_filename, state_type,
+                           keep_checkpoints)
+  server.serve()
+  profiler.dump()
+
+
+# Same as rl_trainer.train_adaptive, but the shared model and optimizer live
+# in the parameter server at address
+def train_adaptive_remote(rank,
+                          machine,
+                          max_beam_size,
+                          address,
+                          authkey,
+                          data_X, data_Y,
+                          decode_method, beam_size,
+                          reward_coef_fscore, reward_coef_beam_size,
+                          f_score_index_begin,
+                          args):
+  torch.manual_seed(123 + rank)
+
+  logfile = open(os.path.join(args.logdir, "log_" + str(rank) + ".txt"), "w+")
+
+  client = ParameterClient(address, authkey)
+
+  model = AdaptiveActorCritic(max_beam_size=max_beam_size, action_space=3,
+                              state_type=machine.state_type)
+  model.train()
+  optimizer = RemoteOptimizer(client, model)
+
+  sync_interval = getattr(args, "sync_interval", 1)
+  counter_interval = getattr(args, "counter_interval", 1)
+  sentences_since_sync = sync_interval
+  local_steps = 0
+
+  batch_num = len(data_X)
+
+  for epoch in range(0, args.n_epochs):
+    reward_list = []
+
+    # shuffle
+    batch_idx_list = range(batch_num)
+    batch_idx_list = np.random.permutation(batch_idx_list)
+
+    time_begin = time.time()
+    for batch_idx in batch_idx_list:
+      sen = data_X[batch_idx]
+      label = data_Y[batch_idx]
+
+      current_batch_size = len(sen)
+      current_sen_len = len(sen[0])
+
+      if current_sen_len < 3:  # ignore sentence having tiny length
+        continue
+
+      sen_var = Variable(torch.LongTensor(sen))
+      label_var = Variable(torch.LongTensor(label))
+
+      if machine.gpu:
+        sen_var = sen_var.cuda()
+        label_var = label_var.cuda()
+
+      init_enc_hidden = Variable(
+        torch.zeros((2, current_batch_size, machine.hidden_dim)))
+      init_enc_cell = Variable(
+        torch.zeros((2, current_batch_size, machine.hidden_dim)))
+
+      if machine.gpu:
+        init_enc_hidden = init_enc_hidden.cuda()
+        init_enc_cell = init_enc_cell.cuda()
+
+      enc_hidden_seq, (enc_hidden_out, enc_cell_out) = machine.encode(sen_var,
+                                                                   init_enc_hidden,
+                                                                   init_enc_cell)
+
+      init_dec_hidden = machine.enc2dec_hidden(
+        torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
+      init_dec_cell = machine.enc2dec_cell(
+        torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
+
+      # Pull the weights from the server periodically
+      if sentences_since_sync >= sync_interval:
+        client.pull(model)
+        sentences_since_sync = 0
+      sentences_since_sync += 1
+
+      # ===================================
+      if decode_method == "adaptive":
+        # The local model plays the role of the shared model as well,
+        # so that ensure_shared_grads is a no-op and RemoteOptimizer
+        # pushes the local gradients
+        label_pred_seq, accum_logP_pred_seq, logP_pred_seq, \
+        attention_pred_seq, episode, sen_beam_size_seq, total_reward = \
+          decode_one_sentence_adaptive_rl(machine,
+          current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq,
+          beam_size, max_beam_size, model, model, reward_coef_fscore,
+          reward_coef_beam_size, label_var, f_score_index_begin,
+          optimizer, args)
+
+        reward_list.append(total_reward)
+
+        local_steps += current_sen_len - 1
+        if local_steps >= counter_interval:
+          client.add_steps(local_steps)
+          local_steps = 0
+      else:
+        raise Exception("Not implemented!")
+      # ===================================
+    # End for batch_idx
+    time_end = time.time()
+    time_used = time_end - time_begin
+
+    if local_steps > 0:
+      client.add_steps(local_steps)
+      local_steps = 0
+
+    reward_list = np.array(reward_list)
+    reward_mean = np.mean(reward_list)
+    reward_std = np.std(reward_list)
+    log_msg = "%d\t%f\t%f\t%f" % (epoch, reward_mean, reward_std, time_used)
+    print(log_msg)
+    logfile.write(log_msg + '\n')
+    logfile.flush()
+
+    client.end_epoch(rank, epoch)
+  # End for epoch
+
+  client.close()
+  logfile.close()
+  # Workers do not run atexit handlers
+  profiler.dump()
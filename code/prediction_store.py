@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+import queue
+import sys
+import threading
+
+import numpy as np
+
+
+###############################
+# Buffered writer for the prediction files of an evaluation, replacing the
+# token-by-token writes (and flushes) of the five files
+#   <prefix>sen_<suffix>.txt               word index, one per line
+#   <prefix>label_<suffix>.txt             gold label index, one per line
+#   <prefix>pred_<suffix>.txt              predicted label index, one per line
+#   <prefix>result_processed_<suffix>.txt  "word label prediction" per token
+#   <prefix>beam_size_<suffix>.txt         beam sizes of one sentence per line
+#                                          (adaptive decoding only)
+#
+# write_batch() only keeps the arrays of a batch. Once block_size tokens are
+# pending they are formatted and written in one go per file, by a background
+# thread with background=True. Index-to-string lookups go through arrays
+# built once from index2word / index2label. An error of the background
+# thread is raised again by the next flush() or by close().
+#
+# With mode="npz" nothing is formatted: close() saves all the arrays in
+# <prefix>predictions_<suffix>.npz (together with the vocabularies), which
+# to_text() or
+#   python3 prediction_store.py <npz file> <prefix> <suffix>
+# turns into the text files above when needed.
+###############################
+
+FILE_NAMES = ["sen", "label", "pred", "result_processed", "beam_size"]
+
+
+def lookup_table(index2string):
+  table = np.empty(max(index2string) + 1, dtype=object)
+  table[:] = ""
+  for index, string in index2string.items():
+    table[index] = string
+  return table
+
+
+def npz_filename(prefix, suffix):
+  return prefix + "predictions_" + suffix + ".npz"
+
+
+class PredictionWriter():
+  def __init__(self, prefix, suffix, index2word, index2label, mode="text",
+               block_size=65536, background=False):
+    if mode not in ["text", "npz"]:
+      raise Exception("Unknown prediction output mode: " + mode)
+    self.prefix = prefix
+    self.suffix = suffix
+    self.index2word = index2word
+    self.index2label = index2label
+    self.mode = mode
+    self.block_size = block_size
+
+    self.pending = []
+    self.num_pending = 0
+
+    if mode == "text":
+      self.word_table = lookup_table(index2word)
+      self.label_table = lookup_table(index2label)
+      self.files = {name: open(prefix + name + "_" + suffix + ".txt", "w")
+                    for name in FILE_NAMES}
+    else:
+      # All blocks, kept for close()
+      self.blocks = []
+
+    self.queue = None
+    self.error = None
+    if background and mode == "text":
+      # Bounded, so a slow disk holds the evaluation back instead of
+      # piling up blocks in memory
+      self.queue = queue.Queue(maxsize=4)
+      self.thread = threading.Thread(target=self._run)
+      self.thread.daemon = True
+      self.thread.start()
+
+  # sen, label: lists of lists or arrays, pred: array, all
+  # (batch size, sen len); beam_size_seq: beam sizes of the sentence, or
+  # None when not decoding adaptively
+  def write_batch(self, sen, label, pred, beam_size_seq=None):
+    sen = np.asarray(sen).reshape(-1)
+    label = np.asarray(label).reshape(-1)
+    pred = np.asarray(pred).reshape(-1)
+    assert len(sen) == len(label) and len(label) == len(pred)
+    if beam_size_seq is not None:
+      beam_size_seq = np.asarray(beam_size_seq, dtype=int)
+    self.pending.append((sen, label, pred, beam_size_seq))
+    self.num_pending += len(sen)
+    if self.num_pending >= self.block_size:
+      self.flush()
+
+  def flush(self):
+    if len(self.pending) == 0:
+      return
+    block = self.pending
+    self.pending = []
+    self.num_pending = 0
+
+    if self.mode == "npz":
+      self.blocks += block
+    elif self.queue is not None:
+      self._raise_error()
+      self.queue.put(block)
+    else:
+      self._write_block(block)
+
+  # After an error, the remaining blocks are dropped rather than left in the
+  # queue, so that flush() and close() cannot block on it
+  def _run(self):
+    while True:
+      block = self.queue.get()
+      if block is None:
+        break
+      if self.error is None:
+        try:
+          self._write_block(block)
+        except Exception as e:
+          self.error = e
+
+  def _raise_error(self):
+    if self.error is not None:
+      raise self.error
+
+  def _write_block(self, block):
+    sen = np.concatenate([batch[0] for batch in block])
+    label = np.concatenate([batch[1] for batch in block])
+    pred = np.concatenate([batch[2] for batch in block])
+    write_text_block(self.files, sen, label, pred,
+                     [batch[3] for batch in block if batch[3] is not None],
+                     self.word_table, self.label_table)
+
+  def close(self):
+    if self.mode == "npz":
+      self.flush()
+      save_npz(npz_filename(self.prefix, self.suffix), self.blocks,
+               self.index2word, self.index2label)
+      return
+    try:
+      self.flush()
+    finally:
+      if self.queue is not None:
+        self.queue.put(None)
+        self.thread.join()
+      for f in self.files.values():
+        f.close()
+    self._raise_error()
+
+
+def write_text_block(files, sen, label, pred, beam_size_seqs, word_table, label_table):
+  if len(sen) > 0:
+    files["sen"].write("\n".join(map(str, sen.tolist())) + "\n")
+    files["label"].write("\n".join(map(str, label.tolist())) + "\n")
+    files["pred"].write("\n".join(map(str, pred.tolist())) + "\n")
+    files["result_processed"].write(
+      "".join("%s %s %s\n" % line
+              for line in zip(word_table[sen], label_table[label], label_table[pred])))
+  for beam_size_seq in beam_size_seqs:
+    files["beam_size"].write(" ".join(map(str, beam_size_seq.tolist())) + "\n")
+
+
+def save_npz(filename, blocks, index2word, index2label):
+  empty = np.zeros(0, dtype=int)
+  beam_size_seqs = [batch[3] for batch in blocks if batch[3] is not None]
+  np.savez(filename,
+           sen=np.concatenate([batch[0] for batch in blocks] + [empty]),
+           label=np.concatenate([batch[1] for batch in blocks] + [empty]),
+           pred=np.concatenate([batch[2] for batch in blocks] + [empty]),
+           beam_size=np.concatenate(beam_size_seqs + [empty]),
+           beam_size_len=np.array([len(seq) for seq in beam_size_seqs], dtype=int),
+           index2word=np.array([index2word.get(i, "") for i in range(max(index2word) + 1)]),
+           index2label=np.array([index2label.get(i, "") for i in range(max(index2label) + 1)]))
+
+
+# Write the legacy text files of an npz prediction file
+def to_text(filename, prefix, suffix):
+  data = np.load(filename)
+  word_table = data["index2word"].astype(object)
+  label_table = data["index2label"].astype(object)
+  beam_size_ends = np.cumsum(data["beam_size_len"])
+  beam_size_seqs = np.split(data["beam_size"], beam_size_ends[:-1]) if len(beam_size_ends) else []
+
+  files = {name: open(prefix + name + "_" + suffix + ".txt", "w")
+           for name in FILE_NAMES}
+  write_text_block(files, data["sen"], data["label"], data["pred"],
+                   beam_size_seqs, word_table, label_table)
+  for f in files.values():
+    f.close()
+
+
+if __name__ == "__main__":
+  # Usage: python3 prediction_store.py <npz file> <prefix> <suffix>
+  to_text(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+import atexit
+import glob
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+import torch
+
+
+###############################
+# Opt-in timing spans for the hot paths (encode, decode_beam_step, top-k,
+# make_state, agent inference, backtracking, get_fscore, optimizer step,
+# result writing).
+#
+# Off by default. Turn it on with the ADABEAM_PROFILE environment variable
+# (set to the output directory), or with enable(output_dir), e.g. from
+# train_rl_de.py --profile. When off, span() returns a shared no-op context
+# and profiled functions only pay for one flag check.
+#
+# Each process aggregates count / total / max time and the peak memory of
+# each phase, and keeps up to MAX_EVENTS raw events. The RSS of a phase is the
+# largest current RSS (from /proc/self/statm) seen at the end of its spans;
+# its GPU memory is the peak torch allocated during its spans, whose counter
+# is reset when a span begins. The peaks of a nested span are passed on to
+# the enclosing one. dump() writes them as trace_<run>_<pid>.json (Chrome trace
+# format, load it in chrome://tracing or Perfetto) and
+# summary_<run>_<pid>.json, together with the lifetime peak memory of the
+# process. The main process dumps at exit; multiprocessing workers have to
+# call dump() themselves.
+#
+# <run> is chosen by the first enable() and passed to the workers through
+# ADABEAM_PROFILE_RUN, so merge() only combines the files of one run even if
+# the output directory holds older ones:
+#   python3 profiler.py <output dir> [<run>]
+# (default: the latest run of the directory).
+###############################
+
+MAX_EVENTS = 1000000
+
+_enabled = False
+_output_dir = None
+_run = None
+_pid = None
+_events = []
+_stats = {}
+# Open spans of each thread, innermost last, for the GPU peaks
+_local = threading.local()
+# /proc/self/statm of this process, or None where there is none
+_statm = None
+
+
+def _reset():
+  global _pid, _events, _stats, _local, _statm
+  _pid = os.getpid()
+  _events = []
+  _stats = {}
+  _local = threading.local()
+  # Opened again after a fork, as /proc/self is resolved when opening
+  if _statm is not None:
+    os.close(_statm)
+  try:
+    _statm = os.open("/proc/self/statm", os.O_RDONLY)
+  except OSError:
+    _statm = None
+
+
+# A forked worker starts its own trace instead of the parent's copy
+def _check_process():
+  if os.getpid() != _pid:
+    _reset()
+
+
+def enable(output_dir):
+  global _enabled, _output_dir, _run
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+  if not os.environ.get("ADABEAM_PROFILE_RUN"):
+    os.environ["ADABEAM_PROFILE_RUN"] = time.strftime("%Y%m%d%H%M%S") + "-" + str(os.getpid())
+  _run = os.environ["ADABEAM_PROFILE_RUN"]
+  _output_dir = output_dir
+  _enabled = True
+  _reset()
+
+
+def is_enabled():
+  return _enabled
+
+
+def _open_spans():
+  spans = getattr(_local, "spans", None)
+  if spans is None:
+    spans = _local.spans = []
+  return spans
+
+
+def _gpu_used():
+  return torch.cuda.is_available() and getattr(torch.cuda, "_initialized", False)
+
+
+def _reset_gpu_peak():
+  if hasattr(torch.cuda, "reset_peak_memory_stats"):
+    torch.cuda.reset_peak_memory_stats()
+  else:
+    torch.cuda.reset_max_memory_allocated()
+
+
+# Current resident memory of this process, in MB, or its peak so far where
+# /proc is not available (ru_maxrss is in KB on Linux)
+def _current_rss():
+  if _statm is not None:
+    resident_pages = int(os.pread(_statm, 128, 0).split()[1])
+    return resident_pages * resource.getpagesize() / (1024.0 * 1024.0)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Peak resident memory of this process so far, in MB, and the peak GPU
+# memory allocated by torch since the last reset if any
+def _peak_memory():
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  peak_gpu = 0
+  if _gpu_used():
+    peak_gpu = torch.cuda.max_memory_allocated() / (1024.0 * 1024.0)
+  return peak_rss, peak_gpu
+
+
+def _record(name, begin, end, peak_rss, peak_gpu):
+  duration = end - begin
+
+  stat = _stats.get(name)
+  if stat is None:
+    stat = _stats[name] = {"count": 0, "total": 0.0, "max": 0.0,
+                           "peak_rss_mb": 0.0, "peak_gpu_mb": 0.0}
+  stat["count"] += 1
+  stat["total"] += duration
+  stat["max"] = max(stat["max"], duration)
+  stat["peak_rss_mb"] = max(stat["peak_rss_mb"], peak_rss)
+  stat["peak_gpu_mb"] = max(stat["peak_gpu_mb"], peak_gpu)
+
+  if len(_events) < MAX_EVENTS:
+    _events.append((name, begin, duration, threading.get_ident()))
+
+
+class _Span():
+  __slots__ = ["name", "begin", "peak_rss", "peak_gpu"]
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    _check_process()
+    open_spans = _open_spans()
+    self.peak_rss = 0.0
+    self.peak_gpu = 0.0
+    if _gpu_used():
+      # The enclosing span keeps the peak so far before the reset
+      if open_spans:
+        open_spans[-1].peak_gpu = max(open_spans[-1].peak_gpu, _peak_memory()[1])
+      _reset_gpu_peak()
+    open_spans.append(self)
+    self.begin = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    end = time.time()
+    open_spans = _open_spans()
+    open_spans.pop()
+    self.peak_rss = max(self.peak_rss, _current_rss())
+    if _gpu_used():
+      self.peak_gpu = max(self.peak_gpu, _peak_memory()[1])
+    if open_spans:
+      parent = open_spans[-1]
+      parent.peak_rss = max(parent.peak_rss, self.peak_rss)
+      parent.peak_gpu = max(parent.peak_gpu, self.peak_gpu)
+    _record(self.name, self.begin, end, self.peak_rss, self.peak_gpu)
+    return False
+
+
+class _NullSpan():
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+  if not _enabled:
+    return _NULL_SPAN
+  return _Span(name)
+
+
+# Decorator timing every call of a function as the span name
+def profiled(name):
+  def decorator(function):
+    def wrapper(*args, **kwargs):
+      if not _enabled:
+        return function(*args, **kwargs)
+      with _Span(name):
+        return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+  return decorator
+
+
+def dump():
+  if not _enabled or os.getpid() != _pid:
+    return
+
+  trace_events = [{"name": name, "ph": "X", "pid": _pid, "tid": tid,
+                   "ts": begin * 1e6, "dur": duration * 1e6}
+                  for name, begin, duration, tid in _events]
+  prefix = os.path.join(_output_dir, "%s_" + _run + "_" + str(_pid) + ".json")
+  with open(prefix % "trace", "w") as f:
+    json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+  # The GPU counter is reset by the spans, so their peaks count as well
+  peak_rss, peak_gpu = _peak_memory()
+  peak_gpu = max([peak_gpu] + [stat["peak_gpu_mb"] for stat in _stats.values()])
+  with open(prefix % "summary", "w") as f:
+    json.dump({"phases": _stats, "peak_rss_mb": peak_rss, "peak_gpu_mb": peak_gpu},
+              f, indent=2, sort_keys=True)
+
+
+# Latest run with summary files in output_dir, or None
+def latest_run(output_dir):
+  latest = None
+  for filename in glob.glob(os.path.join(output_dir, "summary_*.json")):
+    match = re.match(r"summary_(.+)_\d+\.json$", os.path.basename(filename))
+    if match:
+      mtime = os.path.getmtime(filename)
+      if latest is None or mtime > latest[0]:
+        latest = (mtime, match.group(1))
+  return latest[1] if latest else None
+
+
+# Merge the per-process files of a run (default: this process's run if
+# profiling, else the latest one) of output_dir into trace.json and
+# summary.txt
+def merge(output_dir, run=None):
+  run = run or _run or latest_run(output_dir)
+
+  trace_events = []
+  for filename in sorted(glob.glob(os.path.join(output_dir, "trace_%s_*.json" % run))):
+    with open(filename) as f:
+      trace_events += json.load(f)["traceEvents"]
+  with open(os.path.join(output_dir, "trace.json"), "w") as f:
+    json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+  stats = {}
+  num_processes = 0
+  peak_rss, peak_gpu = 0.0, 0.0
+  for filename in sorted(glob.glob(os.path.join(output_dir, "summary_%s_*.json" % run))):
+    num_processes += 1
+    with open(filename) as f:
+      process = json.load(f)
+    peak_rss = max(peak_rss, process["peak_rss_mb"])
+    peak_gpu = max(peak_gpu, process["peak_gpu_mb"])
+    for name, stat in process["phases"].items():
+      merged = stats.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0,
+                                       "peak_rss_mb": 0.0, "peak_gpu_mb": 0.0})
+      merged["count"] += stat["count"]
+      merged["total"] += stat["total"]
+      for key in ["max", "peak_rss_mb", "peak_gpu_mb"]:
+        merged[key] = max(merged[key], stat[key])
+
+  summary = "# run %s, %d processes, largest process peak rss %.1f MB, peak gpu %.1f MB\n" % (
+    run, num_processes, peak_rss, peak_gpu)
+  summary += "phase\tcount\ttotal_s\tmean_ms\tmax_ms\tpeak_rss_mb\tpeak_gpu_mb\n"
+  for name, stat in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+    summary += "%s\t%d\t%.3f\t%.4f\t%.4f\t%.1f\t%.1f\n" % (
+      name, stat["count"], stat["total"],
+      1000 * stat["total"] / max(stat["count"], 1), 1000 * stat["max"],
+      stat["peak_rss_mb"], stat["peak_gpu_mb"])
+  with open(os.path.join(output_dir, "summary.txt"), "w") as f:
+    f.write(summary)
+
+  return summary
+
+
+if os.environ.get("ADABEAM_PROFILE"):
+  enable(os.environ["ADABEAM_PROFILE"])
+
+atexit.register(dump)
+
+
+if __name__ == "__main__":
+  # Usage: python3 profiler.py <output dir> [<run>]
+  print(merge(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
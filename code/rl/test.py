@@ -1,9 +1,9 @@
-import itertools
 import os
 import torch
 import torch.nn.functional as F
 
 from model import AdaptiveActorCritic
+from prediction_store import PredictionWriter
 from torch.autograd import Variable
 
 
@@ -37,18 +37,11 @@ def test_adaptive(rank,
 
     desc = result_path + '_process_' + args.name + '_' + str(epoch) + '_'
     if result_path:
-      f_sen = open(os.path.join(args.logdir,
-                                desc + "sen_" + suffix + ".txt"), 'w')
-      f_pred = open(os.path.join(args.logdir,
-                                 desc + "pred_" + suffix + ".txt"), 'w')
-      f_label = open(os.path.join(args.logdir,
-                                  desc + "label_" + suffix + ".txt"), 'w')
-      f_result_processed = \
-        open(os.path.join(args.logdir,
-                          desc + "result_processed_" + suffix + ".txt"), 'w')
-      f_beam_size = \
-        open(os.path.join(args.logdir,
-                          desc + 'beam_size_' + suffix + ".txt"), 'w')
+      # Buffered, text or npz (see prediction_store.py)
+      prediction_writer = PredictionWriter(os.path.join(args.logdir, desc),
+                                           suffix, index2word, index2label,
+                                           mode=getattr(args, "result_mode", "text"),
+                                           background=getattr(args, "background_writer", False))
 
     # for calculating F-SCORE
     true_pos_count = 0
@@ -147,43 +140,10 @@ def test_adaptive(rank,
 
       # Write result into file
       if result_path:
-        if machine.gpu:
-          label_pred_seq = label_pred_seq.cpu()
-
-        label_pred_seq = label_pred_seq.data.numpy().tolist()
-
         # Here label_pred_seq.shape = (batch size, sen len)
-
-        # sen, label, label_pred_seq are list of lists,
-        # thus I would like to flatten them for iterating easier
-
-        sen = list(itertools.chain.from_iterable(sen))
-        label = list(itertools.chain.from_iterable(label))
-        label_pred_seq = list(itertools.chain.from_iterable(label_pred_seq))
-        assert len(sen) == len(label) and len(label) == len(label_pred_seq)
-        for i in range(len(sen)):
-          f_sen.write(str(sen[i]) + '\n')
-          f_label.write(str(label[i]) + '\n')
-          f_pred.write(str(label_pred_seq[i]) + '\n')
-
-          # clean version (does not print <PAD>, print a newline instead of <EOS>)
-          # if sen[i] != 0 and sen[i] != 2: # not <PAD> and not <EOS>
-          # if sen[i] != 0: # not <PAD>
-
-          result_sen = index2word[sen[i]]
-          result_label = index2label[label[i]]
-          result_pred = index2label[label_pred_seq[i]]
-          f_result_processed.write(
-            "%s %s %s\n" % (result_sen, result_label, result_pred))
-          f_sen.flush()
-          f_label.flush()
-          f_pred.flush()
-          f_result_processed.flush()
-
-        if decode_method == "adaptive":
-          beam_size_seq_str = ' '.join(map(str, sen_beam_size_seq))
-          f_beam_size.write(beam_size_seq_str + '\n')
-          f_beam_size.flush()
+        prediction_writer.write_batch(
+          sen, label, label_pred_seq.data.cpu().numpy(),
+          sen_beam_size_seq if decode_method == "adaptive" else None)
 
     # End for batch_idx
 
@@ -204,11 +164,7 @@ def test_adaptive(rank,
     fscore = fscore * 100
 
     if result_path:
-      f_sen.close()
-      f_pred.close()
-      f_label.close()
-      f_result_processed.close()
-      f_beam_size.close()
+      prediction_writer.close()
 
 
     avg_beam_sizes = sum(beam_size_seqs) / float(len(beam_size_seqs))
@@ -1,4 +1,3 @@
-import itertools
 import numpy as np
 import os
 import time
@@ -6,18 +5,34 @@ import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
+from decode_cost import write_sentence_costs, write_cost_summary
 from model import AdaptiveActorCritic
+from prediction_store import PredictionWriter
+import profiler
 from torch.autograd import Variable
 
 
+# Always re-point the shared gradients at this worker's gradients.
+# Returning early once a shared gradient exists (as in the usual A3C recipe)
+# means a worker keeps stepping with whatever gradient object it saw first,
+# so updates from concurrent workers can be silently dropped.
 def ensure_shared_grads(model, shared_model):
   for param, shared_param in zip(model.parameters(),
                                  shared_model.parameters()):
-    if shared_param.grad is not None:
-      return
     shared_param._grad = param.grad
 
 
+# Copy the shared parameters into the worker's model without taking a lock.
+# Workers update the shared model Hogwild-style anyway, so a read that races
+# with an optimizer step only yields a slightly stale snapshot. This also
+# avoids building a full state_dict (an OrderedDict of detached tensors)
+# for every sync.
+def sync_with_shared_model(model, shared_model):
+  for param, shared_param in zip(model.parameters(),
+                                 shared_model.parameters()):
+    param.data.copy_(shared_param.data)
+
+
 def train_adaptive(rank,
                    machine,
                    max_beam_size,
@@ -29,13 +44,30 @@ def train_adaptive(rank,
                    suffix, decode_method, beam_size,
                    reward_coef_fscore, reward_coef_beam_size,
                    f_score_index_begin,
-                   args):
+                   args,
+                   version=None,
+                   checkpoint_manager=None):
   torch.manual_seed(123 + rank)
 
+  # How many sentences a worker decodes between two parameter syncs,
+  # and how many time steps it counts locally before adding them to the
+  # shared counter. Older scripts do not define these arguments, in which
+  # case we keep the original behavior (sync every sentence).
+  sync_interval = getattr(args, "sync_interval", 1)
+  counter_interval = getattr(args, "counter_interval", 1)
+
+  # version is a lock-free shared integer bumped after every optimizer step.
+  # A worker only copies the shared parameters when the version it last
+  # synced with is out of date. If it is not passed in, always sync.
+  synced_version = -1
+  sentences_since_sync = sync_interval
+  local_steps = 0
+
   logfile = open(os.path.join(args.logdir, "log_" + str(rank) + ".txt"), "w+")
 
   # create adaptive model
-  model = AdaptiveActorCritic(max_beam_size=max_beam_size, action_space=3)
+  model = AdaptiveActorCritic(max_beam_size=max_beam_size, action_space=3,
+                              state_type=machine.state_type)
   # If a shared_optimizer is not passed in
   if optimizer is None:
     optimizer = optim.Adam(shared_model.parameters(), lr=args.lr)
@@ -45,110 +77,157 @@ def train_adaptive(rank,
 
   batch_num = len(data_X)
 
-  for epoch in range(0, args.n_epochs):
-    reward_list = []
-
-    # shuffle
-    batch_idx_list = range(batch_num)
-    batch_idx_list = np.random.permutation(batch_idx_list)
-
-    time_begin = time.time()
-    for batch_idx in batch_idx_list:
-      sen = data_X[batch_idx]
-      label = data_Y[batch_idx]
-
-      current_batch_size = len(sen)
-      current_sen_len = len(sen[0])
-
-      # DEBUG
-      # print(batch_idx, current_sen_len)
-      if current_sen_len < 3:  # ignore sentence having tiny length
-        continue
-
-      sen_var = Variable(torch.LongTensor(sen))
-      label_var = Variable(torch.LongTensor(label))
-
-      if machine.gpu:
-        sen_var = sen_var.cuda()
-        label_var = label_var.cuda()
-
-      # Initialize the hidden and cell states
-      # The axes semantics are
-      # (num_layers * num_directions, batch_size, hidden_size)
-      # So 1 for single-directional LSTM encoder,
-      # 2 for bi-directional LSTM encoder.
-      init_enc_hidden = Variable(
-        torch.zeros((2, current_batch_size, machine.hidden_dim)))
-      init_enc_cell = Variable(
-        torch.zeros((2, current_batch_size, machine.hidden_dim)))
-
-      if machine.gpu:
-        init_enc_hidden = init_enc_hidden.cuda()
-        init_enc_cell = init_enc_cell.cuda()
-
-      enc_hidden_seq, (enc_hidden_out, enc_cell_out) = machine.encode(sen_var,
-                                                                   init_enc_hidden,
-                                                                   init_enc_cell)
-
-      # The semantics of enc_hidden_out is (num_layers * num_directions,
-      # batch, hidden_size), and it is "tensor containing the hidden state
-      # for t = seq_len".
-      #
-      # Here we use a linear layer to transform the two-directions of the dec_hidden_out's into a single hidden_dim vector, to use as the input of the decoder
-      init_dec_hidden = machine.enc2dec_hidden(
-        torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
-      init_dec_cell = machine.enc2dec_cell(
-        torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
-
-      # ===================================
-      if decode_method == "adaptive":
-        # the input argument "beam_size" serves as initial_beam_size here
-        # TODO: implement this here
-        label_pred_seq, accum_logP_pred_seq, logP_pred_seq, \
-        attention_pred_seq, episode, sen_beam_size_seq, total_reward = \
-          decode_one_sentence_adaptive_rl(machine,
-          current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq,
-          beam_size, max_beam_size, model, shared_model, reward_coef_fscore,
-          reward_coef_beam_size, label_var, f_score_index_begin, counter, lock,
-          optimizer, args)
-
-        reward_list.append(total_reward)
-
+  # The checkpoint writer thread is stopped in any case, or a failed worker
+  # would never exit
+  try:
+    for epoch in range(0, args.n_epochs):
+      reward_list = []
+
+      # shuffle
+      batch_idx_list = range(batch_num)
+      batch_idx_list = np.random.permutation(batch_idx_list)
+
+      time_begin = time.time()
+      for batch_idx in batch_idx_list:
+        sen = data_X[batch_idx]
+        label = data_Y[batch_idx]
+
+        current_batch_size = len(sen)
+        current_sen_len = len(sen[0])
+
+        # DEBUG
+        # print(batch_idx, current_sen_len)
+        if current_sen_len < 3:  # ignore sentence having tiny length
+          continue
+
+        sen_var = Variable(torch.LongTensor(sen))
+        label_var = Variable(torch.LongTensor(label))
+
+        if machine.gpu:
+          sen_var = sen_var.cuda()
+          label_var = label_var.cuda()
+
+        # Initialize the hidden and cell states
+        # The axes semantics are
+        # (num_layers * num_directions, batch_size, hidden_size)
+        # So 1 for single-directional LSTM encoder,
+        # 2 for bi-directional LSTM encoder.
+        init_enc_hidden = Variable(
+          torch.zeros((2, current_batch_size, machine.hidden_dim)))
+        init_enc_cell = Variable(
+          torch.zeros((2, current_batch_size, machine.hidden_dim)))
+
+        if machine.gpu:
+          init_enc_hidden = init_enc_hidden.cuda()
+          init_enc_cell = init_enc_cell.cuda()
+
+        enc_hidden_seq, (enc_hidden_out, enc_cell_out) = machine.encode(sen_var,
+                                                                     init_enc_hidden,
+                                                                     init_enc_cell)
+
+        # The semantics of enc_hidden_out is (num_layers * num_directions,
+        # batch, hidden_size), and it is "tensor containing the hidden state
+        # for t = seq_len".
+        #
+        # Here we use a linear layer to transform the two-directions of the dec_hidden_out's into a single hidden_dim vector, to use as the input of the decoder
+        init_dec_hidden = machine.enc2dec_hidden(
+          torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
+        init_dec_cell = machine.enc2dec_cell(
+          torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
+
+        # -----------------
+        # Sync params with the shared model (periodically, lock-free)
+        if sentences_since_sync >= sync_interval:
+          if version is None or version.value != synced_version:
+            if version is not None:
+              # Read the version before copying, so that a step landing
+              # during the copy triggers another sync next time
+              synced_version = version.value
+            sync_with_shared_model(model, shared_model)
+          sentences_since_sync = 0
+        sentences_since_sync += 1
+        # -----------------
+
+        # ===================================
+        if decode_method == "adaptive":
+          # the input argument "beam_size" serves as initial_beam_size here
+          # TODO: implement this here
+          label_pred_seq, accum_logP_pred_seq, logP_pred_seq, \
+          attention_pred_seq, episode, sen_beam_size_seq, total_reward = \
+            decode_one_sentence_adaptive_rl(machine,
+            current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq,
+            beam_size, max_beam_size, model, shared_model, reward_coef_fscore,
+            reward_coef_beam_size, label_var, f_score_index_begin,
+            optimizer, args)
+
+          reward_list.append(total_reward)
+
+          if version is not None:
+            # Not atomic on purpose: a lost increment only delays a sync
+            version.value += 1
+
+          # One agent step per time step t = 1, ..., seq_len - 1.
+          # Steps are counted per worker and only added to the shared
+          # counter every counter_interval steps.
+          local_steps += current_sen_len - 1
+          if local_steps >= counter_interval:
+            with counter.get_lock():
+              counter.value += local_steps
+            local_steps = 0
+
+        else:
+          raise Exception("Not implemented!")
+        # ===================================
+
+        # update beam seq
+        #beam_size_seqs.append(sen_beam_size_seq)
+
+        ### Debugging...
+        # print("input sentence =", sen)
+        # print("true label =", label)
+        # print("predicted label =", label_pred_seq)
+        # print("episode =", episode)
+      # End for batch_idx
+      time_end = time.time()
+      time_used = time_end - time_begin
+
+      # Flush the remaining local steps at the end of each epoch
+      if local_steps > 0:
+        with counter.get_lock():
+          counter.value += local_steps
+        local_steps = 0
+
+      reward_list = np.array(reward_list)
+      reward_mean = np.mean(reward_list)
+      reward_std = np.std(reward_list)
+      log_msg = "%d\t%f\t%f\t%f" % (epoch, reward_mean, reward_std, time_used)
+      print(log_msg)
+      #print(log_msg, file=logfile, flush=True)
+      logfile.write(log_msg + '\n')
+      logfile.flush() 
+
+      # Save shared model and (supposedly) shared optimizer
+      if checkpoint_manager is not None:
+        # In the background, once per epoch over all workers
+        checkpoint_manager.save(epoch,
+                                {'epoch': epoch,
+                                 'state_dict': shared_model.state_dict(),
+                                 'optimizer' : optimizer.state_dict()})
       else:
-        raise Exception("Not implemented!")
-      # ===================================
-
-      # update beam seq
-      #beam_size_seqs.append(sen_beam_size_seq)
-
-      ### Debugging...
-      # print("input sentence =", sen)
-      # print("true label =", label)
-      # print("predicted label =", label_pred_seq)
-      # print("episode =", episode)
-    # End for batch_idx
-    time_end = time.time()
-    time_used = time_end - time_begin
-
-    reward_list = np.array(reward_list)
-    reward_mean = np.mean(reward_list)
-    reward_std = np.std(reward_list)
-    log_msg = "%d\t%f\t%f\t%f" % (epoch, reward_mean, reward_std, time_used)
-    print(log_msg)
-    #print(log_msg, file=logfile, flush=True)
-    logfile.write(log_msg + '\n')
-    logfile.flush() 
-
-    # Save shared model and (supposedly) shared optimizer
-    # Purposely possibly over-writing other threads' model for the same epoch
-    checkpoint_filename = os.path.join(args.logdir, "ckpt_" + str(epoch) + ".pth")
-    with lock:
-      torch.save({'epoch': epoch,
-                  'state_dict': shared_model.state_dict(),
-                  'optimizer' : optimizer.state_dict()},
-                  checkpoint_filename)
-  # End for epoch
+        # Purposely possibly over-writing other threads' model for the same epoch
+        checkpoint_filename = os.path.join(args.logdir, "ckpt_" + str(epoch) + ".pth")
+        with lock:
+          torch.save({'epoch': epoch,
+                      'state_dict': shared_model.state_dict(),
+                      'optimizer' : optimizer.state_dict()},
+                      checkpoint_filename)
+    # End for epoch
+  finally:
+    if checkpoint_manager is not None:
+      checkpoint_manager.close()
   logfile.close()
+  # Workers do not run atexit handlers
+  profiler.dump()
 
 
 # Update the thread-specific model once at each sentence
@@ -158,7 +237,7 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
                                     model, shared_model,
                                     reward_coef_fscore, reward_coef_beam_size,
                                     label_true_seq, f_score_index_begin,
-                                    counter, lock, optimizer,
+                                    optimizer,
                                     args):
   # Currently, batch size can only be 1
   batch_size = 1
@@ -233,10 +312,8 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
     # the shape (batch size, 1, input seq len)
     attention_beam = attention_beam.permute(1, 0, 2)
 
-  # score_out.shape => (batch size, |V^y|)
-  score_out = machine.hidden2score(dec_hidden_out) \
-    .view(batch_size, machine.label_size)
-  logP_out = machine.score2logP(score_out).view(batch_size, machine.label_size)
+  # logP_out.shape => (batch size, |V^y|)
+  logP_out = machine.output_logP(dec_hidden_out, 0)
 
   # Initial step, accumulated logP is the same as logP
   accum_logP_out = logP_out
@@ -257,9 +334,15 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
   # Just for code consistency (about reward calculation)
   cur_beam_size_in = 1
 
-  # Just for code consistency (about experience tuple)
-  cur_state = machine.make_state(accum_logP_matrix, logP_matrix, 1,
-                                 max_beam_size)
+  # The agent is queried at t = 1, then again after machine.action_repeat
+  # time steps (or earlier when the score gap trigger fires), see
+  # ner.query_agent. The beam size is held in between.
+  steps_since_query = getattr(machine, "action_repeat", 1)
+  gap_at_query = None
+
+  # The decision in effect, as [state, action, reward summed over the time
+  # steps it was held]. It becomes an experience tuple at the next query.
+  decision = None
   action = None
 
   # All beta^{t=0, b} are actually 0
@@ -271,8 +354,9 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
   beam_size_seq = []
   beam_size = initial_beam_size
   beam_size_seq.append(beam_size)
-  accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size,
-                                           dim=1)
+  with profiler.span("topk"):
+    accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size,
+                                             dim=1)
 
   beta_beam = torch.floor(index_beam.float() / machine.label_size).long()
   y_beam = torch.remainder(index_beam, machine.label_size)
@@ -290,14 +374,17 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
     1, batch_size, y_seq, beta_seq, attention_seq, logP_seq, accum_logP_seq)
 
   # -----------------
-  # Sync params with the shared model
-  with lock:
-    model.load_state_dict(shared_model.state_dict())
+  # Params are synced with the shared model by the caller (train_adaptive)
 
+  # One entry per agent decision. A decision held for k time steps gets the
+  # discounted sum of its k rewards, and discounts holds gamma^k to
+  # bootstrap from the value of the next decision (semi-MDP returns).
   values = []
   log_probs = []
   rewards = []
+  discounts = []
   entropies = []
+  total_reward = 0
   # -----------------
 
   # t = 1, 2, ..., (T_y - 1 == seq_len - 1)
@@ -323,51 +410,60 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
     # We delay the improvement to the future work.
     #
     # Note that this state is actually the output state at t
-    state = machine.make_state(accum_logP_matrix, logP_matrix,
-                               beam_size, max_beam_size)
-
-    # For experience tuple
-    prev_state = cur_state
-    cur_state = state
-    prev_action = action
+    # (the last one is also needed to close the last experience tuple)
+    query, gap = machine.query_agent(accum_logP_matrix, steps_since_query,
+                                     gap_at_query)
+    if query or t == seq_len - 1:
+      state = machine.make_state(accum_logP_matrix, logP_matrix,
+                                 beam_size, max_beam_size, t, seq_len)
 
     # For reward calculation
     prev_beam_size_in = cur_beam_size_in
     cur_beam_size_in = beam_size
 
-    # policy network showtime
-    value, logit = model(state)
-    prob = F.softmax(logit, dim=-1)
-    log_prob = F.log_softmax(logit, dim=-1)
+    # The decision the reward r_{t-1} (computed below) goes to
+    prev_decision_idx = len(rewards) - 1
 
+    if query:
+      # policy network showtime
+      with profiler.span("agent"):
+        value, logit = model(state)
+      prob = F.softmax(logit, dim=-1)
+      log_prob = F.log_softmax(logit, dim=-1)
 
-    # TODO: for naive MLP policy network only
-    prob = prob.view(1, -1)
-    log_prob = log_prob.view(1, -1)
 
-    entropy = -(log_prob * prob).sum(1, keepdim=True)
-    if t <= seq_len - 2:
-      entropies.append(entropy)
+      # TODO: for naive MLP policy network only
+      prob = prob.view(1, -1)
+      log_prob = log_prob.view(1, -1)
 
-    action = prob.multinomial().data
-    log_prob = log_prob.gather(1, Variable(action))
+      entropy = -(log_prob * prob).sum(1, keepdim=True)
 
-    # state, reward, done, _ = env.step(action.numpy())
-    # done = done or episode_length >= args.max_episode_length
-    # reward = max(min(reward, 1), -1)
+      action = prob.multinomial().data
+      log_prob = log_prob.gather(1, Variable(action))
 
-    with lock:
-      counter.value += 1
+      # state, reward, done, _ = env.step(action.numpy())
+      # done = done or episode_length >= args.max_episode_length
+      # reward = max(min(reward, 1), -1)
 
-    # populate data
-    if t <= seq_len - 2:
-      values.append(value)
-      log_probs.append(log_prob)
-      action_seq.append(action)
+      # populate data
+      if t <= seq_len - 2:
+        entropies.append(entropy)
+        values.append(value)
+        log_probs.append(log_prob)
+        action_seq.append(action)
+        rewards.append(0)
+        discounts.append(1)
+
+      # print(type(action))
+      # TODO: review this
+      action = action.numpy()[0]
 
-    # print(type(action))
-    # TODO: review this
-    action = action.numpy()[0]
+      steps_since_query = 0
+      gap_at_query = gap
+    else:
+      # Hold the beam size
+      action = 1
+    steps_since_query += 1
 
     # update beam size w.r.t to the action chosen
     if action == 0 and beam_size > 1:
@@ -378,8 +474,9 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
     if t <= seq_len - 2:
       beam_size_seq.append(beam_size)
 
-    accum_logP_beam, index_beam = \
-      torch.topk(accum_logP_matrix, beam_size, dim=1)
+    with profiler.span("topk"):
+      accum_logP_beam, index_beam = \
+        torch.topk(accum_logP_matrix, beam_size, dim=1)
 
     beta_beam = torch.floor(
       index_beam.float() / machine.label_size).long()
@@ -400,16 +497,26 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
     cur_fscore = machine.get_fscore(label_pred_seq, label_true_seq,
                                     f_score_index_begin)
 
-    # If t >= 2, compute the reward,
-    # and generate the experience tuple ( s_{t-1}, a_{t-1}, r_{t-1}, s_t )
+    # If t >= 2, compute the reward r_{t-1},
+    # which goes to the decision in effect at t - 1
     # reward = None
     if t >= 2:
       reward = machine.get_reward(cur_fscore, fscore, cur_beam_size_in,
                                   prev_beam_size_in, reward_coef_fscore,
                                   reward_coef_beam_size)
-      experience_tuple = (prev_state, prev_action, reward, cur_state)
-      episode.append(experience_tuple)
-      rewards.append(reward)
+      rewards[prev_decision_idx] += discounts[prev_decision_idx] * reward
+      discounts[prev_decision_idx] *= args.gamma
+      decision[2] += reward
+      total_reward += reward
+
+    # At a query (and at the end), generate the experience tuple
+    # ( s_{t'}, a_{t'}, r_{t'} + ... + r_{t-1}, s_t ) of the decision taken
+    # at t' and held until now
+    if query or t == seq_len - 1:
+      if decision is not None:
+        experience_tuple = (decision[0], decision[1], decision[2], state)
+        episode.append(experience_tuple)
+      decision = [state, action, 0] if t < seq_len - 1 else None
 
     fscore = cur_fscore
   # End for t
@@ -417,8 +524,6 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
   # print("rewards: {}".format(rewards))
   # print("actions: {}".format(action_seq))
 
-  total_reward = sum(rewards)
-
   ################
   # backprop now with actor-critic
   R = torch.zeros(1, 1)
@@ -430,30 +535,37 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
   # This is just a coding trick
   values.append(Variable(torch.zeros(1, 1)))
 
+  # discounts[i] is gamma^k for a decision held k time steps,
+  # i.e. just gamma without action repeat
   for i in reversed(range(len(rewards))):
-    R = args.gamma * R + rewards[i]
+    R = discounts[i] * R + rewards[i]
     advantage = R - values[i]
     value_loss = value_loss + 0.5 * advantage.pow(2)
 
     # Generalized Advantage Estimation
     # Here is where the coding trick is used
-    delta_t = rewards[i] + args.gamma * \
+    delta_t = rewards[i] + discounts[i] * \
                            values[i + 1].data - values[i].data
-    gae = gae * args.gamma * args.tau + delta_t
+    gae = gae * discounts[i] * args.tau + delta_t
 
     policy_loss = policy_loss - \
                   log_probs[i] * Variable(gae) - args.entropy_coef * \
                                                  entropies[i]
   # print(policy_loss)
 
+  # The shared gradients point at the local ones (ensure_shared_grads),
+  # but clear the local model explicitly as well
   optimizer.zero_grad()
+  model.zero_grad()
 
-  (policy_loss + args.value_loss_coef * value_loss).backward()
+  with profiler.span("backward"):
+    (policy_loss + args.value_loss_coef * value_loss).backward()
   torch.nn.utils.clip_grad_norm(model.parameters(), args.max_grad_norm)
 
   ensure_shared_grads(model, shared_model)
   # Do I need to do the update with lock?
-  optimizer.step()
+  with profiler.span("optimizer_step"):
+    optimizer.step()
 
   return label_pred_seq, accum_logP_pred_seq, logP_pred_seq, \
          attention_pred_seq, episode, beam_size_seq, total_reward
@@ -471,22 +583,20 @@ def eval_adaptive(machine,
   batch_num = len(data_X)
 
   if write_result:
-    f_sen = open(os.path.join(args.logdir,
-                              "sen_" + suffix + ".txt"), 'w')
-    f_pred = open(os.path.join(args.logdir,
-                               "pred_" + suffix + ".txt"), 'w')
-    f_label = open(os.path.join(args.logdir,
-                                "label_" + suffix + ".txt"), 'w')
-    f_result_processed = \
-      open(os.path.join(args.logdir,
-                        "result_processed_" + suffix + ".txt"), 'w')
-    f_beam_size = \
-      open(os.path.join(args.logdir,
-                        "beam_size_" + suffix + ".txt"), 'w')
+    # Buffered, text or npz (see prediction_store.py)
+    prediction_writer = PredictionWriter(os.path.join(args.logdir, ""),
+                                         suffix, index2word, index2label,
+                                         mode=getattr(args, "result_mode", "text"),
+                                         background=getattr(args, "background_writer", False))
   # End if write_result
 
   beam_size_seqs = []
 
+  # Per-batch decoding cost, with the batch shapes (see decode_cost.py)
+  sen_lens = []
+  batch_sizes = []
+  sentence_costs = []
+
   true_pos_count = 0
   pred_pos_count = 0
   true_pred_pos_count = 0
@@ -501,6 +611,9 @@ def eval_adaptive(machine,
     current_batch_size = len(sen)
     current_sen_len = len(sen[0])
 
+    machine.decode_cost.reset()
+    sen_time_begin = time.time()
+
     sen_var = Variable(torch.LongTensor(sen))
     label_var = Variable(torch.LongTensor(label))
 
@@ -554,6 +667,11 @@ def eval_adaptive(machine,
       raise Exception("Not implemented!")
     # ===================================
 
+    machine.decode_cost.time = time.time() - sen_time_begin
+    sen_lens.append(current_sen_len)
+    batch_sizes.append(current_batch_size)
+    sentence_costs.append(machine.decode_cost.as_list())
+
     # update beam seq
     beam_size_seqs.append(sen_beam_size_seq)
 
@@ -575,44 +693,10 @@ def eval_adaptive(machine,
 
     # Write result into file
     if write_result:
-      if machine.gpu:
-        label_pred_seq = label_pred_seq.cpu()
-
-      label_pred_seq = label_pred_seq.data.numpy().tolist()
-
       # Here label_pred_seq.shape = (batch size, sen len)
-
-      # sen, label, label_pred_seq are list of lists,
-      # thus I would like to flatten them for iterating easier
-
-      sen = list(itertools.chain.from_iterable(sen))
-      label = list(itertools.chain.from_iterable(label))
-      label_pred_seq = list(itertools.chain.from_iterable(label_pred_seq))
-      assert len(sen) == len(label) and len(label) == len(label_pred_seq)
-      for i in range(len(sen)):
-        f_sen.write(str(sen[i]) + '\n')
-        f_label.write(str(label[i]) + '\n')
-        f_pred.write(str(label_pred_seq[i]) + '\n')
-
-        # clean version (does not print <PAD>, print a newline instead of <EOS>)
-        # if sen[i] != 0 and sen[i] != 2: # not <PAD> and not <EOS>
-        # if sen[i] != 0: # not <PAD>
-
-        result_sen = index2word[sen[i]]
-        result_label = index2label[label[i]]
-        result_pred = index2label[label_pred_seq[i]]
-        f_result_processed.write(
-          "%s %s %s\n" % (result_sen, result_label, result_pred))
-
-        f_sen.flush()
-        f_label.flush()
-        f_pred.flush()
-        f_result_processed.flush()
-
-      if decode_method == "adaptive":
-        beam_size_seq_str = ' '.join(map(str, sen_beam_size_seq))
-        f_beam_size.write(beam_size_seq_str + '\n')
-        f_beam_size.flush()
+      prediction_writer.write_batch(
+        sen, label, label_pred_seq.data.cpu().numpy(),
+        sen_beam_size_seq if decode_method == "adaptive" else None)
   # End for batch_idx
   time_end = time.time()
   time_used = time_end - time_begin
@@ -639,11 +723,19 @@ def eval_adaptive(machine,
   avg_beam_size = sum(avg_beam_sizes) / len(avg_beam_sizes)
 
   if write_result:
-    f_sen.close()
-    f_pred.close()
-    f_label.close()
-    f_result_processed.close()
-    f_beam_size.close()
+    write_sentence_costs(os.path.join(args.logdir, "cost_" + suffix + ".txt"),
+                         sen_lens, batch_sizes, sentence_costs)
+    config = [("decode_method", decode_method),
+              ("beam_size", beam_size),
+              ("max_beam_size", max_beam_size),
+              ("agent", type(model).__name__),
+              ("state_type", machine.state_type),
+              ("action_repeat", machine.action_repeat)]
+    write_cost_summary(os.path.join(args.logdir,
+                                    "cost_summary_" + suffix + ".txt"),
+                       config, fscore, sen_lens, batch_sizes, sentence_costs)
+
+    prediction_writer.close()
 
   return fscore, total_beam_number_in_dataset, avg_beam_size, time_used
 
@@ -728,10 +820,8 @@ def decode_one_sentence_adaptive_rl_eval( \
     # the shape (batch size, 1, input seq len)
     attention_beam = attention_beam.permute(1, 0, 2)
 
-  # score_out.shape => (batch size, |V^y|)
-  score_out = machine.hidden2score(dec_hidden_out) \
-    .view(batch_size, machine.label_size)
-  logP_out = machine.score2logP(score_out).view(batch_size, machine.label_size)
+  # logP_out.shape => (batch size, |V^y|)
+  logP_out = machine.output_logP(dec_hidden_out, 0)
 
   # Initial step, accumulated logP is the same as logP
   accum_logP_out = logP_out
@@ -749,12 +839,16 @@ def decode_one_sentence_adaptive_rl_eval( \
   logP_matrix = torch.cat(logP_out_list, dim=1)
   accum_logP_matrix = torch.cat(accum_logP_out_list, dim=1)
 
+  # The LSTMCell call at t = 0
+  machine.decode_cost.lstm_cell += 1
+  machine.decode_cost.candidates += machine.label_size
+
   # Just for code consistency (about reward calculation)
   cur_beam_size_in = 1
 
-  # Just for code consistency (about experience tuple)
-  cur_state = machine.make_state(accum_logP_matrix, logP_matrix, 1,
-                                 max_beam_size)
+  # See decode_one_sentence_adaptive_rl
+  steps_since_query = getattr(machine, "action_repeat", 1)
+  gap_at_query = None
   action = None
 
   # All beta^{t=0, b} are actually 0
@@ -766,8 +860,10 @@ def decode_one_sentence_adaptive_rl_eval( \
   beam_size_seq = []
   beam_size = initial_beam_size
   beam_size_seq.append(beam_size)
-  accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size,
-                                           dim=1)
+  with profiler.span("topk"):
+    accum_logP_beam, index_beam = torch.topk(accum_logP_matrix, beam_size,
+                                             dim=1)
+  machine.decode_cost.topk += 1
 
   beta_beam = torch.floor(index_beam.float() / machine.label_size).long()
   y_beam = torch.remainder(index_beam, machine.label_size)
@@ -807,41 +903,49 @@ def decode_one_sentence_adaptive_rl_eval( \
     # We delay the improvement to the future work.
     #
     # Note that this state is actually the output state at t
-    state = machine.make_state(accum_logP_matrix, logP_matrix,
-                               beam_size, max_beam_size)
-
-    # For experience tuple
-    prev_state = cur_state
-    cur_state = state
-    prev_action = action
+    query, gap = machine.query_agent(accum_logP_matrix, steps_since_query,
+                                     gap_at_query)
 
     # For reward calculation
     prev_beam_size_in = cur_beam_size_in
     cur_beam_size_in = beam_size
 
-    # policy network showtime
-    _, logit = model(state)
-    prob = F.softmax(logit, dim=-1)
+    if query:
+      state = machine.make_state(accum_logP_matrix, logP_matrix,
+                                 beam_size, max_beam_size, t, seq_len)
 
-    # TODO: for naive MLP policy network only
-    prob = prob.view(1, -1)
+      # policy network showtime
+      with profiler.span("agent"):
+        _, logit = model(state)
+      machine.decode_cost.agent_calls += 1
+      prob = F.softmax(logit, dim=-1)
 
-    # action = prob.multinomial().data
+      # TODO: for naive MLP policy network only
+      prob = prob.view(1, -1)
 
-    # deterministic prediction
-    action = prob.max(1, keepdim=True)[1].data
+      # action = prob.multinomial().data
 
-    # state, reward, done, _ = env.step(action.numpy())
-    # done = done or episode_length >= args.max_episode_length
-    # reward = max(min(reward, 1), -1)
+      # deterministic prediction
+      action = prob.max(1, keepdim=True)[1].data
 
-    # populate data
-    #if t <= seq_len - 2:
-    #  action_seq.append(action)
+      # state, reward, done, _ = env.step(action.numpy())
+      # done = done or episode_length >= args.max_episode_length
+      # reward = max(min(reward, 1), -1)
 
-    # print(type(action))
-    # TODO: review this
-    action = action.numpy()[0]
+      # populate data
+      #if t <= seq_len - 2:
+      #  action_seq.append(action)
+
+      # print(type(action))
+      # TODO: review this
+      action = action.numpy()[0]
+
+      steps_since_query = 0
+      gap_at_query = gap
+    else:
+      # Hold the beam size
+      action = 1
+    steps_since_query += 1
     if t <= seq_len - 2:
       action_seq.append(action)
 
@@ -854,8 +958,10 @@ def decode_one_sentence_adaptive_rl_eval( \
     if t <= seq_len - 2:
       beam_size_seq.append(beam_size)
 
-    accum_logP_beam, index_beam = \
-      torch.topk(accum_logP_matrix, beam_size, dim=1)
+    with profiler.span("topk"):
+      accum_logP_beam, index_beam = \
+        torch.topk(accum_logP_matrix, beam_size, dim=1)
+    machine.decode_cost.topk += 1
 
     beta_beam = torch.floor(
       index_beam.float() / machine.label_size).long()
@@ -229,10 +229,8 @@ def decode_one_sentence_adaptive_rl(machine, seq_len, init_dec_hidden,
     # the shape (batch size, 1, input seq len)
     attention_beam = attention_beam.permute(1, 0, 2)
 
-  # score_out.shape => (batch size, |V^y|)
-  score_out = machine.hidden2score(dec_hidden_out) \
-    .view(batch_size, machine.label_size)
-  logP_out = machine.score2logP(score_out).view(batch_size, machine.label_size)
+  # logP_out.shape => (batch size, |V^y|)
+  logP_out = machine.output_logP(dec_hidden_out, 0)
 
   # Initial step, accumulated logP is the same as logP
   accum_logP_out = logP_out
@@ -721,10 +719,8 @@ def decode_one_sentence_adaptive_rl_eval( \
     # the shape (batch size, 1, input seq len)
     attention_beam = attention_beam.permute(1, 0, 2)
 
-  # score_out.shape => (batch size, |V^y|)
-  score_out = machine.hidden2score(dec_hidden_out) \
-    .view(batch_size, machine.label_size)
-  logP_out = machine.score2logP(score_out).view(batch_size, machine.label_size)
+  # logP_out.shape => (batch size, |V^y|)
+  logP_out = machine.output_logP(dec_hidden_out, 0)
 
   # Initial step, accumulated logP is the same as logP
   accum_logP_out = logP_out
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+import json
+
+import numpy as np
+
+from state_features import ACCUM_MARGIN_KEPT, ACCUM_MARGIN_PRUNED, \
+  LOGP_MARGIN_KEPT, LOGP_MARGIN_PRUNED, BEAM_SIZE, NO_CANDIDATE_MARGIN
+
+
+# Features the rules look at, computed from a make_state state:
+# 0: accum_logP of the last kept beam - best accum_logP
+# 1: accum_logP of the first pruned candidate - best accum_logP
+# 2: logP of the last kept beam - best logP
+# 3: logP of the first pruned candidate - best logP
+# 4: current (incoming) beam size
+# These are the quantities det_agent compares against its thresholds.
+FEATURE_NAMES = ["accum_logP_gap_in", "accum_logP_gap_out",
+                 "logP_gap_in", "logP_gap_out", "beam_size_in"]
+
+# Used as the gap of a candidate that does not exist (beam already at max)
+NO_CANDIDATE_GAP = -1e9
+
+
+# states is either one state vector or a (number of states, state dim) matrix
+def rule_features(states, max_beam_size, state_type="topk"):
+  states = np.asarray(states, dtype=np.float64)
+  single = states.ndim == 1
+  if single:
+    states = states[None, :]
+
+  if state_type == "compact":
+    # The compact state already holds these gaps, as margins
+    features = np.stack([
+      -states[:, ACCUM_MARGIN_KEPT],
+      np.where(states[:, ACCUM_MARGIN_PRUNED] < NO_CANDIDATE_MARGIN,
+               -states[:, ACCUM_MARGIN_PRUNED], NO_CANDIDATE_GAP),
+      -states[:, LOGP_MARGIN_KEPT],
+      np.where(states[:, LOGP_MARGIN_PRUNED] < NO_CANDIDATE_MARGIN,
+               -states[:, LOGP_MARGIN_PRUNED], NO_CANDIDATE_GAP),
+      states[:, BEAM_SIZE]], axis=1)
+    return features[0] if single else features
+
+  rows = np.arange(states.shape[0])
+  accum_logP = states[:, 0:max_beam_size]
+  logP = states[:, max_beam_size:2 * max_beam_size]
+  beam_size_in = states[:, 2 * max_beam_size].astype(np.int64)
+
+  has_candidate = beam_size_in < max_beam_size
+  candidate = np.minimum(beam_size_in, max_beam_size - 1)
+
+  features = np.stack([
+    accum_logP[rows, beam_size_in - 1] - accum_logP[:, 0],
+    np.where(has_candidate, accum_logP[rows, candidate] - accum_logP[:, 0], NO_CANDIDATE_GAP),
+    logP[rows, beam_size_in - 1] - logP[:, 0],
+    np.where(has_candidate, logP[rows, candidate] - logP[:, 0], NO_CANDIDATE_GAP),
+    beam_size_in], axis=1)
+
+  return features[0] if single else features
+
+
+class rule_agent():
+  # tree is a nested dict: either {"action": a} for a leaf, or
+  # {"feature": i, "threshold": x, "left": subtree, "right": subtree},
+  # going left when feature i <= x
+  def __init__(self, max_beam_size, tree, state_type="topk"):
+    self.DECREASE = 0
+    self.SAME = 1
+    self.INCREASE = 2
+
+    self.max_beam_size = max_beam_size
+    self.tree = tree
+    self.state_type = state_type
+
+  def get_action(self, state):
+    features = rule_features(state, self.max_beam_size, self.state_type)
+    node = self.tree
+    while "action" not in node:
+      if features[node["feature"]] <= node["threshold"]:
+        node = node["left"]
+      else:
+        node = node["right"]
+    return node["action"]
+
+  def save(self, filename):
+    with open(filename, "w") as f:
+      json.dump({"max_beam_size": self.max_beam_size,
+                 "state_type": self.state_type,
+                 "tree": self.tree}, f, indent=2)
+
+  @staticmethod
+  def load(filename):
+    with open(filename) as f:
+      rule = json.load(f)
+    return rule_agent(rule["max_beam_size"], rule["tree"],
+                      rule.get("state_type", "topk"))
+
+  # Human-readable if/else form of the rules
+  def describe(self, node=None, indent=""):
+    if node is None:
+      node = self.tree
+    if "action" in node:
+      return indent + "return " + ["DECREASE", "SAME", "INCREASE"][node["action"]] + "\n"
+    text = indent + "if %s <= %f:\n" % (FEATURE_NAMES[node["feature"]], node["threshold"])
+    text += self.describe(node["left"], indent + "  ")
+    text += indent + "else:\n"
+    text += self.describe(node["right"], indent + "  ")
+    return text
+
+
+def _gini(counts):
+  total = counts.sum()
+  if total == 0:
+    return 0
+  p = counts / total
+  return 1 - (p * p).sum()
+
+
+# Fit a small CART decision tree (Gini impurity) mapping features to actions.
+# Thresholds are searched over at most max_thresholds quantiles per feature.
+def fit_tree(features, actions, max_depth=3, min_samples_leaf=20,
+             max_thresholds=32, num_actions=3):
+  actions = np.asarray(actions, dtype=np.int64)
+  counts = np.bincount(actions, minlength=num_actions)
+  leaf = {"action": int(counts.argmax())}
+
+  if max_depth == 0 or len(actions) < 2 * min_samples_leaf or (counts > 0).sum() <= 1:
+    return leaf
+
+  best = None
+  parent_impurity = _gini(counts) * len(actions)
+  for feature in range(features.shape[1]):
+    values = features[:, feature]
+    thresholds = np.unique(np.percentile(values, np.linspace(0, 100, max_thresholds + 2)[1:-1]))
+    for threshold in thresholds:
+      left = values <= threshold
+      num_left = left.sum()
+      if num_left < min_samples_leaf or len(actions) - num_left < min_samples_leaf:
+        continue
+      left_counts = np.bincount(actions[left], minlength=num_actions)
+      impurity = _gini(left_counts) * num_left \
+                 + _gini(counts - left_counts) * (len(actions) - num_left)
+      if impurity < parent_impurity and (best is None or impurity < best[0]):
+        best = (impurity, feature, float(threshold), left)
+
+  if best is None:
+    return leaf
+
+  _, feature, threshold, left = best
+  left_tree = fit_tree(features[left], actions[left], max_depth - 1,
+                       min_samples_leaf, max_thresholds, num_actions)
+  right_tree = fit_tree(features[~left], actions[~left], max_depth - 1,
+                        min_samples_leaf, max_thresholds, num_actions)
+
+  # Collapse splits that do not change the decision
+  if "action" in left_tree and "action" in right_tree \
+     and left_tree["action"] == right_tree["action"]:
+    return left_tree
+
+  return {"feature": feature, "threshold": threshold,
+          "left": left_tree, "right": right_tree}
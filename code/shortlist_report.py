@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+
+import torch
+
+from det_agent import det_agent
+from ner_ccg import ner
+from tag_dictionary import TagDictionary
+from train_ccg import get_index2word, get_index2label, minibatch_de
+
+
+###############################
+# Accuracy and decoding time of a CCG checkpoint with the full softmax and
+# with a tag dictionary shortlist (see tag_dictionary.py), for greedy, beam
+# and adaptive decoding on val and test, on CPU.
+#
+# Each configuration is evaluated twice with ner.evaluate, once with
+# machine.tag_dictionary = None and once with the dictionary; the table has
+# the accuracy and wall time of both, the speedup and the accuracy lost. The
+# coverage line of each split is the fraction of gold tags in their word's
+# shortlist, an upper bound of the shortlist's accuracy, and the average
+# shortlist size.
+#
+# Usage:
+#   python3 shortlist_report.py ../result_ccg_lrn_0p001_atten/ckpt_11.pth \
+#     ../dataset/CCGbank/tag_dict.npz --beam-sizes 3,5
+###############################
+
+
+def int_list(text):
+  return [int(x) for x in text.split(",")]
+
+
+def timed_evaluate(machine, X, Y, suffix, decode_method, beam_size, max_beam_size, agent, f_score_index_begin):
+  time_begin = time.time()
+  accuracy, _, avg_beam_size = machine.evaluate(X, Y, None, None, suffix, None, decode_method, beam_size, max_beam_size, agent, 1, 0.02, f_score_index_begin, generate_episode=False, episode_save_path=None)
+  return accuracy, time.time() - time_begin, avg_beam_size
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare full softmax and tag dictionary shortlist decoding')
+  parser.add_argument('checkpoint', help='ckpt_<epoch>.pth of a CCG model')
+  parser.add_argument('tag_dictionary', help='npz written by tag_dictionary.py')
+  parser.add_argument('--splits', default='val,test',
+                      help='comma-separated CCGbank splits (default: val,test)')
+  parser.add_argument('--beam-sizes', type=int_list, default=[3],
+                      help='comma-separated beam sizes, initial ones for adaptive (default: 3)')
+  parser.add_argument('--max-beam-size', type=int, default=10,
+                      help='max beam size of adaptive decoding (default: 10)')
+  parser.add_argument('--accum-logP-ratio-low', type=float, default=0.1)
+  parser.add_argument('--logP-ratio-low', type=float, default=0.1)
+  parser.add_argument('--batch-size', type=int, default=32,
+                      help='sentences per batch for greedy / beam (default: 32)')
+  parser.add_argument('--word-embedding-dim', type=int, default=300)
+  parser.add_argument('--hidden-dim', type=int, default=512)
+  parser.add_argument('--label-embedding-dim', type=int, default=512)
+  parser.add_argument('--attention', default='fixed',
+                      help='attention type of the checkpoint, or "none" (default: fixed)')
+  parser.add_argument('--f-score-index-begin', type=int, default=2)
+  parser.add_argument('--threads', type=int, default=1,
+                      help='torch threads (default: 1)')
+  args = parser.parse_args()
+
+  if args.attention == "none":
+    args.attention = None
+  torch.set_num_threads(args.threads)
+
+  index2word = get_index2word("../dataset/CCGbank/dict_word")
+  index2label = get_index2label("../dataset/CCGbank/dict_tag")
+  label_size = len(index2label)
+
+  machine = ner(args.word_embedding_dim, args.hidden_dim, args.label_embedding_dim, len(index2word), label_size, minibatch_size=args.batch_size, attention=args.attention, gpu=False, pretrained=None, load_model_filename=args.checkpoint, load_map_location="cpu")
+  tag_dictionary = TagDictionary.load(args.tag_dictionary)
+
+  max_beam_size = min(args.max_beam_size, label_size)
+  agent = det_agent(max_beam_size, args.accum_logP_ratio_low, args.logP_ratio_low)
+
+  configs = [("greedy", 1)]
+  configs += [("beam", beam_size) for beam_size in args.beam_sizes]
+  configs += [("adaptive", beam_size) for beam_size in args.beam_sizes if beam_size <= max_beam_size]
+
+  print("split\tdecoder\tbeam_size\tfull_acc\tshortlist_acc\tacc_diff\tfull_s\tshortlist_s\tspeedup\tshortlist_avg_beam")
+  for split in args.splits.split(","):
+    X, Y = minibatch_de(split, args.batch_size)
+    # Adaptive decoding takes batches of one
+    X_one, Y_one = minibatch_de(split, 1)
+
+    covered, size = tag_dictionary.coverage([sentence for batch in X for sentence in batch],
+                                            [tags for batch in Y for tags in batch])
+    print("# %s: gold tag in shortlist %.4f, average shortlist size %.1f of %d" % (split, covered, size, label_size))
+
+    for decode_method, beam_size in configs:
+      eval_X, eval_Y = (X_one, Y_one) if decode_method == "adaptive" else (X, Y)
+
+      machine.tag_dictionary = None
+      full_acc, full_time, _ = timed_evaluate(machine, eval_X, eval_Y, split, decode_method, beam_size, max_beam_size, agent, args.f_score_index_begin)
+      machine.tag_dictionary = tag_dictionary
+      shortlist_acc, shortlist_time, avg_beam_size = timed_evaluate(machine, eval_X, eval_Y, split, decode_method, beam_size, max_beam_size, agent, args.f_score_index_begin)
+      machine.tag_dictionary = None
+
+      print("%s\t%s\t%d\t%.6f\t%.6f\t%+.6f\t%.3f\t%.3f\t%.2f\t%.3f" % (split, decode_method, beam_size, full_acc, shortlist_acc, shortlist_acc - full_acc, full_time, shortlist_time, full_time / max(shortlist_time, 1e-9), avg_beam_size), flush=True)
+
+
+if __name__ == "__main__":
+  main()
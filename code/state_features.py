@@ -0,0 +1,111 @@
+import numpy as np
+import torch
+
+
+###############################
+# State representations for the beam agent.
+#
+# "topk" (the original, see ner.make_state):
+#   [max_beam_size accumulated logP's (sorted from high to low),
+#    max_beam_size (non-accumulated) logP's (sorted from high to low),
+#    current (incoming) beam size]
+#   Its length, the two top-k calls per step and the agent's input layer all
+#   grow with max_beam_size, which is the label size in our RL scripts.
+#
+# "compact": a fixed-size summary, independent of the number of labels:
+#   [gaps between consecutive top accumulated logP's (COMPACT_NUM_GAPS),
+#    gaps between consecutive top logP's (COMPACT_NUM_GAPS),
+#    entropy of the label distribution of the best incoming beam,
+#    best accum logP - accum logP of the last kept beam,
+#    best accum logP - accum logP of the first pruned candidate,
+#    best logP - logP of the last kept beam,
+#    best logP - logP of the first pruned candidate,
+#    current (incoming) beam size,
+#    position in the sentence (t / (seq_len - 1))]
+#   The top-k calls only go to beam_size + 1 and everything is computed on
+#   the device, with a single transfer of a few numbers per step.
+###############################
+
+COMPACT_NUM_GAPS = 3
+
+# Indices in the compact state
+ACCUM_GAP_BEGIN = 0
+LOGP_GAP_BEGIN = COMPACT_NUM_GAPS
+ENTROPY = 2 * COMPACT_NUM_GAPS
+ACCUM_MARGIN_KEPT = ENTROPY + 1
+ACCUM_MARGIN_PRUNED = ENTROPY + 2
+LOGP_MARGIN_KEPT = ENTROPY + 3
+LOGP_MARGIN_PRUNED = ENTROPY + 4
+BEAM_SIZE = ENTROPY + 5
+POSITION = ENTROPY + 6
+COMPACT_STATE_DIM = POSITION + 1
+
+# Margin (and gap) used for a candidate that does not exist. A gap of 100 in
+# log space is as good as infinite, but keeps the agent's inputs bounded.
+NO_CANDIDATE_MARGIN = 100.0
+
+
+def get_state_dim(state_type, max_beam_size):
+  if state_type == "topk":
+    return 2 * max_beam_size + 1
+  elif state_type == "compact":
+    return COMPACT_STATE_DIM
+  else:
+    raise Exception("Unknown state type: " + str(state_type))
+
+
+def make_compact_state(accum_logP_matrix, logP_matrix, beam_size, label_size,
+                       t=None, seq_len=None):
+  # Both matrices are (batch size = 1, incoming beam size * label size)
+  candidate_num = accum_logP_matrix.size()[1]
+  k = min(max(beam_size + 1, COMPACT_NUM_GAPS + 1), candidate_num)
+
+  accum_logP_top, _ = torch.topk(accum_logP_matrix, k, dim=1)
+  logP_top, _ = torch.topk(logP_matrix, k, dim=1)
+
+  # The first label_size entries are the label distribution of the best
+  # incoming beam (beams are kept sorted by accumulated logP)
+  best_beam_logP = logP_matrix[:, 0:label_size]
+  entropy = -(torch.exp(best_beam_logP) * best_beam_logP).sum(1, keepdim=True)
+
+  summary = torch.cat([accum_logP_top, logP_top, entropy], dim=1)
+  summary = summary.cpu().data.numpy()[0].astype(np.float64)
+
+  accum_logP_top = summary[0:k]
+  logP_top = summary[k:2 * k]
+  entropy = summary[2 * k]
+
+  def gaps(top):
+    result = np.full(COMPACT_NUM_GAPS, NO_CANDIDATE_MARGIN)
+    num = min(len(top) - 1, COMPACT_NUM_GAPS)
+    result[0:num] = top[0:num] - top[1:num + 1]
+    return result
+
+  def margins(top):
+    kept = top[0] - top[beam_size - 1]
+    pruned = top[0] - top[beam_size] if beam_size < k else NO_CANDIDATE_MARGIN
+    return [kept, pruned]
+
+  position = float(t) / max(seq_len - 1, 1) if (t is not None and seq_len) else 0
+
+  state = np.concatenate([gaps(accum_logP_top), gaps(logP_top), [entropy],
+                          margins(accum_logP_top), margins(logP_top),
+                          [beam_size, position]])
+
+  return state
+
+
+###############################
+# Action repeat: between two queries, the agent's beam size is held.
+# A query is due every action_repeat time steps, or earlier when the gap
+# between the two best accumulated logP's moved by more than
+# repeat_gap_threshold since the last query (see ner.query_agent).
+# The gap is a top-2 on the device and a single number to transfer, much
+# cheaper than make_state plus a policy forward.
+###############################
+
+def get_score_gap(accum_logP_matrix):
+  candidate_num = accum_logP_matrix.size()[1]
+  top, _ = torch.topk(accum_logP_matrix, min(2, candidate_num), dim=1)
+  top = top.cpu().data.numpy()[0]
+  return float(top[0] - top[1]) if len(top) > 1 else NO_CANDIDATE_MARGIN
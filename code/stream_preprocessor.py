@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import itertools
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+from dataset_store import DatasetWriter
+from preprocessor import Preprocessor
+
+
+###############################
+# Streaming version of Preprocessor.read_file / preprocess /
+# index_preprocess, for eng.train and larger CoNLL corpora.
+#
+# Sentence blocks are read lazily from the input (a file, or - for stdin),
+# grouped into chunks of --chunk-size sentences and preprocessed and indexed
+# in a process pool, with the same rules as Preprocessor (lower-casing,
+# sentences over max_sentence_length characters dropped, the digit / quote
+# regex, padding to a multiple of LENGTH_UNIT with <PAD> / O, entity_dict).
+# The indexed chunks are written in input order to the binary format of
+# dataset_store.py. At most 2 * --workers chunks are in flight, so memory
+# does not grow with the corpus.
+#
+# Words missing from the vocabulary map to <UNK> (Preprocessor raises a
+# KeyError instead).
+#
+# Usage:
+#   python3 stream_preprocessor.py ../dataset/CoNLL-2003/eng.train \
+#     ../dataset/CoNLL-2003/vocab_dict ../dataset/CoNLL-2003/eng.train
+###############################
+
+# Set in each worker by init_worker
+PREPROCESSOR = None
+
+
+def read_sentences(f, preprocessor):
+  # Yields the (words, entities) of each sentence, as read_file
+  words, entities = [], []
+  for line in f:
+    if preprocessor._is_valid_line(line):
+      features = line.split()
+      words.append(features[0])
+      entities.append(features[-1])
+    elif len(words) > 0:
+      yield words, entities
+      words, entities = [], []
+  if len(words) > 0:
+    yield words, entities
+
+
+def chunked(iterable, chunk_size):
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if len(chunk) == 0:
+      return
+    yield chunk
+
+
+def load_vocab(vocab_file):
+  # "word index" per line, as written by run.build_vocab
+  vocab_dict = dict()
+  with open(vocab_file) as f:
+    for line in f:
+      splitted = line.split()
+      if len(splitted) == 2:
+        vocab_dict[splitted[0]] = int(splitted[1])
+  return vocab_dict
+
+
+def init_worker(vocab_dict):
+  global PREPROCESSOR
+  PREPROCESSOR = Preprocessor(None, None)
+  PREPROCESSOR.vocab_dict = vocab_dict
+  PREPROCESSOR.vocabulary_size = len(vocab_dict)
+
+
+def process_chunk(chunk):
+  # Returns the concatenated word and label indices and the lengths of the
+  # kept sentences of chunk, and the number of dropped ones
+  p = PREPROCESSOR
+  unk_index = p.vocab_dict[p.UNK_TOKEN]
+  words, labels, lengths = [], [], []
+  dropped = 0
+  for sentence_words, sentence_entities in chunk:
+    sentence = ' '.join(p._preprocess_word(word) for word in sentence_words)
+    if len(sentence) > p.max_sentence_length:
+      dropped += 1
+      continue
+    sentence = p._preprocess_sentence(sentence).split()
+    entities = p._preprocess_entities(' '.join(sentence_entities)).split()
+    assert len(sentence) == len(entities)
+    words.extend(p.vocab_dict.get(word, unk_index) for word in sentence)
+    labels.extend(p.entity_dict[entity] for entity in entities)
+    lengths.append(len(sentence))
+  return (np.array(words, dtype=np.int32), np.array(labels, dtype=np.int32),
+          np.array(lengths, dtype=np.int64), dropped)
+
+
+def preprocess_stream(f, vocab_dict, output_path, workers, chunk_size):
+  writer = DatasetWriter(output_path)
+  chunks = chunked(read_sentences(f, Preprocessor(None, None)), chunk_size)
+  dropped = 0
+
+  # Pool.imap would read the whole input ahead; apply_async with a bounded
+  # queue of pending results keeps both the input and the output in order
+  # and in bounded memory
+  pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(vocab_dict,))
+  pending = collections.deque()
+  for chunk in chunks:
+    pending.append(pool.apply_async(process_chunk, (chunk,)))
+    if len(pending) >= 2 * workers:
+      words, labels, lengths, chunk_dropped = pending.popleft().get()
+      writer.write_sentences(words, labels, lengths)
+      dropped += chunk_dropped
+  while pending:
+    words, labels, lengths, chunk_dropped = pending.popleft().get()
+    writer.write_sentences(words, labels, lengths)
+    dropped += chunk_dropped
+  pool.close()
+  pool.join()
+
+  writer.close()
+  return len(writer), writer.num_tokens, dropped
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Preprocess and index a CoNLL file into the binary dataset format')
+  parser.add_argument('input', help='CoNLL file, or - for stdin')
+  parser.add_argument('vocab', help='vocabulary file ("word index" per line)')
+  parser.add_argument('output', help='dataset path (gets .words, .labels, .offsets)')
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                      help='preprocessing processes (default: number of cores)')
+  parser.add_argument('--chunk-size', type=int, default=1000,
+                      help='sentences per task (default: 1000)')
+  args = parser.parse_args()
+
+  vocab_dict = load_vocab(args.vocab)
+  print("Loaded the existing vocabulary dictionary. vocab_size: ", len(vocab_dict))
+
+  time_begin = time.time()
+  if args.input == "-":
+    num_sentences, num_tokens, dropped = preprocess_stream(sys.stdin, vocab_dict, args.output, args.workers, args.chunk_size)
+  else:
+    with open(args.input) as f:
+      num_sentences, num_tokens, dropped = preprocess_stream(f, vocab_dict, args.output, args.workers, args.chunk_size)
+  print("Wrote %d sentences (%d tokens, %d too long sentences dropped) to %s in %.1f s"
+        % (num_sentences, num_tokens, dropped, args.output, time.time() - time_begin))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+import argparse
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from operator import itemgetter
+
+import numpy as np
+import torch
+
+from chunk_eval import chunk_fscore
+from det_agent import det_agent
+from ner import ner
+from parallel_eval import parallel_evaluate
+from train_de import get_index2word, get_index2label, construct_df
+
+
+###############################
+# Runs many training / evaluation configurations of the German NER tagger
+# in one job, instead of one exp_*.py script (and one data loading) each.
+#
+# The sweep file is JSON: "base" holds the settings shared by all runs, and
+# either "grid" (every combination of the listed values) or "configs" (a
+# list of overrides, each optionally with a "name") the ones that vary:
+#
+#   {"base": {"task": "eval", "result_path": "../result_lrn_0p001/",
+#             "epoch": 51, "attention": null},
+#    "grid": {"decode_method": ["beam", "adaptive"], "beam_size": [1, 3, 5]}}
+#
+# task "eval" evaluates ckpt_<epoch>.pth of result_path on val and test;
+# task "train" runs ner.train (learning_rate, max_epoch, batch_size,
+# patience, keep_last, ...) into the run's directory. See DEFAULTS for all
+# settings.
+#
+# The vocabularies, the sentences of every split and the pretrained
+# embedding are loaded once; the runs are forked from this process (so they
+# share that memory copy-on-write), one process per run, --workers at a
+# time with --threads torch threads each. With --eval-workers N, an eval
+# run shares its decoding out to N processes of its own (see
+# parallel_eval.py). A run's results go to
+# <sweep dir>/<name>/done.json, and a restarted sweep skips the runs that
+# have one, so after a crash only the unfinished runs start over.
+# <sweep dir>/results.txt collects one line per finished run. A failed run
+# is reported, with its traceback in <sweep dir>/<name>/error.txt, and the
+# others go on (ner.train stops its checkpoint writer and background
+# evaluator when it fails, so the run's worker process does exit).
+#
+# Usage:
+#   python3 sweep.py sweep.json ../result_sweep/ --threads 2
+###############################
+
+DATA_PATH = "../dataset/German/"
+
+DEFAULTS = {
+  "task": "eval",
+  # Model
+  "word_embedding_dim": 64, "hidden_dim": 64, "label_embedding_dim": 8,
+  "attention": None, "pretrained": "de64", "state_type": "topk",
+  "action_repeat": 1,
+  # eval: checkpoint and decoding
+  "result_path": None, "epoch": None,
+  "decode_method": "greedy", "beam_size": 1, "max_beam_size": None,
+  "accum_logP_ratio_low": 0.1, "logP_ratio_low": 0.1,
+  "reward_coef_fscore": 1, "reward_coef_beam_size": 0.1,
+  "write_result": False,
+  # train
+  "learning_rate": 0.001, "max_epoch": 100, "batch_size": 32,
+  "do_evaluation": True, "patience": None, "keep_last": None,
+  "sparse_embedding": False,
+  "seed": None,
+}
+
+# For German dataset, f_score_index_begin = 5 (because O_INDEX = 4)
+F_SCORE_INDEX_BEGIN = 5
+
+# Loaded once in the parent, inherited by the forked runs
+DATA = {}
+
+
+def read_split(data):
+  all_data = []
+  indexed_data = construct_df(data)
+  for index, row in indexed_data.iterrows():
+    splitted_sentence = list(map(int, row['SENTENCE'].split()))
+    splitted_entities = list(map(int, row['ENTITY'].split()))
+    assert len(splitted_entities) == len(splitted_sentence)
+    all_data.append((len(splitted_sentence), splitted_sentence, splitted_entities))
+  return all_data
+
+
+# Minibatches of sentences of the same length, as train_de.minibatch_de
+def batch_by_length(all_data, batch_size):
+  X_batch = []
+  Y_batch = []
+  for _, group in itertools.groupby(sorted(all_data, key=itemgetter(0)), key=itemgetter(0)):
+    group = list(group)
+    for begin in range(0, len(group), batch_size):
+      X_batch.append([data[1] for data in group[begin:begin + batch_size]])
+      Y_batch.append([data[2] for data in group[begin:begin + batch_size]])
+  return X_batch, Y_batch
+
+
+def batch_of_one(all_data):
+  return [[data[1]] for data in all_data], [[data[2]] for data in all_data]
+
+
+def load_data(pretrained_names):
+  DATA["index2word"] = get_index2word(DATA_PATH + "vocab1.de")
+  DATA["index2label"] = get_index2label(DATA_PATH + "vocab1.en")
+  for split in ["train", "valid", "test"]:
+    DATA[split] = read_split(split)
+  DATA["embedding"] = {}
+  for pretrained in pretrained_names:
+    DATA["embedding"][pretrained] = torch.from_numpy(
+      np.loadtxt('../dataset/WordEmbed/' + pretrained + '_embed.txt', dtype=float))
+
+
+def make_configs(sweep):
+  base = dict(DEFAULTS)
+  base.update(sweep.get("base", {}))
+
+  configs = []
+  if "grid" in sweep:
+    keys = sorted(sweep["grid"])
+    for values in itertools.product(*[sweep["grid"][key] for key in keys]):
+      config = dict(base)
+      config.update(zip(keys, values))
+      name = "-".join("%s_%s" % (key, value) for key, value in zip(keys, values))
+      configs.append((name, config))
+  else:
+    for i, override in enumerate(sweep["configs"]):
+      config = dict(base)
+      config.update(override)
+      configs.append((config.pop("name", "config_%d" % i), config))
+
+  for name, config in configs:
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+      raise Exception("Unknown settings in %s: %s" % (name, ", ".join(sorted(unknown))))
+  return configs
+
+
+def make_machine(config, load_model_filename=None, train_data=None, eval_data=None):
+  train_X, train_Y = train_data if train_data else (None, None)
+  (val_X, val_Y), (test_X, test_Y) = eval_data
+  label_size = len(DATA["index2label"])
+  # The pretrained embedding is copied in from DATA instead of being loaded
+  # by every run
+  machine = ner(config["word_embedding_dim"], config["hidden_dim"], config["label_embedding_dim"], len(DATA["index2word"]), label_size, learning_rate=config["learning_rate"], minibatch_size=config["batch_size"], max_epoch=config["max_epoch"], train_X=train_X, train_Y=train_Y, val_X=val_X, val_Y=val_Y, test_X=test_X, test_Y=test_Y, attention=config["attention"], gpu=False, pretrained=None, load_model_filename=load_model_filename, load_map_location="cpu", state_type=config["state_type"], action_repeat=config["action_repeat"], sparse_embedding=config["sparse_embedding"])
+  if config["pretrained"] and not load_model_filename:
+    machine.word_embedding.weight.data.copy_(DATA["embedding"][config["pretrained"]])
+  return machine
+
+
+def run_eval(config, run_path, eval_workers=1):
+  load_model_filename = os.path.join(config["result_path"], "ckpt_" + str(config["epoch"]) + ".pth")
+  eval_data = (batch_of_one(DATA["valid"]), batch_of_one(DATA["test"]))
+  machine = make_machine(config, load_model_filename=load_model_filename, eval_data=eval_data)
+
+  decode_method = config["decode_method"]
+  beam_size = config["beam_size"]
+  max_beam_size = config["max_beam_size"] or len(DATA["index2label"])
+  agent = None
+  if decode_method == "adaptive":
+    agent = det_agent(max_beam_size, config["accum_logP_ratio_low"], config["logP_ratio_low"], config["state_type"])
+
+  evaluate = machine.evaluate
+  if eval_workers > 1:
+    # Pool workers are daemonic, which may not start processes; the run's
+    # process exits after this run anyway
+    multiprocessing.current_process().daemon = False
+    evaluate = functools.partial(parallel_evaluate, machine, num_workers=eval_workers,
+                                 num_threads=torch.get_num_threads())
+
+  result_path = run_path if config["write_result"] else None
+  result = {}
+  for suffix, (eval_X, eval_Y) in zip(["val", "test"], eval_data):
+    time_begin = time.time()
+    fscore, _, avg_beam_size = evaluate(eval_X, eval_Y, DATA["index2word"], DATA["index2label"], suffix, result_path, decode_method, beam_size, max_beam_size, agent, config["reward_coef_fscore"], config["reward_coef_beam_size"], F_SCORE_INDEX_BEGIN, generate_episode=False)
+    result[suffix + "_fscore"] = float(fscore)
+    result[suffix + "_chunk_fscore"] = chunk_fscore(machine.chunk_counts)
+    result[suffix + "_avg_beam_size"] = float(avg_beam_size)
+    result[suffix + "_time"] = time.time() - time_begin
+  return result
+
+
+def run_train(config, run_path):
+  train_data = batch_by_length(DATA["train"], config["batch_size"])
+  eval_data = (batch_of_one(DATA["valid"]), batch_of_one(DATA["test"]))
+  machine = make_machine(config, train_data=train_data, eval_data=eval_data)
+
+  time_begin = time.time()
+  train_loss_list = machine.train(True, run_path, config["do_evaluation"], config["beam_size"], patience=config["patience"], keep_last=config["keep_last"], f_score_index_begin=F_SCORE_INDEX_BEGIN, index2label=DATA["index2label"])
+  result = {"epochs": len(train_loss_list),
+            "final_loss": float(train_loss_list[-1]) if train_loss_list else None,
+            "time": time.time() - time_begin}
+
+  # "# best epoch\t<epoch>\t<val F>\t<test F>" and the epochs'
+  # "chunk\t<epoch>\t<val chunk F1>\t<test chunk F1>", written by ner.train
+  chunk_fscores = {}
+  with open(os.path.join(run_path, "log.txt")) as f:
+    for line in f:
+      if line.startswith("# best epoch"):
+        _, best_epoch, val_fscore, test_fscore = line.rstrip("\n").split("\t")
+        result.update({"best_epoch": int(best_epoch),
+                       "val_fscore": float(val_fscore),
+                       "test_fscore": float(test_fscore)})
+      elif line.startswith("chunk\t"):
+        _, epoch, val_chunk_fscore, test_chunk_fscore = line.rstrip("\n").split("\t")
+        chunk_fscores[int(epoch)] = (float(val_chunk_fscore), float(test_chunk_fscore))
+  if result.get("best_epoch") in chunk_fscores:
+    result["val_chunk_fscore"], result["test_chunk_fscore"] = chunk_fscores[result["best_epoch"]]
+  return result
+
+
+def run_config(item):
+  name, config, sweep_dir, threads, eval_workers = item
+  torch.set_num_threads(threads)
+  if config["seed"] is not None:
+    torch.manual_seed(config["seed"])
+    np.random.seed(config["seed"])
+
+  run_path = os.path.join(sweep_dir, name) + "/"
+  if not os.path.exists(run_path):
+    os.makedirs(run_path)
+  with open(os.path.join(run_path, "config.json"), "w") as f:
+    json.dump(config, f, indent=2, sort_keys=True)
+
+  # A failed run is reported and left unfinished, the others go on
+  try:
+    if config["task"] == "train":
+      result = run_train(config, run_path)
+    elif config["task"] == "eval":
+      result = run_eval(config, run_path, eval_workers)
+    else:
+      raise Exception("Unknown task: " + config["task"])
+  except Exception as e:
+    with open(os.path.join(run_path, "error.txt"), "w") as f:
+      f.write(traceback.format_exc())
+    return name, {"error": repr(e)}
+
+  # Written last and atomically: its presence marks the run as finished
+  done_filename = os.path.join(run_path, "done.json")
+  with open(done_filename + ".tmp", "w") as f:
+    json.dump(result, f, indent=2, sort_keys=True)
+  os.rename(done_filename + ".tmp", done_filename)
+  return name, result
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Run a sweep of ner configurations')
+  parser.add_argument('sweep_file', help='JSON with "base" and "grid" or "configs"')
+  parser.add_argument('sweep_dir', help='gets one directory per run')
+  parser.add_argument('--threads', type=int, default=1,
+                      help='torch threads per run (default: 1)')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='runs at a time (default: cores / (threads * eval workers))')
+  parser.add_argument('--eval-workers', type=int, default=1,
+                      help='processes decoding each eval run, with --threads '
+                           'torch threads each (default: 1)')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='only list the runs still to do')
+  args = parser.parse_args()
+
+  with open(args.sweep_file) as f:
+    configs = make_configs(json.load(f))
+
+  todo = [(name, config) for name, config in configs
+          if not os.path.exists(os.path.join(args.sweep_dir, name, "done.json"))]
+  print("%d runs, %d finished, %d to do" % (len(configs), len(configs) - len(todo), len(todo)))
+  if args.dry_run:
+    for name, _ in todo:
+      print(name)
+    return
+  if len(todo) == 0:
+    return
+
+  if not os.path.exists(args.sweep_dir):
+    os.makedirs(args.sweep_dir)
+
+  load_data(set(config["pretrained"] for _, config in todo
+                if config["pretrained"] and config["task"] == "train"))
+
+  workers = args.workers or max(1, multiprocessing.cpu_count() // (args.threads * args.eval_workers))
+  workers = min(workers, len(todo))
+  print("Running on %d workers with %d threads each" % (workers, args.threads))
+
+  # fork, so that the runs inherit DATA; a fresh process per run
+  pool = multiprocessing.get_context("fork").Pool(workers, maxtasksperchild=1)
+  items = [(name, config, args.sweep_dir, args.threads, args.eval_workers) for name, config in todo]
+  with open(os.path.join(args.sweep_dir, "results.txt"), "a") as results_file:
+    for name, result in pool.imap_unordered(run_config, items):
+      print(name, result)
+      if "error" in result:
+        continue
+      results_file.write("%s\t%s\n" % (name, json.dumps(result, sort_keys=True)))
+      results_file.flush()
+  pool.close()
+  pool.join()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import itertools
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from det_agent import det_agent
+from ner import ner
+from stream_preprocessor import chunked
+from train_de import get_index2word, get_index2label
+
+
+###############################
+# Tags raw, unlabeled text with a trained ner checkpoint, for corpora that do
+# not fit in memory (evaluate needs gold labels and all batches in memory).
+#
+# Input (a file, or - for stdin) is one tokenized sentence per line, as the
+# German *.de-en.de files, or with --input-format conll the first column of
+# CoNLL sentence blocks. Sentences are read --window at a time, indexed with
+# the saved vocabulary (unknown words map to --unk-token), sorted by length
+# within the window and cut into batches of equal length (of one sentence
+# for adaptive decoding, which does not batch). The batches are decoded with
+# greedy, beam or adaptive decoding by --workers processes forked from this
+# one, which all share the model's weights, and the tags are written in
+# input order: one "word tag" line per token and an empty line after each
+# sentence (conll), or the tags of a sentence on one line (line).
+#
+# At most two windows are in flight (one being decoded, one being written
+# or read), so memory does not grow with the corpus.
+#
+# Usage:
+#   python3 tag_corpus.py ../result_lrn_0p001/ckpt_51.pth corpus.txt corpus.tags \
+#     --decode-method adaptive --beam-size 3 --workers 8
+###############################
+
+# Set in the parent before forking the workers
+MACHINE = None
+DECODE = {}
+
+
+def read_sentences(f, input_format):
+  if input_format == "line":
+    for line in f:
+      yield line.split()
+    return
+
+  words = []
+  for line in f:
+    features = line.split()
+    if len(features) > 0 and features[0] != "-DOCSTART-":
+      words.append(features[0])
+    elif len(words) > 0:
+      yield words
+      words = []
+  if len(words) > 0:
+    yield words
+
+
+def make_batches(window, batch_size):
+  # (sentence positions in the window, index arrays) of equal length
+  order = sorted(range(len(window)), key=lambda i: len(window[i][1]))
+  batches = []
+  for _, group in itertools.groupby(order, key=lambda i: len(window[i][1])):
+    group = list(group)
+    for begin in range(0, len(group), batch_size):
+      positions = group[begin:begin + batch_size]
+      batches.append((positions, np.array([window[i][1] for i in positions], dtype=np.int64)))
+  return batches
+
+
+def init_worker(threads):
+  torch.set_num_threads(threads)
+
+
+def tag_batch(batch):
+  positions, sen = batch
+  machine = MACHINE
+  current_batch_size, current_sen_len = sen.shape
+  if current_sen_len == 0:
+    return positions, sen
+
+  with torch.no_grad():
+    sen_var = Variable(torch.from_numpy(sen))
+    init_enc_hidden = Variable(torch.zeros((2, current_batch_size, machine.hidden_dim)))
+    init_enc_cell = Variable(torch.zeros((2, current_batch_size, machine.hidden_dim)))
+    enc_hidden_seq, (enc_hidden_out, enc_cell_out) = machine.encode(sen_var, init_enc_hidden, init_enc_cell)
+    init_dec_hidden = machine.enc2dec_hidden(torch.cat([enc_hidden_out[0], enc_hidden_out[1]], dim=1))
+    init_dec_cell = machine.enc2dec_cell(torch.cat([enc_cell_out[0], enc_cell_out[1]], dim=1))
+
+    decode_method = DECODE["decode_method"]
+    if decode_method == "greedy":
+      label_pred_seq = machine.decode_greedy(current_batch_size, current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq)[0]
+    elif decode_method == "beam":
+      label_pred_seq = machine.decode_beam(current_batch_size, current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, DECODE["beam_size"])[0]
+    else:
+      # No gold labels: no reward, no episode
+      label_pred_seq = machine.decode_beam_adaptive(current_sen_len, init_dec_hidden, init_dec_cell, enc_hidden_seq, DECODE["beam_size"], DECODE["max_beam_size"], DECODE["agent"], 0, 0, None, 0, generate_episode=False)[0]
+
+  return positions, label_pred_seq.data.cpu().numpy()
+
+
+def write_window(f, window, tags, index2label, output_format):
+  lines = []
+  for (words, _), sentence_tags in zip(window, tags):
+    labels = [index2label.get(int(tag), str(tag)) for tag in sentence_tags]
+    if output_format == "conll":
+      lines.extend("%s %s\n" % word_label for word_label in zip(words, labels))
+      lines.append("\n")
+    else:
+      lines.append(" ".join(labels) + "\n")
+  f.write("".join(lines))
+
+
+def tag_stream(input_file, output_file, word2index, unk_index, index2label, args):
+  pool = multiprocessing.get_context("fork").Pool(args.workers, initializer=init_worker, initargs=(args.threads,))
+  batch_size = 1 if args.decode_method == "adaptive" else args.batch_size
+
+  num_sentences = 0
+  # (window, its batches' async results), in input order
+  pending = collections.deque()
+  windows = chunked(read_sentences(input_file, args.input_format), args.window)
+  for sentences in itertools.chain(windows, [None]):
+    if sentences is not None:
+      window = [(words, [word2index.get(word, unk_index) for word in words]) for words in sentences]
+      results = [pool.apply_async(tag_batch, (batch,)) for batch in make_batches(window, batch_size)]
+      pending.append((window, results))
+
+    # Write the oldest window once the next one is queued (or at the end)
+    while len(pending) >= 2 or (sentences is None and pending):
+      window, results = pending.popleft()
+      tags = [None] * len(window)
+      for result in results:
+        positions, label_pred_seq = result.get()
+        for position, sentence_tags in zip(positions, label_pred_seq):
+          tags[position] = sentence_tags
+      write_window(output_file, window, tags, index2label, args.output_format)
+      num_sentences += len(window)
+
+  pool.close()
+  pool.join()
+  return num_sentences
+
+
+def main():
+  global MACHINE
+
+  parser = argparse.ArgumentParser(description='Tag raw text with a trained ner checkpoint')
+  parser.add_argument('checkpoint', help='ckpt_<epoch>.pth written by ner.train')
+  parser.add_argument('input', help='text file, or - for stdin')
+  parser.add_argument('output', help='tag file, or - for stdout')
+  parser.add_argument('--input-format', choices=['line', 'conll'], default='line',
+                      help='one sentence per line, or CoNLL blocks (default: line)')
+  parser.add_argument('--output-format', choices=['conll', 'line'], default='conll',
+                      help='"word tag" per line, or the tags of a sentence per line (default: conll)')
+  parser.add_argument('--word-vocab', default='../dataset/German/vocab1.de')
+  parser.add_argument('--label-vocab', default='../dataset/German/vocab1.en')
+  parser.add_argument('--unk-token', default='_UNK')
+  parser.add_argument('--decode-method', choices=['greedy', 'beam', 'adaptive'], default='greedy')
+  parser.add_argument('--beam-size', type=int, default=1,
+                      help='beam size, or initial beam size for adaptive (default: 1)')
+  parser.add_argument('--max-beam-size', type=int, default=None,
+                      help='for adaptive (default: label size)')
+  parser.add_argument('--accum-logP-ratio-low', type=float, default=0.1)
+  parser.add_argument('--logP-ratio-low', type=float, default=0.1)
+  parser.add_argument('--word-embedding-dim', type=int, default=64)
+  parser.add_argument('--hidden-dim', type=int, default=64)
+  parser.add_argument('--label-embedding-dim', type=int, default=8)
+  parser.add_argument('--attention', default='none',
+                      help='attention type of the checkpoint, or "none" (default: none)')
+  parser.add_argument('--state-type', default='topk')
+  parser.add_argument('--batch-size', type=int, default=32,
+                      help='sentences per batch for greedy / beam (default: 32)')
+  parser.add_argument('--window', type=int, default=8192,
+                      help='sentences read and length-bucketed at a time (default: 8192)')
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--threads', type=int, default=1,
+                      help='torch threads per worker (default: 1)')
+  args = parser.parse_args()
+
+  if args.attention == "none":
+    args.attention = None
+
+  index2word = get_index2word(args.word_vocab)
+  index2label = get_index2label(args.label_vocab)
+  word2index = {word: index for index, word in index2word.items()}
+  if args.unk_token not in word2index:
+    raise Exception("Unknown word token " + args.unk_token + " not in " + args.word_vocab)
+  label_size = len(index2label)
+
+  MACHINE = ner(args.word_embedding_dim, args.hidden_dim, args.label_embedding_dim, len(index2word), label_size, minibatch_size=args.batch_size, attention=args.attention, gpu=False, pretrained=None, load_model_filename=args.checkpoint, load_map_location="cpu", state_type=args.state_type)
+  # One copy of the weights for all the forked workers
+  MACHINE.share_memory()
+
+  DECODE["decode_method"] = args.decode_method
+  DECODE["beam_size"] = args.beam_size
+  DECODE["max_beam_size"] = args.max_beam_size or label_size
+  if args.decode_method == "adaptive":
+    DECODE["agent"] = det_agent(DECODE["max_beam_size"], args.accum_logP_ratio_low, args.logP_ratio_low, args.state_type)
+
+  input_file = sys.stdin if args.input == "-" else open(args.input)
+  output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+  time_begin = time.time()
+  num_sentences = tag_stream(input_file, output_file, word2index, word2index[args.unk_token], index2label, args)
+  if output_file is not sys.stdout:
+    output_file.close()
+  if input_file is not sys.stdin:
+    input_file.close()
+  print("Tagged %d sentences in %.1f s" % (num_sentences, time.time() - time_begin), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
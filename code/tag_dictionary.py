@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+
+###############################
+# Tag dictionary for CCG supertagging: the tags a word may get, used to
+# shortlist the labels ner's decoders score at each position.
+#
+# Built from indexed training data (CCGbank <data>_x / <data>_y): a word seen
+# at least cutoff times may only get the tags it was seen with; a rarer or
+# unknown word gets the fallback set, the tags seen at least
+# fallback_min_count times overall (as the tag dictionary and frequent tag
+# set of the C&C supertagger).
+#
+# Set on a model, it restricts evaluate's decoding (greedy, beam and
+# adaptive) to the shortlisted tags of each word: only their rows of
+# hidden2score are computed and the log-softmax is taken over them, the
+# other labels getting PRUNED_LOGP (see ner.output_logP):
+#   machine.tag_dictionary = TagDictionary.load("../dataset/CCGbank/tag_dict.npz")
+# Training always uses all the labels.
+#
+# Usage:
+#   python3 tag_dictionary.py ../dataset/CCGbank/tag_dict.npz --cutoff 20
+# and shortlist_report.py to compare with the full softmax.
+###############################
+
+DATA_PATH = "../dataset/CCGbank/"
+
+# Log-probability of the labels left out of a shortlist. Finite, so that
+# beams larger than the shortlist and the agent's state stay well defined.
+PRUNED_LOGP = -1e4
+
+
+def read_indexed(filename):
+  with open(filename) as f:
+    return [list(map(int, line.split())) for line in f]
+
+
+class TagDictionary():
+  # word_tags: word index => sorted array of its tag indices, for the
+  # frequent words; fallback_tags: sorted array of tag indices
+  def __init__(self, word_tags, fallback_tags):
+    self.word_tags = word_tags
+    self.fallback_tags = fallback_tags
+
+  @staticmethod
+  def build(sentences, tag_seqs, cutoff=20, fallback_min_count=10):
+    word_count = collections.Counter()
+    tag_count = collections.Counter()
+    word_tag_sets = collections.defaultdict(set)
+    for sentence, tags in zip(sentences, tag_seqs):
+      assert len(sentence) == len(tags)
+      word_count.update(sentence)
+      tag_count.update(tags)
+      for word, tag in zip(sentence, tags):
+        word_tag_sets[word].add(tag)
+
+    word_tags = {word: np.array(sorted(word_tag_sets[word]), dtype=np.int64)
+                 for word, count in word_count.items() if count >= cutoff}
+    fallback_tags = np.array(sorted(tag for tag, count in tag_count.items()
+                                    if count >= fallback_min_count), dtype=np.int64)
+    return TagDictionary(word_tags, fallback_tags)
+
+  def save(self, filename):
+    words = np.array(sorted(self.word_tags), dtype=np.int64)
+    lengths = [len(self.word_tags[word]) for word in words]
+    np.savez(filename, words=words,
+             offsets=np.cumsum([0] + lengths).astype(np.int64),
+             tags=np.concatenate([self.word_tags[word] for word in words] + [np.zeros(0, dtype=np.int64)]),
+             fallback_tags=self.fallback_tags)
+
+  @staticmethod
+  def load(filename):
+    data = np.load(filename)
+    offsets = data["offsets"]
+    tags = data["tags"]
+    word_tags = {int(word): tags[offsets[i]:offsets[i + 1]]
+                 for i, word in enumerate(data["words"])}
+    return TagDictionary(word_tags, data["fallback_tags"])
+
+  def tags(self, word):
+    return self.word_tags.get(int(word), self.fallback_tags)
+
+  # For each position t of a batch (batch size, sen len) of word indices,
+  # (candidates, mask): the union of the batch's shortlists at t as a
+  # LongTensor, and a (batch size, number of candidates) FloatTensor adding
+  # PRUNED_LOGP to the candidates not in a sentence's own shortlist (None
+  # for a batch of one)
+  def shortlist(self, sen, gpu=False, cuda_dev=None):
+    sen = np.asarray(sen)
+    result = []
+    for t in range(sen.shape[1]):
+      tag_sets = [self.tags(word) for word in sen[:, t]]
+      if len(tag_sets) == 1:
+        candidates = tag_sets[0]
+        mask = None
+      else:
+        candidates = np.unique(np.concatenate(tag_sets))
+        mask = np.full((len(tag_sets), len(candidates)), PRUNED_LOGP, dtype=np.float32)
+        for i, tags in enumerate(tag_sets):
+          mask[i, np.searchsorted(candidates, tags)] = 0
+        mask = Variable(torch.from_numpy(mask))
+      candidates = Variable(torch.from_numpy(np.asarray(candidates, dtype=np.int64)))
+      if gpu:
+        candidates = candidates.cuda(cuda_dev)
+        mask = mask.cuda(cuda_dev) if mask is not None else None
+      result.append((candidates, mask))
+    return result
+
+  # (fraction of the gold tags in the shortlist, average shortlist size)
+  def coverage(self, sentences, tag_seqs):
+    covered = 0
+    size = 0
+    total = 0
+    for sentence, tags in zip(sentences, tag_seqs):
+      for word, tag in zip(sentence, tags):
+        shortlist = self.tags(word)
+        covered += int(tag in shortlist)
+        size += len(shortlist)
+        total += 1
+    return covered / max(total, 1), size / max(total, 1)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Build a CCG tag dictionary from indexed training data')
+  parser.add_argument('output', help='npz file to write')
+  parser.add_argument('--data', default='train',
+                      help='CCGbank split to read, <data>_x and <data>_y (default: train)')
+  parser.add_argument('--cutoff', type=int, default=20,
+                      help='words seen less often get the fallback tags (default: 20)')
+  parser.add_argument('--fallback-min-count', type=int, default=10,
+                      help='count of a tag to be in the fallback set (default: 10)')
+  args = parser.parse_args()
+
+  sentences = read_indexed(DATA_PATH + args.data + "_x")
+  tag_seqs = read_indexed(DATA_PATH + args.data + "_y")
+  tag_dictionary = TagDictionary.build(sentences, tag_seqs, args.cutoff, args.fallback_min_count)
+  tag_dictionary.save(args.output)
+
+  covered, size = tag_dictionary.coverage(sentences, tag_seqs)
+  print("%d words with their own tags, %d fallback tags" % (len(tag_dictionary.word_tags), len(tag_dictionary.fallback_tags)))
+  print("On %s: gold tag in shortlist %.4f, average shortlist size %.1f" % (args.data, covered, size))
+
+
+if __name__ == "__main__":
+  main()
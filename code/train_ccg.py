@@ -15,6 +15,7 @@ from operator import itemgetter
 import collections
 
 from ner import ner
+from distributed import launch
 
 
 def get_index2word(dict_file):
@@ -135,14 +136,27 @@ def main():
 
   load_model_filename = None
 
-  machine = ner(word_embedding_dim, hidden_dim, label_embedding_dim, vocab_size, label_size, learning_rate=learning_rate, minibatch_size=batch_size, max_epoch=max_epoch, train_X=train_X, train_Y=train_Y, val_X=None, val_Y=None, test_X=None, test_Y=None, attention=attention, gpu=gpu, pretrained=pretrained, load_model_filename=load_model_filename)
+  # "adaptive" for an adaptive softmax over the supertags, with clusters cut
+  # at adaptive_cutoffs in their frequency ranking (see adaptive_softmax.py)
+  output_layer = "softmax"
+  adaptive_cutoffs = (100, 400)
+
+  # Data parallel training over this many local processes, with
+  # threads_per_proc torch threads each (see distributed.py)
+  num_procs = 1
+  threads_per_proc = 1
+
+  machine = ner(word_embedding_dim, hidden_dim, label_embedding_dim, vocab_size, label_size, learning_rate=learning_rate, minibatch_size=batch_size, max_epoch=max_epoch, train_X=train_X, train_Y=train_Y, val_X=None, val_Y=None, test_X=None, test_Y=None, attention=attention, gpu=gpu, pretrained=pretrained, load_model_filename=load_model_filename, output_layer=output_layer, adaptive_cutoffs=adaptive_cutoffs)
   if gpu:
     machine = machine.cuda()
 
   shuffle = True
 
   # Pure training, no evaluation
-  train_loss_list = machine.train(shuffle, result_path, False, None)
+  if num_procs > 1:
+    launch(num_procs, machine.train, (shuffle, result_path, False, None), {"data": "ccg", "distributed": True}, num_threads=threads_per_proc)
+  else:
+    train_loss_list = machine.train(shuffle, result_path, False, None, data="ccg")
 
 
 if __name__ == "__main__":
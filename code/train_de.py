@@ -142,7 +142,7 @@ def main():
   shuffle = True
 
   # Pure training, no evaluation shuffle, result_path, do_evaluation, beam_size
-  train_loss_list = machine.train(shuffle, result_path, True, None)
+  train_loss_list = machine.train(shuffle, result_path, True, None, index2label=index2label)
 
 
 if __name__ == "__main__":
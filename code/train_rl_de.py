@@ -10,9 +10,12 @@ import pandas as pd
 import torch
 import torch.multiprocessing as mp
 
+from checkpoint_manager import CheckpointManager
 from model import AdaptiveActorCritic
 from ner import ner
 from optim import SharedAdam
+from param_server import run_parameter_server, train_adaptive_remote
+import profiler
 from rl_trainer import train_adaptive, eval_adaptive
 
 matplotlib.use("Agg")
@@ -221,13 +224,137 @@ def main():
                       help='name of the process')
   parser.add_argument('--no-shared', default=False,
                       help='use an optimizer without shared momentum.')
+  parser.add_argument('--sync-interval', type=int, default=10,
+                      help='number of sentences between two syncs with the '
+                           'shared model (default: 10)')
+  parser.add_argument('--counter-interval', type=int, default=100,
+                      help='number of steps counted locally before updating '
+                           'the shared step counter (default: 100)')
+  parser.add_argument('--warm-start', default=None,
+                      help='checkpoint of the agent to start from, e.g. '
+                           'ckpt_offline.pth from offline_trainer.py')
+  parser.add_argument('--state-type', default='topk',
+                      choices=['topk', 'compact'],
+                      help='state of the agent: "topk" has 2 * max_beam_size '
+                           '+ 1 elements, "compact" a fixed-size summary '
+                           'independent of the label size (default: topk)')
+  parser.add_argument('--action-repeat', type=int, default=1,
+                      help='number of time steps the agent\'s beam size is '
+                           'held before it is queried again (default: 1)')
+  parser.add_argument('--repeat-gap-threshold', type=float, default=None,
+                      help='also query the agent when the gap between the '
+                           'two best scores moved by more than this since '
+                           'the last query (default: off)')
+  parser.add_argument('--result-mode', default='text', choices=['text', 'npz'],
+                      help='prediction files: legacy text, or one npz file '
+                           'to convert with prediction_store.py (default: text)')
+  parser.add_argument('--background-writer', action='store_true',
+                      help='format and write the text prediction files in a '
+                           'background thread')
+  parser.add_argument('--keep-checkpoints', type=int, default=None,
+                      help='keep only the checkpoints of the last N epochs '
+                           '(default: keep all)')
+  parser.add_argument('--profile', default=None,
+                      help='directory to write timing spans to (Chrome '
+                           'trace and summary, see profiler.py; default: off)')
+  parser.add_argument('--ps-role', default='none',
+                      choices=['none', 'local', 'server', 'actor'],
+                      help='parameter-server mode: "none" uses shared memory '
+                           'on this host; "local" starts a server and '
+                           '--num-processes actors on localhost; "server" and '
+                           '"actor" start one side only (default: none)')
+  parser.add_argument('--ps-host', default='127.0.0.1',
+                      help='host of the parameter server (default: 127.0.0.1)')
+  parser.add_argument('--ps-bind', default=None,
+                      help='address the server listens on, e.g. 0.0.0.0 for '
+                           'remote actors (default: --ps-host)')
+  parser.add_argument('--ps-port', type=int, default=29500,
+                      help='port of the parameter server (default: 29500)')
+  parser.add_argument('--ps-authkey', default=None,
+                      help='shared secret between server and actors '
+                           '(default: $ADABEAM_PS_AUTHKEY; required, as the '
+                           'server unpickles what the actors send)')
+  parser.add_argument('--ps-num-actors', type=int, default=None,
+                      help='number of actors the server waits for, over all '
+                           'hosts (default: --num-processes)')
+  parser.add_argument('--ps-rank-offset', type=int, default=0,
+                      help='rank of the first actor started on this host')
   args = parser.parse_args()
 
+  if args.ps_role != 'none':
+    args.ps_authkey = args.ps_authkey or os.environ.get('ADABEAM_PS_AUTHKEY')
+    if not args.ps_authkey:
+      parser.error('parameter-server mode needs --ps-authkey or $ADABEAM_PS_AUTHKEY')
+
   if not os.path.exists(args.logdir):
     os.mkdir(args.logdir)
 
+  if args.profile:
+    # Also through the environment, for workers that do not fork
+    os.environ['ADABEAM_PROFILE'] = args.profile
+    profiler.enable(args.profile)
+
+  machine.state_type = args.state_type
+  machine.action_repeat = args.action_repeat
+  machine.repeat_gap_threshold = args.repeat_gap_threshold
+
+  # For German dataset, f_score_index_begin = 5 (because O_INDEX = 4)
+  f_score_index_begin = 5
+  # RL reward coefficient
+  reward_coef_fscore = 1
+  reward_coef_beam_size = 0.1
+
+  if args.ps_role != 'none':
+    # --------------------------------------------
+    #       RL TRAINING WITH A PARAMETER SERVER
+    # --------------------------------------------
+    address = (args.ps_host, args.ps_port)
+    authkey = args.ps_authkey.encode()
+    num_actors = args.ps_num_actors or args.num_processes
+
+    processes = []
+    if args.ps_role in ('local', 'server'):
+      # Only on --ps-host unless another address (e.g. 0.0.0.0, for remote
+      # actors) is given explicitly
+      server_address = (args.ps_bind or args.ps_host, args.ps_port)
+      p = mp.Process(target=run_parameter_server,
+                     args=(max_beam_size, args.lr, server_address, authkey,
+                           num_actors, args.logdir, args.warm_start,
+                           args.state_type, args.keep_checkpoints))
+      p.start()
+      processes.append(p)
+
+    if args.ps_role in ('local', 'actor'):
+      for rank in range(args.ps_rank_offset,
+                        args.ps_rank_offset + args.num_processes):
+        p = mp.Process(target=train_adaptive_remote,
+                       args=(rank,
+                             machine,
+                             max_beam_size,
+                             address,
+                             authkey,
+                             val_X, val_Y,
+                             "adaptive", initial_beam_size,
+                             reward_coef_fscore, reward_coef_beam_size,
+                             f_score_index_begin,
+                             args))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+      p.join()
+
+    if args.profile:
+      profiler.dump()
+      profiler.merge(args.profile)
+    return
+
   shared_model = AdaptiveActorCritic(max_beam_size=max_beam_size,
-                                     action_space=3)
+                                     action_space=3,
+                                     state_type=args.state_type)
+  if args.warm_start:
+    shared_model.load_state_dict(
+      torch.load(args.warm_start, map_location="cpu")["state_dict"])
   shared_model.share_memory()
 
   if args.no_shared:
@@ -242,16 +369,15 @@ def main():
   # --------------------------------------------
   #                 RL TRAINING
   # --------------------------------------------
-  # For German dataset, f_score_index_begin = 5 (because O_INDEX = 4)
-  # For toy dataset, f_score_index_begin = 4 (because {0: '<s>', 1: '<e>', 2: '<p>', 3: '<u>', ...})
-  f_score_index_begin = 5
-  # RL reward coefficient
-  reward_coef_fscore = 1
-  reward_coef_beam_size = 0.1
-
   processes = []
   counter = mp.Value('i', 0)
   lock = mp.Lock()
+  # Version stamp of the shared model, bumped after every optimizer step.
+  # Deliberately lock-free; see rl_trainer.train_adaptive.
+  version = mp.RawValue('i', 0)
+  # One background-written checkpoint per epoch, whichever worker gets there
+  # first (see checkpoint_manager.py)
+  checkpoint_manager = CheckpointManager(args.logdir, keep_last=args.keep_checkpoints)
 
   args.name = "train"
   for rank in range(0, args.num_processes):
@@ -268,13 +394,19 @@ def main():
                          "train", "adaptive", initial_beam_size,
                          reward_coef_fscore, reward_coef_beam_size,
                          f_score_index_begin,
-                         args))
+                         args,
+                         version,
+                         checkpoint_manager))
     p.start()
     processes.append(p)
 
   for p in processes:
     p.join()
 
+  if args.profile:
+    profiler.dump()
+    print(profiler.merge(args.profile))
+
 
 if __name__ == "__main__":
   main()